@@ -2,38 +2,47 @@
 Agent module for contract analysis.
 Supports LLMs: Ollama (local, default), OpenAI, Anthropic.
 Switch LLM by setting the LLM_PROVIDER environment variable to 'ollama', 'openai', or 'anthropic'.
+Requests go through the pooled, retrying clients in llm.py.
+
+Contracts longer than SUMMARY_MAX_CHARS are summarized map-reduce style:
+section-sized chunks are summarized in parallel (cached by content hash, so an
+edited contract only re-summarizes the changed sections) and then reduced.
+
+Clause extraction can be served by a local extractor (e.g. the CUAD span model
+in cuad_extractor.py) by pointing CLAUSE_EXTRACTOR at a 'module:function'.
+Clauses are asked as their CUAD categories; only those it answers with low
+confidence, or that have no CUAD category, are sent to the LLM.
 """
 import os
+import json
+import hashlib
+import importlib
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 load_dotenv()
 from langchain.prompts import PromptTemplate
 import re
 
-# LLM imports
+from llm import get_client
+import telemetry
+from telemetry import span
+
+# Default provider; analyze_contract(..., provider=...) can use another one side by side
 LLM_PROVIDER = os.getenv("LLM_PROVIDER", "ollama").lower()
 
-if LLM_PROVIDER == "openai":
-    from langchain_openai import OpenAI
-    LLM = OpenAI(temperature=0, openai_api_key=os.getenv("OPENAI_API_KEY"))
-elif LLM_PROVIDER == "anthropic":
-    from langchain_anthropic import ChatAnthropic
-    LLM = ChatAnthropic(model="claude-3-opus-20240229", anthropic_api_key=os.getenv("ANTHROPIC_API_KEY"))
-else:  # Default to Ollama
-    from langchain_ollama import OllamaLLM
-    LLM = OllamaLLM(model="llama3")  # You can change to "mistral" or another local model
-
-# Prompt templates
+# Prompt templates. Prompts over the contract put it first, so classification,
+# clause extraction and summary share one prefix and Ollama can reuse its KV cache.
 CLASSIFY_PROMPT = PromptTemplate(
     input_variables=["contract_text"],
     template="""
-    Classify this contract. Is it an NDA, SLA, MSA, or Other?\nContract:\n{contract_text}\nType (NDA/SLA/MSA/Other):
+    Contract:\n{contract_text}\n\nClassify this contract. Is it an NDA, SLA, MSA, or Other?\nType (NDA/SLA/MSA/Other):
     """
 )
 
 CLAUSE_PROMPT = PromptTemplate(
     input_variables=["clause_name", "contract_text"],
     template="""
-    Extract the *{clause_name}* clause from this contract.\nContract:\n{contract_text}\nClause:
+    Contract:\n{contract_text}\n\nExtract the *{clause_name}* clause from this contract.\nClause:
     """
 )
 
@@ -47,11 +56,93 @@ RISK_PROMPT = PromptTemplate(
 SUMMARY_PROMPT = PromptTemplate(
     input_variables=["contract_text"],
     template="""
-    Summarize this contract in 2-3 sentences.\nContract:\n{contract_text}\nSummary:
+    Contract:\n{contract_text}\n\nSummarize this contract in 2-3 sentences.\nSummary:
+    """
+)
+
+SECTION_SUMMARY_PROMPT = PromptTemplate(
+    input_variables=["section_text"],
+    template="""
+    Summarize this contract section in 2-3 sentences, keeping parties, obligations, dates and amounts.\nSection:\n{section_text}\nSummary:
     """
 )
 
-KEY_CLAUSES = ["Termination", "Indemnity", "Confidentiality"]
+REDUCE_SUMMARY_PROMPT = PromptTemplate(
+    input_variables=["section_summaries"],
+    template="""
+    These are summaries of consecutive sections of one contract. Summarize the whole contract in 2-3 sentences.\nSection summaries:\n{section_summaries}\nSummary:
+    """
+)
+
+# Contracts longer than this (in characters) are summarized map-reduce style and
+# classified from their opening only, instead of overflowing the model context.
+SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", "12000"))
+SUMMARY_CHUNK_CHARS = int(os.getenv("SUMMARY_CHUNK_CHARS", "6000"))
+SUMMARY_WORKERS = int(os.getenv("SUMMARY_WORKERS", "4"))
+SUMMARY_CACHE_DIR = os.path.join(os.path.dirname(__file__), '..', 'data', 'cache', 'summaries')
+
+# Paragraphs that open a new section: "ARTICLE 5", "Section 2.1", "12. Term", "3.4 Fees"
+SECTION_HEADING = re.compile(r'^\s*(ARTICLE|Article|SECTION|Section|\d+(\.\d+)*\.?\s+[A-Z])')
+
+CONTRACT_TYPES = ["NDA", "SLA", "MSA", "Other"]
+
+# Per-prompt generation limits. Classification is a single label, decoded under
+# a choice constraint where the provider supports it, and ends at the first line;
+# risk is a level plus one sentence and ends at the first blank line. (Anthropic
+# rejects whitespace-only stop sequences, so there only max_tokens applies.)
+# Models that open with a newline hit these stops before any text, so
+# analyze_contract_stream retries an empty answer once without its stop sequences.
+GENERATION_OPTIONS = {
+    "contract_type": {"max_tokens": 10, "choices": CONTRACT_TYPES, "stop": ["\n"]},
+    "clause": {"max_tokens": 512},
+    "risk": {"max_tokens": 80, "stop": ["\n\n"]},
+    "summary": {"max_tokens": 200},
+}
+
+KEY_CLAUSES = [c.strip() for c in os.getenv("KEY_CLAUSES", "Termination,Indemnity,Confidentiality").split(",") if c.strip()]
+
+# The 41 CUAD clause categories a local span model can be trained on
+CUAD_CATEGORIES = [
+    "Document Name", "Parties", "Agreement Date", "Effective Date", "Expiration Date",
+    "Renewal Term", "Notice Period To Terminate Renewal", "Governing Law", "Most Favored Nation",
+    "Non-Compete", "Exclusivity", "No-Solicit Of Customers", "Competitive Restriction Exception",
+    "No-Solicit Of Employees", "Non-Disparagement", "Termination For Convenience", "Rofr/Rofo/Rofn",
+    "Change Of Control", "Anti-Assignment", "Revenue/Profit Sharing", "Price Restrictions",
+    "Minimum Commitment", "Volume Restriction", "Ip Ownership Assignment", "Joint Ip Ownership",
+    "License Grant", "Non-Transferable License", "Affiliate License-Licensor",
+    "Affiliate License-Licensee", "Unlimited/All-You-Can-Eat-License",
+    "Irrevocable Or Perpetual License", "Source Code Escrow", "Post-Termination Services",
+    "Audit Rights", "Uncapped Liability", "Cap On Liability", "Liquidated Damages",
+    "Warranty Duration", "Insurance", "Covenant Not To Sue", "Third Party Beneficiary",
+]
+
+# KEY_CLAUSES names answered by a differently named CUAD category, extendable with
+# CLAUSE_CATEGORIES="Clause=CUAD Category;...". A mapped category may be narrower
+# than the clause (CUAD has no termination-for-cause category), so when it finds
+# nothing the clause goes to the LLM. CUAD has no indemnity or confidentiality
+# category, so those clauses always go to the LLM.
+CLAUSE_CATEGORIES = {"Termination": "Termination For Convenience"}
+CLAUSE_CATEGORIES.update(dict(
+    [part.strip() for part in pair.split("=", 1)]
+    for pair in os.getenv("CLAUSE_CATEGORIES", "").split(";") if "=" in pair))
+
+# Local clause extractor as 'module:function', e.g. 'cuad_extractor:extract_clauses'.
+# It is called as fn(text, categories) with CUAD category names and returns CUAD
+# n-best lists: {category: [{"text": ..., "probability": ...}, ...]}.
+CLAUSE_EXTRACTOR = os.getenv("CLAUSE_EXTRACTOR", "")
+# Local answers below this n-best probability are re-extracted by the LLM
+CLAUSE_CONFIDENCE = float(os.getenv("CLAUSE_CONFIDENCE", "0.5"))
+NO_CLAUSE_TEXT = "No {clause_name} clause found in this contract."
+
+_clause_extractor = None
+
+def get_clause_extractor():
+    """Imports the configured local clause extractor once; None if not configured."""
+    global _clause_extractor
+    if _clause_extractor is None and CLAUSE_EXTRACTOR:
+        module_name, func_name = CLAUSE_EXTRACTOR.split(":")
+        _clause_extractor = getattr(importlib.import_module(module_name), func_name)
+    return _clause_extractor
 
 # Helper to extract risk level
 def extract_risk_level(risk_text):
@@ -60,44 +151,239 @@ def extract_risk_level(risk_text):
         return match.group(1).capitalize()
     return "Unknown"
 
-def analyze_contract(text, doc_id):
+# Helper to extract contract type from a free-text classification
+def extract_contract_type(type_text):
+    match = re.search(r'\b(NDA|SLA|MSA|Non-Disclosure|Service Level|Master Services?|Other)\b', type_text, re.IGNORECASE)
+    if not match:
+        return "Other"
+    label = match.group(1).upper()
+    if label in ("NDA", "NON-DISCLOSURE"):
+        return "NDA"
+    if label in ("SLA", "SERVICE LEVEL"):
+        return "SLA"
+    if label.startswith("MASTER") or label == "MSA":
+        return "MSA"
+    return "Other"
+
+def get_clause_category(clause):
+    """The CUAD category that answers a clause name, or None if there is none."""
+    if clause in CLAUSE_CATEGORIES:
+        return CLAUSE_CATEGORIES[clause]
+    for category in CUAD_CATEGORIES:
+        if category.lower() == clause.lower():
+            return category
+    return None
+
+def extract_local_clauses(text, clause_names):
     """
-    Analyzes a contract: classifies, extracts clauses, scores risk, and summarizes.
+    Runs the local extractor on the CUAD categories of the clauses, keeping only
+    the clauses it answers confidently. The most probable n-best entry decides:
+    a confident non-empty span is used as the clause, a confident empty span
+    means the clause is absent if the clause is itself a CUAD category, and
+    anything else (low confidence, no CUAD category, or nothing found in a
+    mapped category) is left for the LLM.
     Args:
         text (str): The contract text.
-        doc_id (str): Unique identifier for the document.
+        clause_names (list): Clause names to extract.
     Returns:
-        dict: {contract_type, clauses, risks, risk_rationales, summary}
+        dict: {clause: (clause_text, probability)} for the confident clauses.
     """
-    # Use .invoke() for chat models, direct call for Ollama/OpenAI
-    def get_llm_response(prompt):
-        if LLM_PROVIDER in ["anthropic"]:
-            return LLM.invoke(prompt).content.strip()
-        else:
-            return LLM.invoke(prompt).strip()
+    extractor = get_clause_extractor()
+    categories = {clause: get_clause_category(clause) for clause in clause_names}
+    wanted = list(dict.fromkeys(category for category in categories.values() if category))
+    nbest = extractor(text, wanted) if extractor and wanted else {}
+    local = {}
+    for clause in clause_names:
+        candidates = nbest.get(categories[clause]) or [] if categories[clause] else []
+        best = max(candidates, key=lambda c: c["probability"]) if candidates else None
+        if best is None or best["probability"] < CLAUSE_CONFIDENCE:
+            continue
+        if best["text"]:
+            local[clause] = (best["text"], best["probability"])
+        elif categories[clause].lower() == clause.lower():
+            local[clause] = (NO_CLAUSE_TEXT.format(clause_name=clause), best["probability"])
+    return local
+
+def split_sections(text, max_chars=SUMMARY_CHUNK_CHARS):
+    """
+    Splits a contract into section-sized chunks at paragraph boundaries.
+    A chunk is closed at a section heading once it is half full, or before a
+    paragraph that would overflow it, so boundaries follow the document's own
+    structure and an edit only changes the chunks around it.
+    """
+    chunks, current, size = [], [], 0
+    for para in re.split(r'\n\s*\n', text):
+        para = para.strip()
+        # Oversized paragraphs are hard-split
+        for piece in (para[i:i + max_chars] for i in range(0, len(para), max_chars)):
+            at_heading = SECTION_HEADING.match(piece)
+            if current and (size + len(piece) > max_chars or (at_heading and size >= max_chars // 2)):
+                chunks.append("\n\n".join(current))
+                current, size = [], 0
+            current.append(piece)
+            size += len(piece) + 2
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+def cached_generate(client, prompt, options, cache_dir=None, name="section_summary"):
+    """
+    Generates through an on-disk cache keyed by a hash of provider, model and prompt.
+    name labels the cache in metrics and the LLM span.
+    """
+    cache_dir = cache_dir or SUMMARY_CACHE_DIR
+    key = hashlib.sha256(f"{client.provider}:{client.model}\n{prompt}".encode()).hexdigest()
+    path = os.path.join(cache_dir, key + '.json')
+    if os.path.exists(path):
+        telemetry.inc("cache_hits", cache=name)
+        with open(path, 'r') as f:
+            return json.load(f)["text"]
+    telemetry.inc("cache_misses", cache=name)
+    with span("llm", provider=client.provider, field=name):
+        text = client.generate(prompt, **options).strip()
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({"text": text}, f)
+    os.replace(tmp_path, path)
+    return text
+
+def summarize_sections(text, client):
+    """
+    Map step of the long-contract summary: summarizes each section in parallel
+    and returns the joined section summaries, recursing until they fit in
+    SUMMARY_MAX_CHARS.
+    """
+    sections = split_sections(text)
+    prompts = [SECTION_SUMMARY_PROMPT.format(section_text=section) for section in sections]
+    with ThreadPoolExecutor(max_workers=SUMMARY_WORKERS) as pool:
+        summaries = list(pool.map(lambda p: cached_generate(client, p, GENERATION_OPTIONS["summary"]), prompts))
+    digest = "\n".join(f"- {summary}" for summary in summaries)
+    if len(digest) > SUMMARY_MAX_CHARS and len(sections) > 1:
+        return summarize_sections(digest, client)
+    return digest
+
+def prefill_report(calls):
+    """
+    Estimates the prefill work saved by KV-cache reuse across one contract's prompts.
+    The first call is taken as cold and calibrates characters per token and
+    prefill seconds per token; every later call is credited with the tokens
+    its prompt should have cost minus the tokens the provider actually evaluated.
+    Args:
+        calls (list): (prompt_chars, prompt_tokens_evaluated, prefill_seconds) per call, in order.
+    Returns:
+        dict: {calls, prompt_tokens, prefill_seconds, saved_tokens_est, saved_seconds_est},
+            or None if the provider reported no prompt tokens.
+    """
+    calls = [call for call in calls if call[1]]
+    if not calls:
+        return None
+    first_chars, first_tokens, first_seconds = calls[0]
+    chars_per_token = first_chars / first_tokens
+    saved_tokens = sum(max(0.0, chars / chars_per_token - tokens) for chars, tokens, _ in calls[1:])
+    return {
+        "calls": len(calls),
+        "prompt_tokens": sum(tokens for _, tokens, _ in calls),
+        "prefill_seconds": round(sum(seconds for _, _, seconds in calls), 3),
+        "saved_tokens_est": int(saved_tokens),
+        "saved_seconds_est": round(saved_tokens * first_seconds / first_tokens, 3),
+    }
+
+def analyze_contract_stream(text, doc_id, provider=None):
+    """
+    Streaming variant of analyze_contract: yields each field as its tokens arrive.
+    Fields are produced in order: contract_type, each clause, summary, then each
+    clause's risk. The prompts that carry the whole contract run back to back so
+    the provider can reuse the cached contract prefix between them.
+    Args:
+        text (str): The contract text.
+        doc_id (str): Unique identifier for the document.
+        provider (str): LLM provider to use; defaults to LLM_PROVIDER.
+    Yields:
+        dict: {"event": "start" | "delta" | "end", "field", "clause", "text"}, where
+            "delta" carries new tokens and "end" the complete field text; the last
+            event is {"event": "done", "analysis": <analyze_contract result>,
+            "prefill": <prefill_report of the contract prompts>}.
+    """
+    client = get_client(provider or LLM_PROVIDER)
+    contract_calls = []
+
+    def stream_field(field, prompt, clause=None, parse=None, track_prefill=False):
+        yield {"event": "start", "field": field, "clause": clause}
+        options = GENERATION_OPTIONS[field]
+        while True:
+            parts = []
+            with span("llm", provider=client.provider, field=field):
+                for delta in client.stream(prompt, **options):
+                    parts.append(delta)
+                    yield {"event": "delta", "field": field, "clause": clause, "text": delta}
+            if track_prefill:
+                stats = client.last_stats
+                contract_calls.append((len(prompt), stats.get("prompt_tokens", 0), stats.get("prefill_seconds", 0.0)))
+            value = "".join(parts).strip()
+            if value or "stop" not in options:
+                break
+            # Stopped before any text (e.g. on a leading newline): retry once without stop sequences
+            options = {k: v for k, v in options.items() if k != "stop"}
+        if parse:
+            value = parse(value)
+        yield {"event": "end", "field": field, "clause": clause, "text": value}
+        return value
 
     # 1. Classification
-    contract_type = get_llm_response(CLASSIFY_PROMPT.format(contract_text=text))
-    # 2. Clause extraction
-    clauses = {}
+    # The opening of a contract (title, recitals) is enough to classify it
+    contract_type = yield from stream_field(
+        "contract_type", CLASSIFY_PROMPT.format(contract_text=text[:SUMMARY_MAX_CHARS]),
+        parse=extract_contract_type, track_prefill=True)
+    # 2. Clause extraction (local extractor first, LLM for low-confidence clauses)
+    with span("local_clauses"):
+        local_clauses = extract_local_clauses(text, KEY_CLAUSES)
+    clauses, clause_confidence = {}, {}
     for clause in KEY_CLAUSES:
-        clause_text = get_llm_response(CLAUSE_PROMPT.format(clause_name=clause, contract_text=text))
+        if clause in local_clauses:
+            clause_text, clause_confidence[clause] = local_clauses[clause]
+            yield {"event": "start", "field": "clause", "clause": clause}
+            yield {"event": "delta", "field": "clause", "clause": clause, "text": clause_text}
+            yield {"event": "end", "field": "clause", "clause": clause, "text": clause_text}
+        else:
+            clause_confidence[clause] = None
+            clause_text = yield from stream_field(
+                "clause", CLAUSE_PROMPT.format(clause_name=clause, contract_text=text), clause, track_prefill=True)
         clauses[clause] = clause_text
-    # 3. Risk scoring
-    risks = {}
-    risk_rationales = {}
+    # 3. Summarization (map-reduce over sections for long contracts)
+    if len(text) > SUMMARY_MAX_CHARS:
+        with span("summary_map"):
+            section_summaries = summarize_sections(text, client)
+        summary = yield from stream_field("summary", REDUCE_SUMMARY_PROMPT.format(section_summaries=section_summaries))
+    else:
+        summary = yield from stream_field("summary", SUMMARY_PROMPT.format(contract_text=text), track_prefill=True)
+    # 4. Risk scoring
+    risks, risk_rationales = {}, {}
     for clause, clause_text in clauses.items():
-        risk_response = get_llm_response(RISK_PROMPT.format(clause_name=clause, clause_text=clause_text))
-        risk_level = extract_risk_level(risk_response)
-        risks[clause] = risk_level
+        risk_response = yield from stream_field(
+            "risk", RISK_PROMPT.format(clause_name=clause, clause_text=clause_text), clause)
+        risks[clause] = extract_risk_level(risk_response)
         risk_rationales[clause] = risk_response
-    # 4. Summarization
-    summary = get_llm_response(SUMMARY_PROMPT.format(contract_text=text))
-    return {
+    yield {"event": "done", "prefill": prefill_report(contract_calls), "analysis": {
         "doc_id": doc_id,
         "contract_type": contract_type,
         "clauses": clauses,
+        "clause_confidence": clause_confidence,
         "risks": risks,
         "risk_rationales": risk_rationales,
         "summary": summary
-    } 
\ No newline at end of file
+    }}
+
+def analyze_contract(text, doc_id, provider=None):
+    """
+    Analyzes a contract: classifies, extracts clauses, scores risk, and summarizes.
+    Args:
+        text (str): The contract text.
+        doc_id (str): Unique identifier for the document.
+        provider (str): LLM provider to use; defaults to LLM_PROVIDER.
+    Returns:
+        dict: {contract_type, clauses, clause_confidence, risks, risk_rationales, summary}
+    """
+    for event in analyze_contract_stream(text, doc_id, provider):
+        if event["event"] == "done":
+            return event["analysis"]
@@ -0,0 +1,354 @@
+"""
+End-to-end pipeline benchmark.
+
+Runs parser.parse_contract, embedder.chunk_and_embed and agent.analyze_contract
+over a fixed, sorted sample of the CUAD contracts in uploads/, against the
+deterministic fake LLM from fake_llm.py (Ollama protocol) with configurable
+latency. Reports per-stage p50/p95 latency, docs/sec, peak RSS and LLM tokens,
+and writes the results as JSON so runs can be compared over time.
+
+--index compares the FAISS index types in vector_index.py against the exact
+flat baseline instead: build time, size, query latency and recall@k for a sweep
+of nprobe / efSearch values, over the vectors of an existing store or a
+synthetic clustered corpus.
+
+--retrieval embeds a sample of labelled CUAD contracts and asks each clause
+question within its contract, comparing vector, BM25 and hybrid retrieval:
+a hit is a top-k chunk overlapping a labelled answer span.
+
+Usage:
+    python benchmark.py --docs 10 --latency 0.05 [--skip-embed] [--compare previous.json]
+    python benchmark.py --index [--store data/vectorstore | --vectors 200000] [--k 10]
+    python benchmark.py --retrieval --docs 20 [--k 5]
+"""
+import os
+import sys
+import json
+import math
+import glob
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+from datetime import datetime, timezone
+
+import numpy as np
+
+from fake_llm import FakeLLMServer
+from profiling import PROFILE, profile
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), 'uploads')
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), '..', 'data', 'benchmarks')
+STAGES = ["parse", "embed", "analyze", "total"]
+# Query-time settings swept per index type in the index benchmark
+SEARCH_SWEEP = {"flat": [None], "hnsw": [16, 64, 256], "ivf_flat": [1, 4, 16, 64], "ivf_pq": [1, 4, 16, 64]}
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def sample_corpus(corpus_dir, docs):
+    return sorted(glob.glob(os.path.join(corpus_dir, '*.txt')))[:docs]
+
+def summarize_stage(seconds):
+    return {
+        "p50_ms": round(percentile(seconds, 50) * 1000, 2),
+        "p95_ms": round(percentile(seconds, 95) * 1000, 2),
+        "mean_ms": round(sum(seconds) / len(seconds) * 1000, 2) if seconds else 0.0,
+        "total_s": round(sum(seconds), 3),
+    }
+
+def run_benchmark(paths, latency=0.0, prefill_latency=0.0, skip_embed=False, profile_dir=None):
+    """
+    Benchmarks the pipeline over the given contract files.
+    Args:
+        paths (list): Contract files to process, in order.
+        latency (float): Fake LLM seconds per request.
+        prefill_latency (float): Fake LLM seconds per uncached prompt word.
+        skip_embed (bool): Skip the embedding stage (e.g. without the MiniLM model).
+        profile_dir (str): If set, sample-profile each document into <profile_dir>/<doc>.collapsed.txt.
+    Returns:
+        dict: Benchmark results.
+    """
+    with FakeLLMServer(latency=latency, prefill_latency=prefill_latency) as server, \
+            tempfile.TemporaryDirectory() as work_dir:
+        # Point the pipeline at the fake LLM before agent/llm read their configuration
+        os.environ["LLM_PROVIDER"] = "ollama"
+        os.environ["OLLAMA_BASE_URL"] = server.url
+        import parser
+        import agent
+        if not skip_embed:
+            import embedder
+        agent.SUMMARY_CACHE_DIR = os.path.join(work_dir, 'summaries')
+        client = agent.get_client("ollama")
+        usage_before = dict(client.usage)
+
+        timings = {stage: [] for stage in STAGES}
+        started = time.perf_counter()
+        for path in paths:
+            doc_id = os.path.basename(path)
+            profile_path = os.path.join(profile_dir, doc_id + '.collapsed.txt') if profile_dir else None
+            with profile(profile_path, enabled=bool(profile_dir)):
+                t0 = time.perf_counter()
+                text = parser.parse_contract(path)
+                t1 = time.perf_counter()
+                if not skip_embed:
+                    embedder.chunk_and_embed(text, doc_id, persist_dir=os.path.join(work_dir, 'vectorstore'))
+                t2 = time.perf_counter()
+                agent.analyze_contract(text, doc_id)
+                t3 = time.perf_counter()
+            timings["parse"].append(t1 - t0)
+            if not skip_embed:
+                timings["embed"].append(t2 - t1)
+            timings["analyze"].append(t3 - t2)
+            timings["total"].append(t3 - t0)
+        elapsed = time.perf_counter() - started
+        usage = {key: round(value - usage_before.get(key, 0), 3) for key, value in client.usage.items()}
+
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "config": {"docs": len(paths), "latency": latency, "prefill_latency": prefill_latency,
+                   "skip_embed": skip_embed, "profiled": bool(profile_dir)},
+        "stages": {stage: summarize_stage(seconds) for stage, seconds in timings.items() if seconds},
+        "docs_per_sec": round(len(paths) / elapsed, 3) if elapsed else 0.0,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "llm": usage,
+    }
+
+def format_results(results, baseline=None):
+    lines = [f"{'Stage':<10} {'p50 ms':>10} {'p95 ms':>10} {'total s':>10}"]
+    for stage, row in results["stages"].items():
+        line = f"{stage:<10} {row['p50_ms']:>10.1f} {row['p95_ms']:>10.1f} {row['total_s']:>10.2f}"
+        if baseline and stage in baseline.get("stages", {}):
+            before = baseline["stages"][stage]["p50_ms"]
+            if before:
+                line += f"   p50 {100 * (row['p50_ms'] - before) / before:+.1f}%"
+        lines.append(line)
+    lines.append(f"docs/sec: {results['docs_per_sec']}   peak RSS: {results['peak_rss_mb']} MB")
+    lines.append(f"LLM: {results['llm']['requests']} requests, {results['llm']['prompt_tokens']} prompt tokens, "
+                 f"{results['llm']['completion_tokens']} completion tokens")
+    return "\n".join(lines)
+
+def load_store_vectors(store_dir):
+    """All vectors of a saved FAISS store, in position order."""
+    import faiss
+    import vector_index
+    index = faiss.read_index(os.path.join(store_dir, "index.faiss"))
+    if vector_index.index_type_of(index).startswith("ivf"):
+        faiss.extract_index_ivf(index).make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
+
+def synthetic_vectors(n, d=384, clusters=256, seed=0):
+    """Clustered random vectors, a rough stand-in for sentence embeddings."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, d)).astype("float32")
+    labels = rng.integers(0, clusters, n)
+    return centers[labels] + 0.3 * rng.normal(size=(n, d)).astype("float32")
+
+def run_index_benchmark(vectors, queries=200, k=10, index_types=None, seed=0):
+    """
+    Measures recall@k and query latency of each index type against exact search.
+    Queries are held-out perturbed copies of random corpus vectors.
+    Args:
+        vectors (np.ndarray): Corpus vectors, shape (n, d).
+        queries (int): Number of queries.
+        k (int): Neighbours per query.
+        index_types (list): Types to compare; defaults to all of vector_index.INDEX_TYPES.
+    Returns:
+        dict: Results with one row per (index type, search setting).
+    """
+    import vector_index
+    rng = np.random.default_rng(seed)
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    picked = vectors[rng.choice(len(vectors), queries, replace=False)]
+    query_vectors = picked + 0.05 * picked.std() * rng.normal(size=picked.shape).astype("float32")
+    rows, truth = [], None
+    for index_type in index_types or vector_index.INDEX_TYPES:
+        t0 = time.perf_counter()
+        index = vector_index.build_index(vectors, index_type)
+        build_s = time.perf_counter() - t0
+        for setting in SEARCH_SWEEP[index_type]:
+            if index_type == "hnsw":
+                vector_index.configure_search(index, ef_search=setting)
+            elif setting:
+                vector_index.configure_search(index, nprobe=setting)
+            latencies, found = [], []
+            for query in query_vectors:
+                t0 = time.perf_counter()
+                _, ids = index.search(query[None, :], k)
+                latencies.append(time.perf_counter() - t0)
+                found.append(ids[0])
+            if truth is None:
+                truth = found  # flat runs first and is exact
+            recall = np.mean([len(set(f) & set(t)) / k for f, t in zip(found, truth)])
+            rows.append({
+                "index": index_type,
+                "setting": setting,
+                "build_s": round(build_s, 3),
+                "size_mb": round(vector_index.index_bytes(index) / 1e6, 2),
+                "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+                "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+                f"recall_at_{k}": round(float(recall), 4),
+            })
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "config": {"vectors": len(vectors), "dim": vectors.shape[1], "queries": queries, "k": k},
+        "indexes": rows,
+    }
+
+def format_index_results(results):
+    k = results["config"]["k"]
+    lines = [f"{'Index':<10} {'setting':>8} {'build s':>8} {'MB':>9} {'p50 ms':>8} {'p95 ms':>8} {f'R@{k}':>7}"]
+    for row in results["indexes"]:
+        setting = "-" if row["setting"] is None else row["setting"]
+        lines.append(f"{row['index']:<10} {setting:>8} {row['build_s']:>8.2f} {row['size_mb']:>9.2f} "
+                     f"{row['p50_ms']:>8.3f} {row['p95_ms']:>8.3f} {row[f'recall_at_{k}']:>7.3f}")
+    return "\n".join(lines)
+
+def load_labelled_contracts(corpus_dir, docs):
+    """(doc_id, text, [(question, [(start, end) answer spans])]) for the first labelled contracts."""
+    contracts = []
+    for path in sorted(glob.glob(os.path.join(corpus_dir, '*.json')))[:docs]:
+        with open(path, 'r') as f:
+            paragraphs = json.load(f)
+        for para in paragraphs:
+            questions = []
+            for qa in para.get('qas', []):
+                spans = [(a['answer_start'], a['answer_start'] + len(a['text'])) for a in qa['answers']]
+                if spans:
+                    # CUAD questions end with a plain-language description of the category
+                    questions.append((qa['question'].split("Details:")[-1].strip(), spans))
+            contracts.append((os.path.basename(path)[:-len('.json')], para['context'], questions))
+    return contracts
+
+def run_retrieval_benchmark(contracts, k=5):
+    """
+    Compares vector, BM25 and hybrid retrieval on CUAD clause questions.
+    Every question is asked within its own contract (doc_id filter).
+    Args:
+        contracts (list): Output of load_labelled_contracts.
+        k (int): Chunks retrieved per question.
+    Returns:
+        dict: Hit rate, MRR and p50/p95 latency per mode.
+    """
+    import embedder
+    import retriever
+    with tempfile.TemporaryDirectory() as store_dir:
+        for doc_id, text, _ in contracts:
+            embedder.chunk_and_embed(text, doc_id, persist_dir=store_dir)
+        db = embedder.load_vectorstore(store_dir)
+        modes = {}
+        for mode in retriever.RETRIEVAL_MODES:
+            hits, reciprocal_ranks, latencies = 0, 0.0, []
+            for doc_id, _, questions in contracts:
+                for question, spans in questions:
+                    t0 = time.perf_counter()
+                    found = retriever.retrieve_positions(question, k, {"doc_id": doc_id}, mode, store_dir, db)
+                    latencies.append(time.perf_counter() - t0)
+                    chunks = embedder.get_documents(db, [p for p, _ in found])
+                    rank = next((i for i, chunk in enumerate(chunks, start=1)
+                                 if any(chunk.metadata["start"] < end and chunk.metadata["end"] > start
+                                        for start, end in spans)), None)
+                    if rank:
+                        hits += 1
+                        reciprocal_ranks += 1 / rank
+            questions_total = len(latencies)
+            modes[mode] = {
+                f"hit_at_{k}": round(hits / questions_total, 4) if questions_total else 0.0,
+                "mrr": round(reciprocal_ranks / questions_total, 4) if questions_total else 0.0,
+                "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+                "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            }
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "config": {"docs": len(contracts), "questions": questions_total, "k": k},
+        "modes": modes,
+    }
+
+def format_retrieval_results(results):
+    k = results["config"]["k"]
+    lines = [f"{'Mode':<8} {f'Hit@{k}':>7} {'MRR':>7} {'p50 ms':>8} {'p95 ms':>8}"]
+    for mode, row in results["modes"].items():
+        lines.append(f"{mode:<8} {row[f'hit_at_{k}']:>7.3f} {row['mrr']:>7.3f} {row['p50_ms']:>8.2f} {row['p95_ms']:>8.2f}")
+    lines.append(f"{results['config']['questions']} questions over {results['config']['docs']} contracts")
+    return "\n".join(lines)
+
+def save_results(results, out, prefix):
+    out = out or os.path.join(RESULTS_DIR, f"{prefix}-{results['timestamp'].replace(':', '')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {out}")
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmark parse/embed/analyze throughput.")
+    arg_parser.add_argument('--corpus', default=CORPUS_DIR, help="directory of .txt contracts")
+    arg_parser.add_argument('--docs', type=int, default=10, help="number of contracts (sorted by name)")
+    arg_parser.add_argument('--latency', type=float, default=0.05, help="fake LLM seconds per request")
+    arg_parser.add_argument('--prefill-latency', type=float, default=0.0, help="fake LLM seconds per uncached prompt word")
+    arg_parser.add_argument('--skip-embed', action='store_true', help="skip the embedding stage")
+    arg_parser.add_argument('--out', help="results json (default: data/benchmarks/benchmark-<timestamp>.json)")
+    arg_parser.add_argument('--compare', help="earlier results json to compare against")
+    arg_parser.add_argument('--profile', action='store_true',
+                            help="write per-document collapsed-stack profiles to <out>-profiles/")
+    arg_parser.add_argument('--index', action='store_true', help="benchmark FAISS index types instead of the pipeline")
+    arg_parser.add_argument('--store', help="--index: vector store directory to take vectors from")
+    arg_parser.add_argument('--vectors', type=int, default=100000, help="--index: synthetic corpus size without --store")
+    arg_parser.add_argument('--queries', type=int, default=200, help="--index: number of queries")
+    arg_parser.add_argument('--k', type=int, default=10, help="--index / --retrieval: results per query")
+    arg_parser.add_argument('--retrieval', action='store_true',
+                            help="benchmark vector vs BM25 vs hybrid retrieval on the CUAD labels")
+    args = arg_parser.parse_args()
+
+    if args.index:
+        vectors = load_store_vectors(args.store) if args.store else synthetic_vectors(args.vectors)
+        results = run_index_benchmark(vectors, args.queries, args.k)
+        print(format_index_results(results))
+        save_results(results, args.out, "index")
+        return
+    if args.retrieval:
+        results = run_retrieval_benchmark(load_labelled_contracts(args.corpus, args.docs), args.k)
+        print(format_retrieval_results(results))
+        save_results(results, args.out, "retrieval")
+        return
+
+    paths = sample_corpus(args.corpus, args.docs)
+    if not paths:
+        raise SystemExit(f"No .txt contracts found in {args.corpus}")
+    out = args.out
+    if not out:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H%M%S")
+        out = os.path.join(RESULTS_DIR, f"benchmark-{stamp}.json")
+    profile_dir = os.path.splitext(out)[0] + "-profiles" if args.profile or PROFILE else None
+    results = run_benchmark(paths, args.latency, args.prefill_latency, args.skip_embed, profile_dir)
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+    print(format_results(results, baseline))
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {out}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+BM25 keyword index over the vector store's chunks.
+
+Clause lookups hinge on exact legal terms ("indemnify", "hold harmless",
+"terminate for convenience") that sentence embeddings blur, so every chunk
+added to the FAISS store is also indexed here, under the same position, in an
+inverted index kept in SQLite (bm25.db next to the store). Adding a contract
+only inserts its postings; corpus statistics are kept as running totals, so
+nothing is rebuilt. The only exception is a change to tokenize(): an index
+built with another TOKENIZER_VERSION is rebuilt once from docstore.db, since
+its terms would no longer match the queries.
+"""
+import os
+import re
+import math
+import sqlite3
+from collections import Counter
+
+DB_NAME = "bm25.db"
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+
+# Bump whenever tokenize() changes what terms a text produces
+TOKENIZER_VERSION = 2
+TOKEN = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset("""
+a an and are as at be by for from has have in is it its of on or that the this to was were will with
+shall such any all other under upon which may been if not no so than then there these those hereof herein
+""".split())
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    tf INTEGER NOT NULL,
+    PRIMARY KEY (term, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS lengths (
+    position INTEGER PRIMARY KEY,
+    length INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stats (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+def stem(token):
+    # Light suffix stripping so "terminates"/"terminated"/"terminating" share a term
+    for suffix, replacement in (("ies", "y"), ("ied", "y"), ("ing", ""), ("ed", ""), ("es", ""), ("s", "")):
+        if token.endswith(suffix) and len(token) - len(suffix) >= 4:
+            return token[:-len(suffix)] + replacement
+    # "terminate" must meet "terminated" (-> "terminat")
+    return token[:-1] if token.endswith("e") and len(token) >= 5 else token
+
+def tokenize(text):
+    return [stem(token) for token in TOKEN.findall(text.lower()) if token not in STOPWORDS]
+
+def connect(persist_dir):
+    os.makedirs(persist_dir, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(persist_dir, DB_NAME))
+    conn.executescript(_SCHEMA)
+    _check_tokenizer_version(conn, persist_dir)
+    return conn
+
+def _index_rows(texts_by_position):
+    postings, lengths = [], []
+    for position, text in texts_by_position:
+        tokens = tokenize(text)
+        lengths.append((position, len(tokens)))
+        postings.extend((term, position, tf) for term, tf in Counter(tokens).items())
+    return postings, lengths
+
+def _check_tokenizer_version(conn, persist_dir):
+    # Indexes from before the version was recorded (version 1) hold chunks but no version row
+    row = conn.execute("SELECT value FROM stats WHERE key = 'tokenizer_version'").fetchone()
+    if row and row[0] == TOKENIZER_VERSION:
+        return
+    conn.execute("BEGIN IMMEDIATE")  # one process reindexes, the others then see the new version
+    try:
+        row = conn.execute("SELECT value FROM stats WHERE key = 'tokenizer_version'").fetchone()
+        indexed = conn.execute("SELECT COUNT(*) FROM lengths").fetchone()[0]
+        if (row and row[0] == TOKENIZER_VERSION) or (indexed and not reindex(conn, persist_dir)):
+            conn.rollback()
+            return
+        conn.execute("INSERT OR REPLACE INTO stats VALUES ('tokenizer_version', ?)", (TOKENIZER_VERSION,))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+def reindex(conn, persist_dir):
+    """
+    Re-tokenizes every indexed chunk from the store's docstore.db, inside the caller's transaction.
+    Returns:
+        bool: False if there is no docstore.db to read the chunks from.
+    """
+    docstore_path = os.path.join(persist_dir, "docstore.db")
+    if not os.path.exists(docstore_path):
+        return False
+    conn.execute("DELETE FROM postings")
+    conn.execute("DELETE FROM lengths")
+    chunks = tokens = 0
+    source = sqlite3.connect(docstore_path)
+    try:
+        rows = source.execute("SELECT p.position, d.text FROM positions p JOIN documents d ON d.id = p.id "
+                              "ORDER BY p.position")
+        while True:
+            batch = rows.fetchmany(1000)
+            if not batch:
+                break
+            postings, lengths = _index_rows(batch)
+            conn.executemany("INSERT INTO lengths VALUES (?, ?)", lengths)
+            conn.executemany("INSERT INTO postings VALUES (?, ?, ?)", postings)
+            chunks += len(lengths)
+            tokens += sum(length for _, length in lengths)
+    finally:
+        source.close()
+    conn.executemany("INSERT OR REPLACE INTO stats VALUES (?, ?)", [("chunks", chunks), ("tokens", tokens)])
+    return True
+
+def remove_ranges(persist_dir, ranges):
+    """
+    Deletes the postings of the chunks in each [start, end) position range, e.g.
+    of a re-ingested document, and moves later positions down to close the gaps,
+    as removing the vectors does.
+    """
+    conn = connect(persist_dir)
+    with conn:
+        for start, end in sorted(ranges, reverse=True):
+            removed = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(length), 0) FROM lengths WHERE position >= ? AND position < ?",
+                (start, end)).fetchone()
+            for table in ("postings", "lengths"):
+                conn.execute(f"DELETE FROM {table} WHERE position >= ? AND position < ?", (start, end))
+                # Through negative values, so no row collides with one not yet moved
+                conn.execute(f"UPDATE {table} SET position = ? - position WHERE position >= ?", (end - start, end))
+                conn.execute(f"UPDATE {table} SET position = -position WHERE position < 0")
+            for key, delta in (("chunks", -removed[0]), ("tokens", -removed[1])):
+                conn.execute("UPDATE stats SET value = value + ? WHERE key = ?", (delta, key))
+    conn.close()
+
+def add(persist_dir, first_position, texts):
+    """
+    Indexes newly added chunks. A re-ingested document's old chunks must be
+    removed first (remove_ranges), or its terms are counted twice.
+    Args:
+        persist_dir (str): Vector store directory.
+        first_position (int): FAISS position of the first chunk.
+        texts (list): Chunk texts, in insertion order.
+    """
+    postings, lengths = _index_rows(enumerate(texts, first_position))
+    conn = connect(persist_dir)
+    with conn:
+        replaced = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(length), 0) FROM lengths WHERE position >= ? AND position < ?",
+            (first_position, first_position + len(texts))).fetchone()
+        conn.execute("DELETE FROM postings WHERE position >= ? AND position < ?",
+                     (first_position, first_position + len(texts)))
+        conn.executemany("INSERT OR REPLACE INTO lengths VALUES (?, ?)", lengths)
+        conn.executemany("INSERT INTO postings VALUES (?, ?, ?)", postings)
+        for key, delta in (("chunks", len(texts) - replaced[0]),
+                           ("tokens", sum(length for _, length in lengths) - replaced[1])):
+            conn.execute("INSERT INTO stats VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = value + ?",
+                         (key, delta, delta))
+    conn.close()
+
+def search(persist_dir, query, k=10, positions=None):
+    """
+    Ranks chunks by BM25.
+    Args:
+        persist_dir (str): Vector store directory.
+        query (str): Query text.
+        k (int): Number of results.
+        positions (np.ndarray): If given, only these positions are ranked (see metadata_index.resolve).
+    Returns:
+        list: (position, score) pairs, best first.
+    """
+    terms = list(dict.fromkeys(tokenize(query)))
+    if not terms:
+        return []
+    conn = connect(persist_dir)
+    try:
+        stats = dict(conn.execute("SELECT key, value FROM stats").fetchall())
+        chunks, tokens = stats.get("chunks", 0), stats.get("tokens", 0)
+        if not chunks:
+            return []
+        avg_length = tokens / chunks
+        scores = Counter()
+        allowed = set(positions.tolist()) if positions is not None else None
+        for term in terms:
+            rows = conn.execute("SELECT p.position, p.tf, l.length FROM postings p "
+                                "JOIN lengths l ON l.position = p.position WHERE p.term = ?", (term,)).fetchall()
+            if not rows:
+                continue
+            idf = math.log(1 + (chunks - len(rows) + 0.5) / (len(rows) + 0.5))
+            for position, tf, length in rows:
+                if allowed is not None and position not in allowed:
+                    continue
+                scores[position] += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length))
+    finally:
+        conn.close()
+    return [(int(position), score) for position, score in scores.most_common(k)]
@@ -0,0 +1,110 @@
+"""
+Local clause extractor backed by a trained CUAD span model.
+
+Point the agent at it with CLAUSE_EXTRACTOR=cuad_extractor:extract_clauses and
+CUAD_MODEL at a checkpoint trained with uploads/cuad-main/train.py (or one of
+the released CUAD checkpoints). Every requested category is asked as its CUAD
+question over the doc_stride windows of the contract, the model runs on CPU
+(int8-quantized by default, length-bucketed, see infer_cpu.py) and the answers
+are the n-best lists of compute_predictions_logits, whose probabilities the
+agent uses as confidence.
+"""
+import os
+import sys
+import tempfile
+from types import SimpleNamespace
+
+CUAD_DIR = os.getenv("CUAD_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads', 'cuad-main'))
+CUAD_MODEL = os.getenv("CUAD_MODEL", "")
+CUAD_QUANTIZE = os.getenv("CUAD_QUANTIZE", "1") == "1"
+# Tokenization must match training (see uploads/cuad-main/run.sh)
+CUAD_MAX_SEQ_LENGTH = int(os.getenv("CUAD_MAX_SEQ_LENGTH", "512"))
+CUAD_DOC_STRIDE = int(os.getenv("CUAD_DOC_STRIDE", "256"))
+CUAD_MAX_QUERY_LENGTH = int(os.getenv("CUAD_MAX_QUERY_LENGTH", "64"))
+CUAD_MAX_ANSWER_LENGTH = int(os.getenv("CUAD_MAX_ANSWER_LENGTH", "512"))
+CUAD_N_BEST = int(os.getenv("CUAD_N_BEST", "20"))
+CUAD_BATCH_SIZE = int(os.getenv("CUAD_BATCH_SIZE", "16"))
+# Fraction of each category's windows scored by the model (prefilter.py); 1 scores all
+CUAD_PREFILTER_KEEP = float(os.getenv("CUAD_PREFILTER_KEEP", "1.0"))
+CUAD_QUESTION = 'Highlight the parts (if any) of this contract related to "{category}" that should be reviewed by a lawyer. Details: {description}'
+CONTRACT_TITLE = "contract"
+
+_model = None
+
+def _import_cuad():
+    # The CUAD scripts are flat modules in CUAD_DIR
+    if CUAD_DIR not in sys.path:
+        sys.path.insert(0, CUAD_DIR)
+
+def get_model():
+    """Loads the tokenizer and the (quantized) CUAD model once."""
+    global _model
+    if _model is None:
+        if not CUAD_MODEL:
+            raise RuntimeError("Set CUAD_MODEL to a trained CUAD checkpoint to use the CUAD clause extractor")
+        _import_cuad()
+        from infer_cpu import load_model
+        args = SimpleNamespace(model_name_or_path=CUAD_MODEL, tokenizer_name="", do_lower_case=False,
+                               cache_dir="", quantize=CUAD_QUANTIZE)
+        tokenizer, model = load_model(args)
+        _model = (args, tokenizer, model)
+    return _model
+
+def build_examples(text, categories):
+    """
+    One CUAD question per category over the contract text.
+    Args:
+        text (str): The contract text.
+        categories (list): CUAD category names.
+    Returns:
+        list: SquadExample objects whose qas_id is "contract__<category>".
+    """
+    _import_cuad()
+    from evaluate import get_questions_from_csv
+    from transformers.data.processors.squad import SquadExample
+    descriptions = {name.lower(): description for name, description in get_questions_from_csv().items()}
+    return [SquadExample(qas_id=f"{CONTRACT_TITLE}__{category}",
+                         question_text=CUAD_QUESTION.format(category=category,
+                                                            description=descriptions.get(category.lower(), "").strip()),
+                         context_text=text, answer_text=None, start_position_character=None,
+                         title=CONTRACT_TITLE, answers=[])
+            for category in categories]
+
+def extract_clauses(text, clause_names):
+    """
+    CLAUSE_EXTRACTOR entry point.
+    Args:
+        text (str): The contract text.
+        clause_names (list): CUAD category names.
+    Returns:
+        dict: {category: n-best list of {"text", "probability", ...}}; an empty text means no such clause.
+    """
+    if not clause_names or not text.strip():
+        return {}
+    args, tokenizer, model = get_model()
+    from transformers import squad_convert_examples_to_features
+    from evaluate import iter_json
+    from infer_cpu import predict_logits
+    from prefilter import get_feature_examples, get_window_scores, select_features
+    from utils import compute_predictions_logits
+
+    examples = build_examples(text, clause_names)
+    features, dataset = squad_convert_examples_to_features(
+        examples=examples, tokenizer=tokenizer, max_seq_length=CUAD_MAX_SEQ_LENGTH, doc_stride=CUAD_DOC_STRIDE,
+        max_query_length=CUAD_MAX_QUERY_LENGTH, is_training=False, return_dataset="pt", threads=1,
+        tqdm_enabled=False)
+    feature_indices = list(range(len(features)))
+    if CUAD_PREFILTER_KEEP < 1:
+        scores = get_window_scores(examples, features)
+        feature_indices = select_features(get_feature_examples(features), scores, CUAD_PREFILTER_KEEP).tolist()
+    predict_args = SimpleNamespace(max_seq_length=CUAD_MAX_SEQ_LENGTH, batch_size=CUAD_BATCH_SIZE,
+                                   model_type=args.model_type)
+    all_results = predict_logits(predict_args, model, dataset, feature_indices)
+
+    json_input_dict = {"data": [{"title": CONTRACT_TITLE, "paragraphs": [{"context": text}]}]}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        nbest_file = os.path.join(tmp_dir, "nbest_predictions.json")
+        compute_predictions_logits(
+            json_input_dict, examples, [features[i] for i in feature_indices], all_results, CUAD_N_BEST,
+            CUAD_MAX_ANSWER_LENGTH, False, None, nbest_file, None, False, True, 0.0, tokenizer)
+        return {qas_id.split("__", 1)[1]: nbest for qas_id, nbest in iter_json(nbest_file)}
@@ -0,0 +1,136 @@
+"""
+SQLite-backed docstore for the FAISS vector store.
+
+LangChain's FAISS.save_local pickles the whole docstore (every chunk's text and
+metadata) plus the position -> id mapping into index.pkl, which load_local has
+to unpickle into each process. SQLiteDocstore and SQLiteIdMap keep both in
+docstore.db instead and fetch rows on demand, so loading a store reads nothing
+up front, only the returned chunks are ever read, and processes on one node
+share the database pages through the OS cache.
+"""
+import os
+import json
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+
+from langchain_community.docstore.base import AddableMixin, Docstore
+from langchain_core.documents import Document
+
+DB_NAME = "docstore.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id TEXT PRIMARY KEY,
+    text TEXT NOT NULL,
+    metadata TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS positions (
+    position INTEGER PRIMARY KEY,
+    id TEXT NOT NULL
+);
+"""
+
+class _Database:
+    """One connection per store, shared across threads behind a lock."""
+    def __init__(self, persist_dir):
+        os.makedirs(persist_dir, exist_ok=True)
+        self.path = os.path.join(persist_dir, DB_NAME)
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")  # readers don't block the watcher's writes
+        self.conn.executescript(_SCHEMA)
+        self.lock = threading.Lock()
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def write(self, sql, rows):
+        with self.lock, self.conn:
+            self.conn.executemany(sql, rows)
+
+class SQLiteDocstore(Docstore, AddableMixin):
+    """Docstore whose Documents live in SQLite and are read only when searched for."""
+    def __init__(self, database):
+        self.db = database
+
+    def add(self, texts):
+        """Adds {id: Document} entries; ids must be new, as with InMemoryDocstore."""
+        ids = list(texts)
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            found = self.db.query(f"SELECT id FROM documents WHERE id IN ({', '.join('?' * len(batch))})", batch)
+            if found:
+                raise ValueError(f"Tried to add ids that already exist: {[row[0] for row in found]}")
+        self.db.write("INSERT INTO documents VALUES (?, ?, ?)",
+                      [(id_, doc.page_content, json.dumps(doc.metadata)) for id_, doc in texts.items()])
+
+    def delete(self, ids):
+        self.db.write("DELETE FROM documents WHERE id = ?", [(id_,) for id_ in ids])
+
+    def search(self, search):
+        rows = self.db.query("SELECT text, metadata FROM documents WHERE id = ?", (search,))
+        if not rows:
+            return f"ID {search} not found."
+        text, metadata = rows[0]
+        return Document(id=search, page_content=text, metadata=json.loads(metadata))
+
+class SQLiteIdMap(MutableMapping):
+    """FAISS position -> docstore id mapping (LangChain's index_to_docstore_id) in SQLite."""
+    def __init__(self, database):
+        self.db = database
+
+    def __getitem__(self, position):
+        rows = self.db.query("SELECT id FROM positions WHERE position = ?", (int(position),))
+        if not rows:
+            raise KeyError(position)
+        return rows[0][0]
+
+    def __setitem__(self, position, id_):
+        self.update({position: id_})
+
+    def __delitem__(self, position):
+        self.db.write("DELETE FROM positions WHERE position = ?", [(int(position),)])
+
+    def update(self, other=(), **kwargs):
+        items = other.items() if hasattr(other, "items") else other
+        self.db.write("INSERT OR REPLACE INTO positions VALUES (?, ?)", [(int(p), id_) for p, id_ in items])
+
+    def __iter__(self):
+        return iter([row[0] for row in self.db.query("SELECT position FROM positions ORDER BY position")])
+
+    def __len__(self):
+        return self.db.query("SELECT COUNT(*) FROM positions")[0][0]
+
+    def truncate(self, size):
+        """Drops positions >= size, e.g. left over from a write that never reached the index file."""
+        self.db.write("DELETE FROM positions WHERE position >= ?", [(int(size),)])
+
+    def remove_ranges(self, ranges):
+        """
+        Deletes the positions in each [start, end) range together with their documents,
+        and moves later positions down to close the gaps, as removing the vectors does.
+        """
+        with self.db.lock, self.db.conn as conn:
+            for start, end in sorted(ranges, reverse=True):
+                conn.execute("DELETE FROM documents WHERE id IN "
+                             "(SELECT id FROM positions WHERE position >= ? AND position < ?)", (start, end))
+                conn.execute("DELETE FROM positions WHERE position >= ? AND position < ?", (start, end))
+                # Through negative values, so no row collides with one not yet moved
+                conn.execute("UPDATE positions SET position = ? - position WHERE position >= ?", (end - start, end))
+                conn.execute("UPDATE positions SET position = -position WHERE position < 0")
+
+def open_stores(persist_dir):
+    """Returns (SQLiteDocstore, SQLiteIdMap) for a vector store directory."""
+    database = _Database(persist_dir)
+    return SQLiteDocstore(database), SQLiteIdMap(database)
+
+def exists(persist_dir):
+    return os.path.exists(os.path.join(persist_dir, DB_NAME))
+
+def migrate(persist_dir, docstore, index_to_docstore_id):
+    """Copies a pickled (InMemoryDocstore, dict) pair into docstore.db."""
+    store, id_map = open_stores(persist_dir)
+    store.add({id_: docstore.search(id_) for id_ in index_to_docstore_id.values()})
+    id_map.update(index_to_docstore_id)
+    return store, id_map
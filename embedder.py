@@ -1,45 +1,394 @@
+"""
+Chunking and embedding of contract text into a vector DB (FAISS or Chroma).
+
+Chunks are sized by the embedding model's own tokenizer: sentences are packed
+until the next one would exceed the model's max_seq_length (256 wordpieces for
+all-MiniLM-L6-v2), so no chunk is silently truncated by the encoder and short
+chunks don't waste encode slots. Consecutive chunks overlap by
+CHUNK_OVERLAP_SENTENCES only when a chunk boundary falls inside a section;
+a boundary that coincides with a section break needs no overlap.
+
+New chunks are appended to the FAISS store in persist_dir (replacing any
+chunks already stored for the same contract), whose index type
+(flat, HNSW, IVF-Flat or IVF-PQ) is chosen with FAISS_INDEX_TYPE; see
+vector_index.py. Chunk positions and the analysis fields of their contract are
+recorded in metadata_index.py, so search() can restrict a query to a contract,
+a contract type, a date range or a clause category.
+
+The FAISS index is written with faiss.write_index and, by default, loaded
+memory-mapped (VECTORSTORE_MMAP), so processes on a node share its pages and
+loading is near-instant; chunk texts live in SQLite (docstore.py) instead of
+the pickled index.pkl and are fetched only for search results.
+
+The index, docstore.db, metadata.db and bm25.db share vector positions. Every
+write to them (add_to_faiss, reindex, and the watcher's tagging) holds the
+store's write lock, a file lock that the watcher and UI processes share.
+"""
 import os
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import re
+import fcntl
+import itertools
+from contextlib import contextmanager
+from functools import lru_cache
+import faiss
+import numpy as np
 from langchain_huggingface import HuggingFaceEmbeddings  # Updated import
 from langchain_community.vectorstores import FAISS, Chroma
+import telemetry
+from telemetry import span
+import vector_index
+import metadata_index
+import docstore
+import bm25
 
-def chunk_and_embed(text, doc_id, persist_dir="data/vectorstore", db_type="faiss"):
+VECTORSTORE_DIR = os.getenv("VECTORSTORE_DIR", "data/vectorstore")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+# Sentences repeated at the start of a chunk that continues the previous chunk's section
+CHUNK_OVERLAP_SENTENCES = int(os.getenv("CHUNK_OVERLAP_SENTENCES", "1"))
+SECTION_BREAK = re.compile(r"\n[ \t]*\n\s*")
+SENTENCE_END = re.compile(r"(?<=[.;:!?])\s+(?=[\"'(\[]?[A-Z0-9])")
+# Memory-map the FAISS index read-only when loading the store for search
+VECTORSTORE_MMAP = os.getenv("VECTORSTORE_MMAP", "1").lower() in ("1", "true", "yes")
+# Filtered searches over at most this many vectors compare them directly
+FILTER_BRUTE_FORCE_MAX = int(os.getenv("FILTER_BRUTE_FORCE_MAX", "20000"))
+
+@lru_cache(maxsize=None)
+def get_embeddings(model_name=EMBEDDING_MODEL):
+    """Embedding model, loaded once per process."""
+    return HuggingFaceEmbeddings(model_name=model_name)  # Local, no API needed
+
+def get_token_counter(embeddings):
     """
-    Splits text into chunks, embeds them, and stores in a vector DB (FAISS or Chroma).
+    Returns (count_tokens, max_tokens) for a sentence-transformers embedding model.
+    count_tokens takes a list of strings and returns their wordpiece counts in one
+    batched tokenizer call; max_tokens leaves room for the [CLS]/[SEP] tokens.
+    """
+    model = getattr(embeddings, "_client", None) or embeddings.client
+    tokenizer = model.tokenizer
+
+    def count_tokens(texts):
+        if not texts:
+            return []
+        return [len(ids) for ids in tokenizer(list(texts), add_special_tokens=False)["input_ids"]]
+
+    return count_tokens, model.max_seq_length - 2
+
+def _spans(pattern, text, start, end):
+    # (start, end) of the non-empty pieces of text[start:end] between pattern matches
+    pieces, pos = [], start
+    for match in pattern.finditer(text, start, end):
+        if match.start() > pos:
+            pieces.append((pos, match.start()))
+        pos = match.end()
+    if pos < end:
+        pieces.append((pos, end))
+    return pieces
+
+def _split_long(text, start, end, count_tokens, max_tokens):
+    # Hard-splits a sentence longer than the model limit at word boundaries
+    words = [m.span() for m in re.finditer(r"\S+", text[start:end])]
+    counts = count_tokens([text[start + s:start + e] for s, e in words])
+    pieces, piece_start, piece_tokens = [], None, 0
+    for (s, e), tokens in zip(words, counts):
+        if piece_start is not None and piece_tokens + tokens > max_tokens:
+            pieces.append((start + piece_start, start + last_end, piece_tokens))
+            piece_start, piece_tokens = None, 0
+        if piece_start is None:
+            piece_start = s
+        piece_tokens += tokens
+        last_end = e
+    if piece_start is not None:
+        pieces.append((start + piece_start, start + last_end, piece_tokens))
+    return pieces
+
+def chunk_by_tokens(text, count_tokens, max_tokens, overlap=CHUNK_OVERLAP_SENTENCES):
+    """
+    Packs sentences into chunks of at most max_tokens model tokens.
+    Args:
+        text (str): The text to chunk.
+        count_tokens (callable): list of strings -> list of token counts.
+        max_tokens (int): Token budget per chunk.
+        overlap (int): Sentences carried over when a chunk continues a section.
+    Returns:
+        tuple: ([(start, end, tokens)] character offsets and token count per chunk,
+            stats dict with chunks, sentences, split_sentences, avg_tokens, fill,
+            truncated_chunks and truncated_tokens).
+    """
+    units = []  # (start, end, section index)
+    for section, (s_start, s_end) in enumerate(_spans(SECTION_BREAK, text, 0, len(text))):
+        units.extend((start, end, section) for start, end in _spans(SENTENCE_END, text, s_start, s_end))
+    counts = count_tokens([text[start:end] for start, end, _ in units])
+
+    sentences, split_sentences = [], 0
+    for (start, end, section), tokens in zip(units, counts):
+        if tokens > max_tokens:
+            split_sentences += 1
+            sentences.extend((s, e, section, t) for s, e, t in _split_long(text, start, end, count_tokens, max_tokens))
+        else:
+            sentences.append((start, end, section, tokens))
+
+    chunks, current = [], []
+    for sentence in sentences:
+        if current and sum(s[3] for s in current) + sentence[3] > max_tokens:
+            chunks.append(current)
+            carried = current[-overlap:] if overlap and current[-1][2] == sentence[2] else []
+            while carried and sum(s[3] for s in carried) + sentence[3] > max_tokens:
+                carried = carried[1:]
+            current = list(carried)
+        current.append(sentence)
+    if current:
+        chunks.append(current)
+    chunks = [(c[0][0], c[-1][1], sum(s[3] for s in c)) for c in chunks]
+
+    # Token counts of joined sentences can differ slightly from their sum; measure the real chunks
+    actual = count_tokens([text[start:end] for start, end, _ in chunks])
+    chunks = [(start, end, tokens) for (start, end, _), tokens in zip(chunks, actual)]
+    truncated = [tokens - max_tokens for tokens in actual if tokens > max_tokens]
+    avg_tokens = sum(actual) / len(actual) if actual else 0.0
+    stats = {
+        "chunks": len(chunks),
+        "sentences": len(units),
+        "split_sentences": split_sentences,
+        "avg_tokens": round(avg_tokens, 1),
+        "fill": round(avg_tokens / max_tokens, 3) if max_tokens else 0.0,
+        "truncated_chunks": len(truncated),
+        "truncated_tokens": sum(truncated),
+    }
+    return chunks, stats
+
+@contextmanager
+def store_lock(persist_dir=VECTORSTORE_DIR):
+    """Holds the write lock of the store in persist_dir, across threads and processes."""
+    os.makedirs(persist_dir, exist_ok=True)
+    with open(os.path.join(persist_dir, "write.lock"), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _ranges(positions):
+    # Consecutive runs of sorted positions as [start, end) ranges
+    return [(group[0][1], group[-1][1] + 1) for group in
+            (list(g) for _, g in itertools.groupby(enumerate(positions), lambda x: x[1] - x[0]))]
+
+def remove_documents(db, persist_dir, doc_ids):
+    """
+    Removes the stored chunks of doc_ids from the index, docstore.db, metadata.db
+    and bm25.db, moving later positions down in all four. Call under store_lock.
+    Returns:
+        int: Number of chunks removed.
+    """
+    positions = sorted(p for doc_id in doc_ids for p in metadata_index.document_positions(persist_dir, doc_id)
+                       if p < db.index.ntotal)
+    if not positions:
+        return 0
+    ranges = _ranges(positions)
+    db.index_to_docstore_id.remove_ranges(ranges)
+    metadata_index.remove_ranges(persist_dir, ranges)
+    bm25.remove_ranges(persist_dir, ranges)
+    db.index = vector_index.remove_positions(db.index, positions)
+    return len(positions)
+
+def add_to_faiss(persist_dir, texts, embeddings, metadatas, index_type=None):
+    """
+    Embeds texts and writes them to the store in persist_dir, creating it if needed:
+    the vectors and texts are appended to the FAISS index and docstore.db, and each
+    chunk is recorded in metadata.db and bm25.db under the same position. Chunks
+    already stored for a doc_id in metadatas are removed first, so re-ingesting a
+    contract replaces it. Everything after embedding holds store_lock, so concurrent
+    writers cannot drop each other's vectors.
+    A flat store is converted to the configured index type once it is large
+    enough to train (see vector_index.should_convert).
+    Args:
+        metadatas (list): Per chunk {"doc_id", "start", "end"}, as chunk_and_embed builds them.
+    Returns:
+        FAISS vector store.
+    """
+    vectors = embeddings.embed_documents(texts)
+    with store_lock(persist_dir):
+        if os.path.exists(os.path.join(persist_dir, "index.faiss")):
+            db = load_vectorstore(persist_dir, mmap=False)
+        else:
+            db = FAISS(embeddings, faiss.IndexFlatL2(len(vectors[0])), *docstore.open_stores(persist_dir))
+        if not isinstance(db.docstore, docstore.SQLiteDocstore):
+            db.docstore, db.index_to_docstore_id = docstore.migrate(persist_dir, db.docstore, db.index_to_docstore_id)
+        db.index_to_docstore_id.truncate(db.index.ntotal)
+        remove_documents(db, persist_dir, {metadata["doc_id"] for metadata in metadatas})
+        first_position = db.index.ntotal
+        db.add_embeddings(list(zip(texts, vectors)), metadatas=metadatas)
+        if vector_index.should_convert(db.index, index_type):
+            with span("index_convert", index=index_type or vector_index.FAISS_INDEX_TYPE):
+                db.index = vector_index.convert_index(db.index, index_type)
+        save_faiss(db, persist_dir)
+        position = first_position
+        for doc_id, group in itertools.groupby(metadatas, key=lambda metadata: metadata["doc_id"]):
+            spans = [(metadata.get("start"), metadata.get("end")) for metadata in group]
+            metadata_index.record_chunks(persist_dir, doc_id, position, spans)
+            position += len(spans)
+        bm25.add(persist_dir, first_position, texts)
+    return db
+
+def save_faiss(db, persist_dir):
+    """
+    Saves a FAISS store: the index file is replaced atomically (processes that
+    memory-mapped the old file keep a consistent view) and a legacy pickled
+    docstore is migrated to SQLite.
+    """
+    if not isinstance(db.docstore, docstore.SQLiteDocstore):
+        db.docstore, db.index_to_docstore_id = docstore.migrate(persist_dir, db.docstore, db.index_to_docstore_id)
+    path = os.path.join(persist_dir, "index.faiss")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    faiss.write_index(db.index, tmp_path)
+    os.replace(tmp_path, path)
+    legacy_path = os.path.join(persist_dir, "index.pkl")
+    if os.path.exists(legacy_path):
+        os.remove(legacy_path)
+
+def read_index(path, mmap=VECTORSTORE_MMAP):
+    """Reads a FAISS index, memory-mapped read-only if requested and supported."""
+    if mmap:
+        try:
+            return faiss.read_index(path, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError as e:
+            print(f"Memory-mapping {path} failed ({e}); loading it into memory.")
+    return faiss.read_index(path)
+
+def reindex(persist_dir=VECTORSTORE_DIR, index_type=None):
+    """Rebuilds the FAISS store's index as index_type, retraining IVF lists for the current corpus size."""
+    with store_lock(persist_dir):
+        db = load_vectorstore(persist_dir, mmap=False)
+        db.index = vector_index.convert_index(db.index, index_type)
+        save_faiss(db, persist_dir)
+    return db
+
+def chunk_and_embed(text, doc_id, persist_dir=VECTORSTORE_DIR, db_type="faiss"):
+    """
+    Splits text into token-sized chunks, embeds them, and stores in a vector DB (FAISS or Chroma).
     Args:
         text (str): The contract text to embed.
         doc_id (str): Unique identifier for the document.
         persist_dir (str): Directory to store the vector DB.
         db_type (str): 'faiss' or 'chroma'.
+    Returns:
+        dict: Chunking statistics (see chunk_by_tokens).
     """
-    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    chunks = splitter.split_text(text)
-    embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")  # Local, no API needed
+    if db_type not in ("faiss", "chroma"):
+        raise ValueError("db_type must be 'faiss' or 'chroma'")
+    embeddings = get_embeddings()
+    with span("chunk"):
+        count_tokens, max_tokens = get_token_counter(embeddings)
+        spans, stats = chunk_by_tokens(text, count_tokens, max_tokens)
+    chunks = [text[start:end] for start, end, _ in spans]
+    metadatas = [{"doc_id": doc_id, "start": start, "end": end} for start, end, _ in spans]
     if not os.path.exists(persist_dir):
         os.makedirs(persist_dir)
-    if db_type == "faiss":
-        db = FAISS.from_texts(chunks, embeddings, metadatas=[{"doc_id": doc_id}] * len(chunks))
-        db.save_local(persist_dir)
-    elif db_type == "chroma":
-        db = Chroma.from_texts(chunks, embeddings, metadatas=[{"doc_id": doc_id}] * len(chunks), persist_directory=persist_dir)
-        db.persist()
+    with span("embed", db=db_type):
+        if db_type == "faiss":
+            add_to_faiss(persist_dir, chunks, embeddings, metadatas)
+        else:
+            db = Chroma.from_texts(chunks, embeddings, metadatas=metadatas, persist_directory=persist_dir)
+            db.persist()
+    telemetry.inc("chunks_embedded", len(chunks))
+    telemetry.inc("chunks_truncated", stats["truncated_chunks"])
+    print(f"Stored {len(chunks)} chunks for {doc_id} in {db_type} vector DB "
+          f"(avg {stats['avg_tokens']}/{max_tokens} tokens, {stats['split_sentences']} long sentences split, "
+          f"{stats['truncated_chunks']} chunks truncated).")
+    return stats
+
+def _gather_search(index, query, positions, k):
+    # Exact distances over just the filtered vectors
+    if vector_index.index_type_of(index).startswith("ivf"):
+        faiss.extract_index_ivf(index).make_direct_map()
+    vectors = index.reconstruct_batch(positions)
+    distances = ((vectors - query) ** 2).sum(axis=1)
+    top = np.argsort(distances)[:k]
+    return positions[top], distances[top]
+
+def _selector_search(index, query, positions, k):
+    # Let FAISS skip every vector outside the filter during its normal search
+    selector = faiss.IDSelectorBatch(positions)
+    kind = vector_index.index_type_of(index)
+    if kind.startswith("ivf"):
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=faiss.extract_index_ivf(index).nprobe)
+    elif kind == "hnsw":
+        params = faiss.SearchParametersHNSW(sel=selector, efSearch=faiss.downcast_index(index).hnsw.efSearch)
     else:
-        raise ValueError("db_type must be 'faiss' or 'chroma'")
-    print(f"Stored {len(chunks)} chunks for {doc_id} in {db_type} vector DB.")
+        params = faiss.SearchParameters(sel=selector)
+    distances, found = index.search(query[None, :], k, params=params)
+    keep = found[0] >= 0
+    return found[0][keep], distances[0][keep]
+
+def search_positions(db, query_vector, k=4, positions=None):
+    """
+    Nearest vector positions to a query vector.
+    Args:
+        db (FAISS): Loaded store.
+        query_vector (np.ndarray): float32 query embedding.
+        k (int): Number of results.
+        positions (np.ndarray): If given, only these positions are searched (see metadata_index.resolve).
+    Returns:
+        list: (position, distance) pairs, nearest first.
+    """
+    if positions is None:
+        distances, found = db.index.search(query_vector[None, :], k)
+        found, distances = found[0], distances[0]
+    else:
+        positions = positions[positions < db.index.ntotal]
+        if not len(positions):
+            return []
+        with span("filtered_search", mode="gather" if len(positions) <= FILTER_BRUTE_FORCE_MAX else "selector"):
+            if len(positions) <= FILTER_BRUTE_FORCE_MAX:
+                found, distances = _gather_search(db.index, query_vector, positions, k)
+            else:
+                found, distances = _selector_search(db.index, query_vector, positions, k)
+    return [(int(position), float(distance)) for position, distance in zip(found, distances) if position >= 0]
 
-def load_vectorstore(persist_dir="data/vectorstore", db_type="faiss"):
+def get_documents(db, positions):
+    """Fetches the stored chunks at the given vector positions."""
+    return [db.docstore.search(db.index_to_docstore_id[int(position)]) for position in positions]
+
+def search(query, k=4, filters=None, persist_dir=VECTORSTORE_DIR, db=None):
+    """
+    Similarity search over the FAISS store, optionally restricted by metadata.
+    Args:
+        query (str): Query text.
+        k (int): Number of chunks to return.
+        filters (dict): e.g. {"doc_id": ..., "contract_type": ["MSA", "SLA"],
+            "clause": "Termination", "date_from": "2024-01-01"}; see metadata_index.resolve.
+        persist_dir (str): Directory of the vector store.
+        db (FAISS): An already loaded store, to avoid reloading it per query.
+    Returns:
+        list: (Document, distance) pairs, nearest first.
+    """
+    db = db or load_vectorstore(persist_dir)
+    positions = metadata_index.resolve(persist_dir, filters) if filters else None
+    query_vector = np.asarray(db.embeddings.embed_query(query), dtype="float32")
+    hits = search_positions(db, query_vector, k, positions)
+    return list(zip(get_documents(db, [p for p, _ in hits]), [d for _, d in hits]))
+
+def load_vectorstore(persist_dir=VECTORSTORE_DIR, db_type="faiss", mmap=VECTORSTORE_MMAP):
     """
     Loads the vector store for querying.
     Args:
         persist_dir (str): Directory where the vector DB is stored.
         db_type (str): 'faiss' or 'chroma'.
+        mmap (bool): Memory-map the FAISS index read-only instead of reading it into RAM.
     Returns:
         VectorStore instance.
     """
-    embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+    embeddings = get_embeddings()
     if db_type == "faiss":
-        return FAISS.load_local(persist_dir, embeddings)
+        if not docstore.exists(persist_dir) and os.path.exists(os.path.join(persist_dir, "index.pkl")):
+            # Store saved before the SQLite docstore; migrated on its next save.
+            # The pickle is written by this module only.
+            db = FAISS.load_local(persist_dir, embeddings, allow_dangerous_deserialization=True)
+        else:
+            index = read_index(os.path.join(persist_dir, "index.faiss"), mmap)
+            db = FAISS(embeddings, index, *docstore.open_stores(persist_dir))
+        vector_index.configure_search(db.index)
+        return db
     elif db_type == "chroma":
         return Chroma(persist_directory=persist_dir, embedding_function=embeddings)
     else:
-        raise ValueError("db_type must be 'faiss' or 'chroma'")
\ No newline at end of file
+        raise ValueError("db_type must be 'faiss' or 'chroma'")
@@ -0,0 +1,186 @@
+"""
+Deterministic fake LLM HTTP server for local testing.
+
+Speaks enough of the Ollama (/api/generate), OpenAI (/v1/completions) and
+Anthropic (/v1/messages) wire formats for llm.py, streamed or not, answers
+each prompt with a canned reply chosen from its wording, and can inject
+latency and retryable errors. The Ollama endpoint mimics a single-slot KV cache: only the part of
+a prompt after the prefix it shares with the previous prompt counts as
+evaluated (and pays --prefill-latency per word), as reported in
+prompt_eval_count/prompt_eval_duration.
+Point a provider at it with e.g. OLLAMA_BASE_URL=http://127.0.0.1:11435.
+
+Usage:
+    python fake_llm.py --port 11435 --latency 0.2 --error-rate 0.1
+"""
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def fake_completion(prompt):
+    """Canned reply shaped like what the agent prompts expect."""
+    if "Classify this contract" in prompt:
+        return "Other"
+    if "Rate the" in prompt:
+        return "Medium risk. The clause is standard but leaves some obligations open-ended."
+    if "Summarize" in prompt:
+        return "This agreement sets out the parties' obligations, payment terms and termination rights."
+    words = prompt.split()
+    return " ".join(words[-40:]) if words else ""
+
+def _pieces(text):
+    # Word-sized stream chunks, trailing whitespace kept so they join back losslessly
+    return re.findall(r"\S+\s*", text)
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        with server.lock:
+            server.request_count += 1
+            fail = server.rng.random() < server.error_rate
+        if server.latency:
+            time.sleep(server.latency)
+        if fail:
+            return self._send(503, {"error": "fake overload"})
+        stream = payload.get("stream", False)
+        if self.path == "/api/generate":
+            prompt = payload.get("prompt", "")
+            reply = fake_completion(prompt)
+            evaluated = server.evaluate_prompt(prompt)
+            timings = {"done": True, "prompt_eval_count": evaluated, "eval_count": len(reply.split()),
+                       "prompt_eval_duration": int(evaluated * server.prefill_latency * 1e9)}
+            if stream:
+                lines = [json.dumps({"response": piece, "done": False}) + "\n" for piece in _pieces(reply)]
+                return self._stream("application/x-ndjson", lines + [json.dumps({"response": "", **timings}) + "\n"])
+            return self._send(200, {"model": payload.get("model"), "response": reply, **timings})
+        if self.path == "/v1/completions":
+            prompt = payload.get("prompt", "")
+            reply = fake_completion(prompt)
+            usage = {"prompt_tokens": len(prompt.split()), "completion_tokens": len(reply.split())}
+            if stream:
+                events = [f"data: {json.dumps({'choices': [{'text': piece, 'index': 0}]})}\n\n" for piece in _pieces(reply)]
+                events.append(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n")
+                return self._stream("text/event-stream", events + ["data: [DONE]\n\n"])
+            return self._send(200, {"choices": [{"text": reply, "index": 0}], "usage": usage})
+        if self.path == "/v1/messages":
+            prompt = "".join(m.get("content", "") for m in payload.get("messages", []))
+            reply = fake_completion(prompt)
+            usage = {"input_tokens": len(prompt.split()), "output_tokens": len(reply.split())}
+            if stream:
+                start = {"type": "message_start", "message": {"usage": {"input_tokens": usage["input_tokens"]}}}
+                events = [f"event: message_start\ndata: {json.dumps(start)}\n\n"]
+                events += [f"event: content_block_delta\ndata: "
+                           f"{json.dumps({'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': piece}})}\n\n"
+                           for piece in _pieces(reply)]
+                end = {"type": "message_delta", "usage": {"output_tokens": usage["output_tokens"]}}
+                events.append(f"event: message_delta\ndata: {json.dumps(end)}\n\n")
+                return self._stream("text/event-stream", events + ['event: message_stop\ndata: {"type": "message_stop"}\n\n'])
+            return self._send(200, {"content": [{"type": "text", "text": reply}], "usage": usage})
+        self._send(404, {"error": f"unknown path {self.path}"})
+
+    def _stream(self, content_type, chunks):
+        # No Content-Length: the body ends when the connection closes
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for chunk in chunks:
+            self.wfile.write(chunk.encode())
+            self.wfile.flush()
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class FakeLLMServer(ThreadingHTTPServer):
+    """
+    Fake LLM server running in a background thread.
+    Args:
+        port (int): Port to bind on 127.0.0.1; 0 picks a free port.
+        latency (float): Seconds to wait before answering each request.
+        error_rate (float): Fraction of requests answered with HTTP 503.
+        seed (int): Seed for the error injection.
+        prefill_latency (float): Seconds per evaluated (non-cached) prompt word on /api/generate.
+    Usage:
+        with FakeLLMServer(latency=0.05) as server:
+            os.environ["OLLAMA_BASE_URL"] = server.url
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, error_rate=0.0, seed=0, prefill_latency=0.0):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.prefill_latency = prefill_latency
+        self._cached_words = []
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self._thread = None
+
+    def evaluate_prompt(self, prompt):
+        """Returns how many prompt words miss the cache, sleeping for their prefill time."""
+        words = prompt.split()
+        with self.lock:
+            cached = 0
+            for word, cached_word in zip(words, self._cached_words):
+                if word != cached_word:
+                    break
+                cached += 1
+            self._cached_words = words
+        evaluated = len(words) - cached
+        if self.prefill_latency:
+            time.sleep(evaluated * self.prefill_latency)
+        return evaluated
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Deterministic fake LLM server.")
+    arg_parser.add_argument('--port', type=int, default=11435)
+    arg_parser.add_argument('--latency', type=float, default=0.0, help="seconds per request")
+    arg_parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of requests failing with 503")
+    arg_parser.add_argument('--prefill-latency', type=float, default=0.0, help="seconds per uncached prompt word (Ollama)")
+    args = arg_parser.parse_args()
+    server = FakeLLMServer(args.port, args.latency, args.error_rate, prefill_latency=args.prefill_latency)
+    print(f"Fake LLM listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
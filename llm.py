@@ -0,0 +1,373 @@
+"""
+LLM client layer for Ollama, OpenAI and Anthropic.
+
+Each client owns a pooled HTTP session and applies connect/read timeouts,
+jittered exponential retries on 429/5xx and connection errors, and a circuit
+breaker that fails fast while a provider is down. Clients are cached per
+provider configuration by get_client(), so several providers (or several
+models of one provider) can be used side by side in one process.
+
+Endpoints can be redirected, e.g. to fake_llm.py, with OLLAMA_BASE_URL,
+OPENAI_BASE_URL and ANTHROPIC_BASE_URL.
+"""
+import os
+import json
+import time
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+import telemetry
+
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "300"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF = float(os.getenv("LLM_BACKOFF", "0.5"))          # first retry delay cap, seconds
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "30"))
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "10"))        # keep-alive connections per client
+LLM_CIRCUIT_FAILURES = int(os.getenv("LLM_CIRCUIT_FAILURES", "5"))
+LLM_CIRCUIT_RESET = float(os.getenv("LLM_CIRCUIT_RESET", "30"))
+# Keep the Ollama model (and its KV cache) loaded between calls
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+# Fixed context size for Ollama; must hold a whole contract, or the prompt is truncated
+# from the front and nothing can be reused. Changing it between calls reloads the model.
+OLLAMA_NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX", "0"))
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+class LLMError(RuntimeError):
+    """Raised when a provider request fails (after retries, if retryable)."""
+
+class CircuitOpenError(LLMError):
+    """Raised without contacting the provider while its circuit is open."""
+
+class CircuitBreaker:
+    """
+    Opens after `failures` consecutive failed calls and rejects calls until
+    `reset_timeout` seconds have passed. Then one trial call is let through:
+    success closes the circuit, failure keeps it open for another period.
+    """
+    def __init__(self, failures=LLM_CIRCUIT_FAILURES, reset_timeout=LLM_CIRCUIT_RESET):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self._count = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self.reset_timeout - (time.monotonic() - self._opened_at)
+            if remaining > 0:
+                raise CircuitOpenError(f"circuit open, retry in {remaining:.1f}s")
+            # Half-open: this caller is the trial, everyone else waits another period
+            self._opened_at = time.monotonic()
+
+    def record_success(self):
+        with self._lock:
+            self._count = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._count += 1
+            if self._count >= self.failures:
+                self._opened_at = time.monotonic()
+
+class LLMClient:
+    """
+    Base HTTP client. Subclasses define the endpoint path, request payload and
+    how the completion text is read from the response body.
+    """
+    provider = None
+    path = None
+    default_base_url = None
+    default_model = None
+    # Whether the provider can restrict decoding to a list of choices
+    constrains_choices = False
+
+    def __init__(self, model=None, base_url=None, api_key=None, timeout=LLM_TIMEOUT,
+                 max_retries=LLM_MAX_RETRIES, pool_size=LLM_POOL_SIZE):
+        self.model = model or self.default_model
+        self.base_url = (base_url or self.default_base_url).rstrip("/")
+        self.api_key = api_key
+        self.timeout = (LLM_CONNECT_TIMEOUT, timeout)
+        self.max_retries = max_retries
+        self.breaker = CircuitBreaker()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(self.headers())
+        self.usage = {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "prefill_seconds": 0.0}
+        self._usage_lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def last_stats(self):
+        """Usage of the last completed call made from the current thread."""
+        return getattr(self._local, "stats", {})
+
+    def record_stats(self, stats):
+        """
+        Records one call's usage: prompt_tokens, completion_tokens and, where the
+        provider reports it, prefill_seconds (time spent evaluating the prompt).
+        """
+        with self._usage_lock:
+            self.usage["requests"] += 1
+            for key, value in stats.items():
+                self.usage[key] = self.usage.get(key, 0) + value
+        self._local.stats = stats
+        telemetry.inc("llm_requests", provider=self.provider)
+        for key, value in stats.items():
+            telemetry.inc(f"llm_{key}", value, provider=self.provider)
+
+    def headers(self):
+        return {}
+
+    def build_payload(self, prompt, stream=False, max_tokens=None, stop=None, choices=None):
+        raise NotImplementedError
+
+    def parse_response(self, body):
+        raise NotImplementedError
+
+    def iter_deltas(self, response):
+        raise NotImplementedError
+
+    def parse_choice(self, text):
+        return text
+
+    def generate(self, prompt, **options):
+        """
+        Returns the completion text for a prompt.
+        Args:
+            prompt (str): The prompt.
+            **options: Generation controls, applied where the provider supports them:
+                max_tokens (int) caps the completion length, stop (list) ends it at
+                any of the given strings, and choices (list) constrains the answer
+                to one of the given strings.
+        """
+        response = self._post(self.build_payload(prompt, **options))
+        text = self.parse_response(response.json())
+        return self.parse_choice(text) if options.get("choices") else text
+
+    def stream(self, prompt, **options):
+        """
+        Yields the completion text in pieces as the provider produces them.
+        Takes the same options as generate(). Retries only apply until the
+        response starts; a stream that breaks mid-way raises.
+        """
+        response = self._post(self.build_payload(prompt, stream=True, **options), stream=True)
+        with response:
+            if options.get("choices") and self.constrains_choices:
+                # A constrained answer is a few tokens of JSON; emit the decoded choice once
+                yield self.parse_choice("".join(self.iter_deltas(response)))
+            else:
+                yield from self.iter_deltas(response)
+
+    def _backoff(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF * 2 ** attempt))
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(LLM_BACKOFF_MAX, float(retry_after)))
+        return delay
+
+    def _post(self, payload, stream=False):
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError:
+            telemetry.inc("llm_failures", provider=self.provider, reason="circuit_open")
+            raise
+        url = self.base_url + self.path
+        error = None
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                response = self.session.post(url, json=payload, timeout=self.timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            else:
+                if response.ok:
+                    self.breaker.record_success()
+                    return response
+                message = f"{self.provider} returned HTTP {response.status_code}: {response.text[:200]}"
+                retry_after = response.headers.get("Retry-After")
+                response.close()
+                if response.status_code not in RETRY_STATUS:
+                    # Client errors will not succeed on retry and say nothing about provider health
+                    telemetry.inc("llm_failures", provider=self.provider, reason="client_error")
+                    raise LLMError(message)
+                error = LLMError(message)
+            if attempt < self.max_retries:
+                telemetry.inc("llm_retries", provider=self.provider)
+                time.sleep(self._backoff(attempt, retry_after))
+        self.breaker.record_failure()
+        telemetry.inc("llm_failures", provider=self.provider, reason="retries_exhausted")
+        raise LLMError(f"{self.provider} request failed after {self.max_retries + 1} attempts: {error}") from error
+
+def iter_sse(response):
+    """Parses the JSON payloads of a server-sent events stream (OpenAI, Anthropic)."""
+    for line in response.iter_lines():
+        if not line.startswith(b"data:"):
+            continue
+        data = line[len(b"data:"):].strip().decode("utf-8")
+        if data == "[DONE]":
+            break
+        yield json.loads(data)
+
+class OllamaClient(LLMClient):
+    provider = "ollama"
+    path = "/api/generate"
+    default_base_url = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+    default_model = os.getenv("OLLAMA_MODEL", "llama3")  # You can change to "mistral" or another local model
+    constrains_choices = True
+
+    def build_payload(self, prompt, stream=False, max_tokens=None, stop=None, choices=None):
+        options = {"temperature": 0}
+        if OLLAMA_NUM_CTX:
+            options["num_ctx"] = OLLAMA_NUM_CTX
+        if max_tokens:
+            options["num_predict"] = max_tokens
+        if stop:
+            options["stop"] = stop
+        payload = {"model": self.model, "prompt": prompt, "stream": stream, "options": options,
+                   "keep_alive": OLLAMA_KEEP_ALIVE}
+        if choices:
+            # Structured output: the grammar only admits one of the choices, as a JSON string
+            payload["format"] = {"type": "string", "enum": list(choices)}
+        return payload
+
+    def parse_response(self, body):
+        self._record_timings(body)
+        return body["response"]
+
+    def _record_timings(self, body):
+        # With a warm KV cache prompt_eval_count only covers the part of the prompt not reused
+        self.record_stats({
+            "prompt_tokens": body.get("prompt_eval_count", 0),
+            "completion_tokens": body.get("eval_count", 0),
+            "prefill_seconds": body.get("prompt_eval_duration", 0) / 1e9,
+        })
+
+    def parse_choice(self, text):
+        try:
+            value = json.loads(text)
+        except ValueError:
+            return text
+        return value if isinstance(value, str) else text
+
+    def iter_deltas(self, response):
+        # Newline-delimited JSON objects, the last one with "done": true
+        for line in response.iter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if chunk.get("response"):
+                yield chunk["response"]
+            if chunk.get("done"):
+                self._record_timings(chunk)
+                break
+
+class OpenAIClient(LLMClient):
+    provider = "openai"
+    path = "/v1/completions"
+    default_base_url = os.getenv("OPENAI_BASE_URL", "https://api.openai.com")
+    default_model = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo-instruct")
+
+    def __init__(self, api_key=None, **kwargs):
+        super().__init__(api_key=api_key or os.getenv("OPENAI_API_KEY"), **kwargs)
+
+    def headers(self):
+        return {"Authorization": f"Bearer {self.api_key}"}
+
+    def build_payload(self, prompt, stream=False, max_tokens=None, stop=None, choices=None):
+        payload = {"model": self.model, "prompt": prompt, "temperature": 0, "max_tokens": max_tokens or 256,
+                   "stream": stream}
+        if stop:
+            payload["stop"] = stop[:4]  # the API accepts at most four
+        if stream:
+            payload["stream_options"] = {"include_usage": True}
+        return payload
+
+    def parse_response(self, body):
+        self._record_usage(body.get("usage"))
+        return body["choices"][0]["text"]
+
+    def _record_usage(self, usage):
+        if usage:
+            self.record_stats({"prompt_tokens": usage.get("prompt_tokens", 0),
+                               "completion_tokens": usage.get("completion_tokens", 0)})
+
+    def iter_deltas(self, response):
+        for chunk in iter_sse(response):
+            if chunk.get("choices") and chunk["choices"][0].get("text"):
+                yield chunk["choices"][0]["text"]
+            self._record_usage(chunk.get("usage"))
+
+class AnthropicClient(LLMClient):
+    provider = "anthropic"
+    path = "/v1/messages"
+    default_base_url = os.getenv("ANTHROPIC_BASE_URL", "https://api.anthropic.com")
+    default_model = os.getenv("ANTHROPIC_MODEL", "claude-3-opus-20240229")
+
+    def __init__(self, api_key=None, **kwargs):
+        super().__init__(api_key=api_key or os.getenv("ANTHROPIC_API_KEY"), **kwargs)
+
+    def headers(self):
+        return {"x-api-key": self.api_key or "", "anthropic-version": "2023-06-01"}
+
+    def build_payload(self, prompt, stream=False, max_tokens=None, stop=None, choices=None):
+        payload = {"model": self.model, "max_tokens": max_tokens or 1024, "stream": stream,
+                   "messages": [{"role": "user", "content": prompt}]}
+        # The API rejects whitespace-only stop sequences
+        stop = [s for s in stop or [] if s.strip()]
+        if stop:
+            payload["stop_sequences"] = stop
+        return payload
+
+    def parse_response(self, body):
+        usage = body.get("usage", {})
+        self.record_stats({"prompt_tokens": usage.get("input_tokens", 0),
+                           "completion_tokens": usage.get("output_tokens", 0)})
+        return "".join(block.get("text", "") for block in body["content"] if block.get("type") == "text")
+
+    def iter_deltas(self, response):
+        stats = {"prompt_tokens": 0, "completion_tokens": 0}
+        for event in iter_sse(response):
+            if event.get("type") == "content_block_delta" and event["delta"].get("type") == "text_delta":
+                yield event["delta"]["text"]
+            elif event.get("type") == "message_start":
+                stats["prompt_tokens"] = event["message"].get("usage", {}).get("input_tokens", 0)
+            elif event.get("type") == "message_delta":
+                stats["completion_tokens"] = event.get("usage", {}).get("output_tokens", 0)
+            elif event.get("type") == "error":
+                raise LLMError(f"anthropic stream error: {event.get('error')}")
+        self.record_stats(stats)
+
+PROVIDERS = {
+    "ollama": OllamaClient,
+    "openai": OpenAIClient,
+    "anthropic": AnthropicClient,
+}
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(provider=None, **config):
+    """
+    Returns the shared client for a provider configuration, creating it on first use.
+    Args:
+        provider (str): 'ollama', 'openai' or 'anthropic'; defaults to LLM_PROVIDER.
+        **config: Client overrides such as model, base_url, api_key, timeout.
+    Returns:
+        LLMClient instance.
+    """
+    provider = (provider or os.getenv("LLM_PROVIDER", "ollama")).lower()
+    if provider not in PROVIDERS:
+        raise ValueError(f"LLM provider must be one of {', '.join(PROVIDERS)}")
+    key = (provider, tuple(sorted(config.items())))
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = PROVIDERS[provider](**config)
+        return _clients[key]
@@ -0,0 +1,165 @@
+"""
+Chunk metadata index for filtered vector search.
+
+A SQLite database next to the FAISS store (metadata.db) records, for every
+vector position, its doc_id and character offsets, plus (field, value) tags
+taken from the analysis JSON once the contract is analyzed: contract_type,
+date (the analysis date) and clause (the CUAD categories whose extracted text
+overlaps the chunk). resolve() turns a filter such as
+{"contract_type": "MSA", "clause": ["Termination", "Indemnity"]} into the
+matching vector positions with indexed lookups, so a filtered search only
+touches those vectors.
+"""
+import os
+import re
+import sqlite3
+from datetime import date
+
+import numpy as np
+
+DB_NAME = "metadata.db"
+# Fields that can be filtered on; "<field>_from" / "<field>_to" give an inclusive range
+FILTER_FIELDS = ("doc_id", "contract_type", "date", "clause")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    position INTEGER PRIMARY KEY,
+    doc_id TEXT NOT NULL,
+    start INTEGER,
+    end INTEGER
+);
+CREATE INDEX IF NOT EXISTS chunks_doc ON chunks (doc_id);
+CREATE TABLE IF NOT EXISTS tags (
+    field TEXT NOT NULL,
+    value TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (field, value, position)
+) WITHOUT ROWID;
+"""
+
+def connect(persist_dir):
+    os.makedirs(persist_dir, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(persist_dir, DB_NAME))
+    conn.executescript(_SCHEMA)
+    return conn
+
+def document_positions(persist_dir, doc_id):
+    """Sorted vector positions of a document's chunks."""
+    conn = connect(persist_dir)
+    try:
+        rows = conn.execute("SELECT position FROM chunks WHERE doc_id = ? ORDER BY position", (doc_id,)).fetchall()
+    finally:
+        conn.close()
+    return [row[0] for row in rows]
+
+def remove_ranges(persist_dir, ranges):
+    """
+    Deletes the chunks and tags in each [start, end) position range and moves
+    later positions down to close the gaps, as removing the vectors does.
+    """
+    with connect(persist_dir) as conn:
+        for start, end in sorted(ranges, reverse=True):
+            for table in ("chunks", "tags"):
+                conn.execute(f"DELETE FROM {table} WHERE position >= ? AND position < ?", (start, end))
+                # Through negative values, so no row collides with one not yet moved
+                conn.execute(f"UPDATE {table} SET position = ? - position WHERE position >= ?", (end - start, end))
+                conn.execute(f"UPDATE {table} SET position = -position WHERE position < 0")
+    conn.close()
+
+def record_chunks(persist_dir, doc_id, first_position, spans):
+    """
+    Registers a document's newly added vectors, replacing any rows it still has.
+    The store's writer (embedder.add_to_faiss) holds its write lock and has
+    already removed the document's old vectors.
+    Args:
+        persist_dir (str): Vector store directory.
+        doc_id (str): Document the chunks belong to.
+        first_position (int): FAISS position of the first new vector.
+        spans (list): (start, end) character offsets of each chunk, in insertion order.
+    """
+    rows = [(first_position + i, doc_id, start, end) for i, (start, end) in enumerate(spans)]
+    with connect(persist_dir) as conn:
+        conn.execute("DELETE FROM tags WHERE position IN (SELECT position FROM chunks WHERE doc_id = ?)", (doc_id,))
+        conn.execute("DELETE FROM chunks WHERE doc_id = ?", (doc_id,))
+        conn.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?)", rows)
+        conn.executemany("INSERT OR IGNORE INTO tags VALUES ('doc_id', ?, ?)", [(doc_id, row[0]) for row in rows])
+    conn.close()
+
+def find_span(text, passage, anchor_words=12):
+    """Character span of a (whitespace-normalized) passage in text, or None."""
+    words = passage.split()
+    if len(words) < 3:
+        return None
+    head = re.search(r"\s+".join(map(re.escape, words[:anchor_words])), text)
+    if not head:
+        return None
+    tail = re.compile(r"\s+".join(map(re.escape, words[-anchor_words:])))
+    match = tail.search(text, head.start())
+    return head.start(), match.end() if match else head.start() + len(passage)
+
+def tag_document(persist_dir, doc_id, analysis, text=None):
+    """
+    Tags a document's chunks with its analysis results.
+    Args:
+        persist_dir (str): Vector store directory.
+        doc_id (str): Document identifier.
+        analysis (dict): analyze_contract result (contract_type, clauses, analyzed_at).
+        text (str): The contract text, used to locate clause passages; without it
+            no clause tags are added.
+    Returns:
+        int: Number of tags written.
+    """
+    conn = connect(persist_dir)
+    chunks = conn.execute("SELECT position, start, end FROM chunks WHERE doc_id = ?", (doc_id,)).fetchall()
+    tags = []
+    for field, value in (("contract_type", analysis.get("contract_type")),
+                         ("date", analysis.get("analyzed_at") or date.today().isoformat())):
+        if value:
+            tags.extend((field, value, position) for position, _, _ in chunks)
+    for clause, passage in (analysis.get("clauses") or {}).items() if text else ():
+        span = find_span(text, passage or "")
+        if span:
+            tags.extend(("clause", clause, position) for position, start, end in chunks
+                        if start is not None and start < span[1] and end > span[0])
+    with conn:
+        # Re-analysis replaces the document's analysis tags
+        conn.execute("DELETE FROM tags WHERE field != 'doc_id' AND position IN "
+                     "(SELECT position FROM chunks WHERE doc_id = ?)", (doc_id,))
+        conn.executemany("INSERT OR IGNORE INTO tags VALUES (?, ?, ?)", tags)
+    conn.close()
+    return len(tags)
+
+def resolve(persist_dir, filters):
+    """
+    Vector positions matching every filter.
+    Args:
+        persist_dir (str): Vector store directory.
+        filters (dict): {field: value or list of values (any of)}, and
+            {"<field>_from" / "<field>_to": value} for inclusive ranges (e.g. dates).
+    Returns:
+        np.ndarray: Sorted int64 positions.
+    """
+    conn = connect(persist_dir)
+    result = None
+    try:
+        for key, value in filters.items():
+            field, bound = key, None
+            for suffix in ("_from", "_to"):
+                if key.endswith(suffix):
+                    field, bound = key[:-len(suffix)], suffix
+            if field not in FILTER_FIELDS:
+                raise ValueError(f"filter field must be one of {', '.join(FILTER_FIELDS)}")
+            if bound:
+                op = ">=" if bound == "_from" else "<="
+                rows = conn.execute(f"SELECT position FROM tags WHERE field = ? AND value {op} ?", (field, str(value)))
+            else:
+                values = [str(v) for v in value] if isinstance(value, (list, tuple, set)) else [str(value)]
+                rows = conn.execute(f"SELECT position FROM tags WHERE field = ? AND value IN "
+                                    f"({', '.join('?' * len(values))})", (field, *values))
+            positions = np.unique(np.fromiter((row[0] for row in rows), dtype="int64"))
+            result = positions if result is None else np.intersect1d(result, positions, assume_unique=True)
+            if not len(result):
+                break
+    finally:
+        conn.close()
+    return result if result is not None else np.empty(0, dtype="int64")
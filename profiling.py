@@ -0,0 +1,105 @@
+"""
+Opt-in sampling profiler for the pipeline.
+
+A background thread samples the profiled thread's Python stack every
+PROFILE_INTERVAL seconds (sys._current_frames, no tracing hooks) and counts
+identical stacks. The result is written in the collapsed-stack format
+("frame;frame;frame count" per line), which flamegraph.pl, speedscope or
+inferno turn into a flame graph.
+
+Enable with PROFILE=1 or --profile on watcher.py and benchmark.py. When
+disabled, profile() returns a no-op context manager and nothing is sampled.
+
+Usage:
+    with profile("data/analysis/contract.txt.collapsed.txt"):
+        process(...)
+"""
+import os
+import sys
+import time
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+PROFILE = os.getenv("PROFILE", "0").lower() in ("1", "true", "yes")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))  # seconds between samples
+
+logger = logging.getLogger("profiling")
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class SamplingProfiler:
+    """
+    Samples one thread's stack at a fixed interval.
+    Args:
+        interval (float): Seconds between samples.
+        thread_id (int): Thread to sample; defaults to the thread calling start().
+    """
+    def __init__(self, interval=PROFILE_INTERVAL, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.thread_id is None:
+            self.thread_id = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        """The sampled stacks in collapsed format, most frequent first."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(self.collapsed())
+        return path
+
+@contextmanager
+def _profile(out_path, interval):
+    profiler = SamplingProfiler(interval).start()
+    started = time.perf_counter()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        profiler.write(out_path)
+        logger.info(f"Profile: {profiler.samples} samples over {time.perf_counter() - started:.2f}s saved to {out_path}")
+
+def profile(out_path, enabled=None, interval=PROFILE_INTERVAL):
+    """
+    Profiles the calling thread for the duration of the block.
+    Args:
+        out_path (str): Where to write the collapsed stacks.
+        enabled (bool): Overrides the PROFILE env var.
+        interval (float): Seconds between samples.
+    Returns:
+        A context manager; a no-op one when profiling is disabled.
+    """
+    if not (PROFILE if enabled is None else enabled):
+        return nullcontext()
+    return _profile(out_path, interval)
@@ -0,0 +1,152 @@
+"""
+Question answering over the contract corpus (RAG).
+
+answer_question() retrieves chunks with the hybrid retriever, optionally
+reranks them with a cross-encoder, and asks the LLM to answer from the
+numbered excerpts only, citing them as [n]. Each citation is resolved to the
+doc_id and character offsets of its chunk.
+
+Latency is tracked per stage (embed, retrieve, rerank, generate) against
+QUERY_BUDGETS. Reranking is skipped when embedding and retrieval already used
+their share of the budget. Query embeddings are cached in memory. Answers are
+cached on disk by the hash of their prompt, so a repeated question over
+unchanged excerpts costs no LLM call, while new or re-embedded contracts
+change the excerpts and miss the cache.
+
+Usage:
+    result = answer_question("Which contracts can be terminated for convenience?")
+    print(result["answer"], result["citations"], result["timings"])
+"""
+import os
+import re
+import time
+from functools import lru_cache
+
+import numpy as np
+from langchain.prompts import PromptTemplate
+
+import embedder
+import retriever
+from agent import cached_generate
+from llm import get_client
+from telemetry import span
+
+QUERY_TOP_K = int(os.getenv("QUERY_TOP_K", "5"))
+QUERY_FETCH_K = int(os.getenv("QUERY_FETCH_K", "20"))   # candidates handed to the reranker
+RERANK_MODEL = os.getenv("RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+QUERY_RERANK = os.getenv("QUERY_RERANK", "0").lower() in ("1", "true", "yes")
+ANSWER_CACHE_DIR = os.path.join(os.path.dirname(__file__), '..', 'data', 'cache', 'answers')
+ANSWER_OPTIONS = {"max_tokens": int(os.getenv("QUERY_MAX_TOKENS", "300"))}
+# Seconds per stage; about one second end to end on CPU with a local model
+QUERY_BUDGETS = {
+    "embed": float(os.getenv("QUERY_BUDGET_EMBED", "0.05")),
+    "retrieve": float(os.getenv("QUERY_BUDGET_RETRIEVE", "0.1")),
+    "rerank": float(os.getenv("QUERY_BUDGET_RERANK", "0.25")),
+    "generate": float(os.getenv("QUERY_BUDGET_GENERATE", "0.6")),
+}
+
+ANSWER_PROMPT = PromptTemplate(
+    input_variables=["excerpts", "question"],
+    template="""
+    Contract excerpts:\n{excerpts}\n\nAnswer the question using only the excerpts above. Cite every excerpt you rely on by its number, e.g. [2]. If the excerpts do not contain the answer, say so.\nQuestion: {question}\nAnswer:
+    """
+)
+CITATION = re.compile(r"\[(\d+)\]")
+
+@lru_cache(maxsize=int(os.getenv("QUERY_CACHE_SIZE", "1024")))
+def embed_query(query):
+    """Query embedding, cached per distinct query string."""
+    return np.asarray(embedder.get_embeddings().embed_query(query), dtype="float32")
+
+@lru_cache(maxsize=4)
+def _load_store(persist_dir, mtime):
+    return embedder.load_vectorstore(persist_dir)
+
+def get_store(persist_dir=embedder.VECTORSTORE_DIR):
+    """The loaded vector store, reloaded only when its index file has been rewritten."""
+    return _load_store(persist_dir, os.path.getmtime(os.path.join(persist_dir, "index.faiss")))
+
+@lru_cache(maxsize=1)
+def get_reranker(model_name=RERANK_MODEL):
+    from sentence_transformers import CrossEncoder
+    return CrossEncoder(model_name)
+
+def format_excerpts(chunks):
+    return "\n\n".join(f"[{i}] ({chunk.metadata.get('doc_id')})\n{chunk.page_content}"
+                       for i, chunk in enumerate(chunks, start=1))
+
+def extract_citations(answer, chunks):
+    """Resolves the [n] markers of an answer to the cited chunks' doc_id and offsets."""
+    citations = []
+    for number in dict.fromkeys(int(n) for n in CITATION.findall(answer)):
+        if 1 <= number <= len(chunks):
+            metadata = chunks[number - 1].metadata
+            citations.append({"n": number, "doc_id": metadata.get("doc_id"),
+                              "start": metadata.get("start"), "end": metadata.get("end")})
+    return citations
+
+def answer_question(question, k=QUERY_TOP_K, filters=None, mode="hybrid", rerank=None, provider=None,
+                    persist_dir=embedder.VECTORSTORE_DIR):
+    """
+    Answers a question from the contract corpus with citations.
+    Args:
+        question (str): The question.
+        k (int): Excerpts given to the LLM.
+        filters (dict): Metadata filters, e.g. {"contract_type": "MSA"}; see metadata_index.resolve.
+        mode (str): Retrieval mode: 'hybrid', 'vector' or 'bm25'.
+        rerank (bool): Rerank QUERY_FETCH_K candidates with RERANK_MODEL; defaults to QUERY_RERANK.
+        provider (str): LLM provider; defaults to LLM_PROVIDER.
+        persist_dir (str): Vector store directory.
+    Returns:
+        dict: {answer, citations: [{n, doc_id, start, end}], sources: [{n, doc_id, start, end, text, score}],
+            timings: {stage: seconds}, over_budget: [stages], skipped: [stages]}
+    """
+    rerank = QUERY_RERANK if rerank is None else rerank
+    timings, skipped = {}, []
+    db = get_store(persist_dir)
+
+    t0 = time.perf_counter()
+    query_vector = embed_query(question) if mode != "bm25" else None
+    timings["embed"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    with span("query_retrieve", mode=mode):
+        hits = retriever.retrieve_positions(question, QUERY_FETCH_K if rerank else k, filters, mode, persist_dir,
+                                            db, query_vector=query_vector)
+        chunks = embedder.get_documents(db, [position for position, _ in hits])
+    scores = [score for _, score in hits]
+    timings["retrieve"] = time.perf_counter() - t0
+
+    if rerank and len(chunks) > k:
+        # The reranker is the optional stage; drop it rather than blow the end-to-end budget
+        if timings["embed"] + timings["retrieve"] > QUERY_BUDGETS["embed"] + QUERY_BUDGETS["retrieve"]:
+            skipped.append("rerank")
+        else:
+            t0 = time.perf_counter()
+            with span("query_rerank"):
+                rerank_scores = get_reranker().predict([(question, chunk.page_content) for chunk in chunks])
+            order = np.argsort(-np.asarray(rerank_scores))
+            chunks, scores = [chunks[i] for i in order], [float(rerank_scores[i]) for i in order]
+            timings["rerank"] = time.perf_counter() - t0
+    chunks, scores = chunks[:k], scores[:k]
+
+    if chunks:
+        t0 = time.perf_counter()
+        client = get_client(provider)
+        answer = cached_generate(client, ANSWER_PROMPT.format(excerpts=format_excerpts(chunks), question=question),
+                                 ANSWER_OPTIONS, cache_dir=ANSWER_CACHE_DIR, name="answer")
+        timings["generate"] = time.perf_counter() - t0
+    else:
+        answer = "No matching contract excerpts were found."
+
+    sources = [{"n": i, "doc_id": chunk.metadata.get("doc_id"), "start": chunk.metadata.get("start"),
+                "end": chunk.metadata.get("end"), "text": chunk.page_content, "score": score}
+               for i, (chunk, score) in enumerate(zip(chunks, scores), start=1)]
+    return {
+        "answer": answer,
+        "citations": extract_citations(answer, chunks),
+        "sources": sources,
+        "timings": {stage: round(seconds, 4) for stage, seconds in timings.items()},
+        "over_budget": [stage for stage, seconds in timings.items() if seconds > QUERY_BUDGETS[stage]],
+        "skipped": skipped,
+    }
@@ -0,0 +1,89 @@
+"""
+Hybrid clause retrieval: BM25 keyword search plus FAISS vector search, fused
+with reciprocal rank fusion (RRF).
+
+Both rankers score the same chunks (the BM25 index uses the FAISS vector
+positions as its keys) and honor the same metadata filters. Each fetches
+HYBRID_FETCH_K candidates, and a chunk's fused score is the sum of
+1 / (RRF_K + rank) over the rankings it appears in, so a chunk ranked
+well by either method surfaces without having to calibrate BM25 scores
+against vector distances.
+
+Usage:
+    db = embedder.load_vectorstore()
+    for doc, score in hybrid_search("terminate for convenience", k=5, db=db):
+        ...
+"""
+import os
+import numpy as np
+
+import bm25
+import embedder
+import metadata_index
+from telemetry import span
+
+HYBRID_FETCH_K = int(os.getenv("HYBRID_FETCH_K", "50"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+RETRIEVAL_MODES = ("vector", "bm25", "hybrid")
+
+def rrf_fuse(rankings, k=None, rrf_k=RRF_K):
+    """
+    Fuses ranked lists of keys with reciprocal rank fusion.
+    Args:
+        rankings (list): Lists of keys, best first.
+        k (int): Number of fused results to keep.
+        rrf_k (int): Rank offset; larger values flatten the contribution of top ranks.
+    Returns:
+        list: (key, fused score) pairs, best first.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank)
+    fused = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    return fused[:k] if k else fused
+
+def retrieve_positions(query, k=5, filters=None, mode="hybrid", persist_dir=embedder.VECTORSTORE_DIR, db=None,
+                       query_vector=None, fetch_k=HYBRID_FETCH_K):
+    """
+    Ranks vector-store positions for a query.
+    Args:
+        query (str): Query text.
+        k (int): Number of results.
+        filters (dict): Metadata filters, see metadata_index.resolve.
+        mode (str): 'vector', 'bm25' or 'hybrid'.
+        persist_dir (str): Vector store directory.
+        db (FAISS): Loaded store; required for 'vector' and 'hybrid'.
+        query_vector (np.ndarray): Precomputed query embedding, e.g. from a cache.
+        fetch_k (int): Candidates taken from each ranker before fusion.
+    Returns:
+        list: (position, score) pairs, best first. Scores are RRF scores for
+            'hybrid', BM25 scores for 'bm25' and L2 distances for 'vector'.
+    """
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"mode must be one of {', '.join(RETRIEVAL_MODES)}")
+    positions = metadata_index.resolve(persist_dir, filters) if filters else None
+    if positions is not None and not len(positions):
+        return []
+    vector_hits, keyword_hits = [], []
+    if mode in ("vector", "hybrid"):
+        if query_vector is None:
+            query_vector = np.asarray(db.embeddings.embed_query(query), dtype="float32")
+        with span("vector_search"):
+            vector_hits = embedder.search_positions(db, query_vector, k if mode == "vector" else fetch_k, positions)
+        if mode == "vector":
+            return vector_hits
+    with span("bm25_search"):
+        keyword_hits = bm25.search(persist_dir, query, k if mode == "bm25" else fetch_k, positions)
+    if mode == "bm25":
+        return keyword_hits
+    return rrf_fuse([[p for p, _ in vector_hits], [p for p, _ in keyword_hits]], k)
+
+def hybrid_search(query, k=5, filters=None, mode="hybrid", persist_dir=embedder.VECTORSTORE_DIR, db=None):
+    """
+    Retrieves chunks for a query as (Document, score) pairs, best first.
+    Takes the same arguments as retrieve_positions; loads the store if db is not given.
+    """
+    db = db or embedder.load_vectorstore(persist_dir)
+    hits = retrieve_positions(query, k, filters, mode, persist_dir, db)
+    return list(zip(embedder.get_documents(db, [p for p, _ in hits]), [score for _, score in hits]))
@@ -0,0 +1,216 @@
+"""
+Portfolio risk rollups.
+
+Every analysis JSON the watcher writes is also folded into precomputed counts
+in SQLite (rollups.db next to the analysis directory): clauses by contract
+type x clause x risk level, and documents by ingestion date (analyzed_at) x
+contract type x overall risk. Each document's own contribution is kept too,
+so re-analyzing a contract subtracts its old counts before adding the new
+ones, and nothing is recounted from the files. Dashboard queries read a few
+hundred aggregate rows at most and return in milliseconds.
+
+Usage:
+    python src/rollups.py --rebuild   # backfill from existing analysis JSONs
+"""
+import os
+import json
+import sqlite3
+import argparse
+from datetime import date
+
+ROLLUPS_DB = os.getenv("ROLLUPS_DB", os.path.join(os.path.dirname(__file__), '..', 'data', 'rollups.db'))
+ANALYSIS_DIR = os.path.join(os.path.dirname(__file__), '..', 'data', 'analysis')
+RISK_LEVELS = ("High", "Medium", "Low", "Unknown")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    doc_id TEXT PRIMARY KEY,
+    contract_type TEXT NOT NULL,
+    day TEXT NOT NULL,
+    overall_risk TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS document_clauses (
+    doc_id TEXT NOT NULL,
+    clause TEXT NOT NULL,
+    risk TEXT NOT NULL,
+    PRIMARY KEY (doc_id, clause)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS clause_risk_counts (
+    contract_type TEXT NOT NULL,
+    clause TEXT NOT NULL,
+    risk TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (contract_type, clause, risk)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS daily_counts (
+    day TEXT NOT NULL,
+    contract_type TEXT NOT NULL,
+    overall_risk TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (day, contract_type, overall_risk)
+) WITHOUT ROWID;
+"""
+
+def connect(db_path=ROLLUPS_DB):
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")  # the dashboard reads while the watcher writes
+    conn.executescript(_SCHEMA)
+    return conn
+
+def overall_risk(levels):
+    # Highest risk present determines overall, as in the contract view
+    for level in RISK_LEVELS:
+        if level in levels:
+            return level
+    return "Unknown"
+
+def _bump(conn, table, keys, delta):
+    columns = {"clause_risk_counts": ("contract_type", "clause", "risk"),
+               "daily_counts": ("day", "contract_type", "overall_risk")}[table]
+    where = " AND ".join(f"{column} = ?" for column in columns)
+    conn.executemany(f"INSERT INTO {table} VALUES (?, ?, ?, 0) ON CONFLICT DO NOTHING", keys)
+    conn.executemany(f"UPDATE {table} SET count = count + ? WHERE {where}", [(delta, *key) for key in keys])
+    conn.execute(f"DELETE FROM {table} WHERE count <= 0")
+
+def _subtract(conn, doc_id):
+    old = conn.execute("SELECT day, contract_type, overall_risk FROM documents WHERE doc_id = ?",
+                       (doc_id,)).fetchone()
+    if not old:
+        return
+    clauses = conn.execute("SELECT clause, risk FROM document_clauses WHERE doc_id = ?", (doc_id,)).fetchall()
+    _bump(conn, "clause_risk_counts", [(old[1], clause, risk) for clause, risk in clauses], -1)
+    _bump(conn, "daily_counts", [old], -1)
+    conn.execute("DELETE FROM document_clauses WHERE doc_id = ?", (doc_id,))
+    conn.execute("DELETE FROM documents WHERE doc_id = ?", (doc_id,))
+
+def record(doc_id, analysis, db_path=ROLLUPS_DB):
+    """
+    Folds one document's analysis into the rollups, replacing its previous contribution.
+    Args:
+        doc_id (str): Document identifier.
+        analysis (dict): analyze_contract result (contract_type, clauses, risks, analyzed_at).
+        db_path (str): Rollups database.
+    """
+    # Older analyses stored the LLM's free-text answers; normalize them as the agent does now
+    from agent import extract_contract_type, extract_risk_level
+    contract_type = extract_contract_type(analysis.get("contract_type") or "Other")
+    day = analysis.get("analyzed_at") or date.today().isoformat()
+    risks = analysis.get("risks") or {}
+    clauses = [(clause, extract_risk_level(risks.get(clause) or "")) for clause in analysis.get("clauses") or {}]
+    overall = overall_risk([level for _, level in clauses])
+    conn = connect(db_path)
+    with conn:
+        _subtract(conn, doc_id)
+        conn.execute("INSERT INTO documents VALUES (?, ?, ?, ?)", (doc_id, contract_type, day, overall))
+        conn.executemany("INSERT INTO document_clauses VALUES (?, ?, ?)",
+                         [(doc_id, clause, level) for clause, level in clauses])
+        _bump(conn, "clause_risk_counts", [(contract_type, clause, level) for clause, level in clauses], 1)
+        _bump(conn, "daily_counts", [(day, contract_type, overall)], 1)
+    conn.close()
+
+def remove(doc_id, db_path=ROLLUPS_DB):
+    """Subtracts a document's contribution, e.g. when its analysis is deleted."""
+    conn = connect(db_path)
+    with conn:
+        _subtract(conn, doc_id)
+    conn.close()
+
+def clause_risk_counts(contract_type=None, db_path=ROLLUPS_DB):
+    """
+    Clause counts per risk level.
+    Args:
+        contract_type (str): Limit to one contract type; all types when None.
+        db_path (str): Rollups database.
+    Returns:
+        dict: {clause: {risk level: count}}
+    """
+    conn = connect(db_path)
+    try:
+        sql = "SELECT clause, risk, SUM(count) FROM clause_risk_counts"
+        params = ()
+        if contract_type:
+            sql, params = sql + " WHERE contract_type = ?", (contract_type,)
+        rows = conn.execute(sql + " GROUP BY clause, risk", params).fetchall()
+    finally:
+        conn.close()
+    counts = {}
+    for clause, risk, count in rows:
+        counts.setdefault(clause, {})[risk] = count
+    return counts
+
+def daily_counts(contract_type=None, since=None, db_path=ROLLUPS_DB):
+    """
+    Documents ingested per day by overall risk.
+    Args:
+        contract_type (str): Limit to one contract type; all types when None.
+        since (str): First ISO date to include.
+        db_path (str): Rollups database.
+    Returns:
+        list: (day, overall risk, count) rows, oldest first.
+    """
+    conditions, params = [], []
+    if contract_type:
+        conditions.append("contract_type = ?")
+        params.append(contract_type)
+    if since:
+        conditions.append("day >= ?")
+        params.append(since)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    conn = connect(db_path)
+    try:
+        return conn.execute(f"SELECT day, overall_risk, SUM(count) FROM daily_counts{where} "
+                            "GROUP BY day, overall_risk ORDER BY day", params).fetchall()
+    finally:
+        conn.close()
+
+def portfolio_summary(db_path=ROLLUPS_DB):
+    """
+    Document totals across the portfolio.
+    Returns:
+        dict: {"documents": int, "by_type": {contract type: count}, "by_risk": {overall risk: count}}
+    """
+    conn = connect(db_path)
+    try:
+        by_type = dict(conn.execute("SELECT contract_type, SUM(count) FROM daily_counts GROUP BY contract_type"))
+        by_risk = dict(conn.execute("SELECT overall_risk, SUM(count) FROM daily_counts GROUP BY overall_risk"))
+    finally:
+        conn.close()
+    return {"documents": sum(by_type.values()), "by_type": by_type, "by_risk": by_risk}
+
+def rebuild(analysis_dir=ANALYSIS_DIR, db_path=ROLLUPS_DB):
+    """
+    Recomputes the rollups from the analysis JSONs on disk. Analyses written
+    before analyzed_at was recorded are dated by their file's modification time.
+    Returns:
+        int: Number of documents recorded.
+    """
+    if os.path.exists(db_path):
+        conn = connect(db_path)
+        with conn:
+            for table in ("documents", "document_clauses", "clause_risk_counts", "daily_counts"):
+                conn.execute(f"DELETE FROM {table}")
+        conn.close()
+    recorded = 0
+    for filename in sorted(os.listdir(analysis_dir)) if os.path.isdir(analysis_dir) else ():
+        if not filename.endswith('.json'):
+            continue
+        path = os.path.join(analysis_dir, filename)
+        with open(path, 'r') as f:
+            analysis = json.load(f)
+        analysis.setdefault("analyzed_at", date.fromtimestamp(os.path.getmtime(path)).isoformat())
+        record(filename[:-len('.json')], analysis, db_path)
+        recorded += 1
+    return recorded
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Maintain the portfolio risk rollups.")
+    arg_parser.add_argument('--rebuild', action='store_true', help="recompute the rollups from data/analysis/")
+    args = arg_parser.parse_args()
+    if args.rebuild:
+        print(f"Recorded {rebuild()} analyses in {ROLLUPS_DB}")
+    summary = portfolio_summary()
+    print(f"{summary['documents']} documents; by type {summary['by_type']}; by overall risk {summary['by_risk']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+Tracing, metrics and structured logs for the pipeline.
+
+span() times a pipeline stage (parse, chunk, embed, llm, write, ...): the
+duration lands in the pipeline_stage_seconds histogram, a failure increments
+pipeline_failures_total and re-raises, and every span is logged with its
+labels plus any fields bound with bind() (such as doc_id). inc() bumps a
+counter, e.g. llm_prompt_tokens_total or cache_hits_total.
+
+Metrics are exposed in the OpenMetrics text format, written to METRICS_FILE
+(default data/metrics.prom) by write_metrics() and, if METRICS_PORT is set,
+served at http://127.0.0.1:<port>/metrics for Prometheus to scrape. Set
+LOG_FORMAT=json for one JSON object per log line.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+METRICS_FILE = os.getenv("METRICS_FILE", os.path.join(os.path.dirname(__file__), '..', 'data', 'metrics.prom'))
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Upper bounds (seconds) of the stage duration histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+logger = logging.getLogger("pipeline")
+
+_lock = threading.Lock()
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+_local = threading.local()
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def inc(name, value=1, **labels):
+    """Adds value to the counter `name` (exported as <name>_total) for the given labels."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name, value, **labels):
+    """Records one observation in the histogram `name` for the given labels."""
+    key = _key(name, labels)
+    with _lock:
+        row = _histograms.setdefault(key, [0] * (len(BUCKETS) + 2))
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                row[i] += 1
+        row[-2] += value
+        row[-1] += 1
+
+@contextmanager
+def bind(**fields):
+    """Adds fields (e.g. doc_id) to every span logged by this thread inside the block."""
+    previous = getattr(_local, "fields", {})
+    _local.fields = {**previous, **fields}
+    try:
+        yield
+    finally:
+        _local.fields = previous
+
+@contextmanager
+def span(stage, **labels):
+    """
+    Times a pipeline stage.
+    Args:
+        stage (str): Stage name, used as the "stage" label.
+        **labels: Extra low-cardinality labels (e.g. provider, field).
+    Usage:
+        with span("parse"):
+            text = parse_contract(path)
+    """
+    parents = getattr(_local, "stack", [])
+    _local.stack = parents + [stage]
+    status = "ok"
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        inc("pipeline_failures", stage=stage, **labels)
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        _local.stack = parents
+        observe("pipeline_stage_seconds", duration, stage=stage, **labels)
+        fields = {**getattr(_local, "fields", {}), "span": stage, **labels,
+                  "parent": parents[-1] if parents else None,
+                  "duration_ms": round(duration * 1000, 2), "status": status}
+        logger.info(f"{stage} {status} in {duration * 1000:.1f}ms", extra={"fields": fields})
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+def render():
+    """Returns every metric in the OpenMetrics text format."""
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, list(row)) for key, row in _histograms.items())
+    lines = []
+    family = None
+    for (name, labels), value in counters:
+        if name != family:
+            lines.append(f"# TYPE {name} counter")
+            family = name
+        lines.append(f"{name}_total{_format_labels(labels)} {value}")
+    for (name, labels), row in histograms:
+        if name != family:
+            lines.append(f"# TYPE {name} histogram")
+            lines.append(f"# UNIT {name} seconds")
+            family = name
+        for bound, count in zip(BUCKETS, row):
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {count}")
+        lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {row[-1]}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {round(row[-2], 6)}")
+        lines.append(f"{name}_count{_format_labels(labels)} {row[-1]}")
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+def write_metrics(path=None):
+    """Writes the current metrics to path (default METRICS_FILE) atomically; no-op if unset."""
+    path = path or METRICS_FILE
+    if not path:
+        return None
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(render())
+    os.replace(tmp_path, path)
+    return path
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        data = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def start_metrics_server(port=None):
+    """Serves /metrics on 127.0.0.1 in a background thread if a port is configured."""
+    port = METRICS_PORT if port is None else port
+    if not port:
+        return None
+    server = ThreadingHTTPServer(("127.0.0.1", port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Serving metrics on http://127.0.0.1:{server.server_address[1]}/metrics")
+    return server
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def setup_logging(fmt=None, level=None):
+    """Configures the root logger for LOG_FORMAT ('text' or 'json') and LOG_LEVEL."""
+    handler = logging.StreamHandler()
+    if (fmt or LOG_FORMAT) == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level or LOG_LEVEL)
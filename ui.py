@@ -18,7 +18,8 @@ RISK_COLORS = {
 DARK_BG = "#121212"
 TEXT_COLOR = "#EAEAEA"
 FONT_FAMILY = "'Inter', 'Roboto', 'Segoe UI', 'Arial', sans-serif"
-UPLOAD_DIR = os.path.join(os.path.dirname(__file__), '..', 'data', 'uploads')
+# Outside data/uploads, which watcher.py watches: the UI runs the pipeline on its uploads itself
+UPLOAD_DIR = os.path.join(os.path.dirname(__file__), '..', 'data', 'ui_uploads')
 
 # --- Custom CSS for dark theme and font ---
 st.markdown(f"""
@@ -93,28 +94,109 @@ def filter_clauses(clauses, risks, search, risk_filters):
         filtered.append((clause, text, risk))
     return filtered
 
-def run_pipeline_on_upload(uploaded_file_path):
+STREAM_LABELS = {"contract_type": "Type", "clause": "Clause", "risk": "Risk", "summary": "Summary"}
+
+def render_stream_event(placeholder, partial, event):
+    """Accumulates streamed analysis fields and re-renders them in place as tokens arrive."""
+    if event["event"] == "done":
+        return
+    key = (event["field"], event["clause"])
+    if event["event"] == "start":
+        partial[key] = ""
+    elif event["event"] == "delta":
+        partial[key] += event["text"]
+    else:
+        partial[key] = event["text"]
+    lines = []
+    for (field, clause), text in partial.items():
+        label = STREAM_LABELS[field] + (f" – {clause}" if clause else "")
+        lines.append(f"**{label}:** {text}")
+    placeholder.markdown("\n\n".join(lines))
+
+def run_pipeline_on_upload(uploaded_file_path, on_event=None):
     """
     Run the full pipeline (parser, embedder, agent) on the uploaded file.
-    This assumes watcher.py logic is available as import or function.
+    Uses watcher.process_contract, streaming analysis events to on_event.
     """
-    # Import pipeline modules
-    from src import parser, embedder, agent
-    # 1. Parse
-    text, doc_id = parser.parse_file(uploaded_file_path)
-    # 2. Embed
-    embedder.chunk_and_embed(text, doc_id)
-    # 3. Analyze
-    result = agent.analyze_contract(text, doc_id)
-    # 4. Save analysis JSON
-    analysis_dir = os.path.join(os.path.dirname(__file__), '..', 'data', 'analysis')
-    Path(analysis_dir).mkdir(parents=True, exist_ok=True)
-    with open(os.path.join(analysis_dir, doc_id + '.json'), 'w') as f:
-        json.dump(result, f, indent=2)
-    return doc_id + '.json'
+    from watcher import process_contract
+    return os.path.basename(process_contract(uploaded_file_path, on_event=on_event))
+
+def render_query_panel():
+    """Ask the corpus: retrieval-backed answers with citations to contract excerpts."""
+    from query import answer_question, QUERY_BUDGETS
+    st.title("Ask the Corpus")
+    st.markdown("<hr style='border:1px solid #333'>", unsafe_allow_html=True)
+    question = st.text_input("Question", placeholder="Which contracts can be terminated for convenience?")
+    col1, col2, col3 = st.columns([2, 2, 1])
+    doc_ids = col1.multiselect("Limit to contracts", [c[:-len('.json')] for c in list_contracts()])
+    contract_types = col2.multiselect("Limit to contract types", ["NDA", "SLA", "MSA", "Other"])
+    rerank = col3.checkbox("Rerank", value=False, help="Rerank candidates with a cross-encoder (slower, more precise).")
+    if not question:
+        return
+    filters = {}
+    if doc_ids:
+        filters["doc_id"] = doc_ids
+    if contract_types:
+        filters["contract_type"] = contract_types
+    try:
+        with st.spinner("Searching contracts..."):
+            result = answer_question(question, filters=filters or None, rerank=rerank)
+    except FileNotFoundError:
+        st.info("No contracts have been embedded yet.")
+        return
+    st.markdown(f"<div style='white-space:pre-wrap'>{result['answer']}</div>", unsafe_allow_html=True)
+    timings = " · ".join(f"{stage} {seconds * 1000:.0f} ms" + (" ⚠️" if stage in result["over_budget"] else "")
+                         for stage, seconds in result["timings"].items())
+    st.caption(f"{timings} (budget {sum(QUERY_BUDGETS.values()) * 1000:.0f} ms)"
+               + (f" · skipped: {', '.join(result['skipped'])}" if result["skipped"] else ""))
+    cited = {citation["n"] for citation in result["citations"]}
+    st.subheader("Sources")
+    for source in result["sources"]:
+        marker = "📌 " if source["n"] in cited else ""
+        with st.expander(f"{marker}[{source['n']}] {source['doc_id']} (chars {source['start']}–{source['end']})"):
+            st.markdown(f"<div style='white-space:pre-wrap'>{source['text']}</div>", unsafe_allow_html=True)
+
+def render_portfolio():
+    """Portfolio dashboard, read from the precomputed rollups only (never the analysis files)."""
+    import pandas as pd
+    import rollups
+    st.title("Portfolio Risk")
+    st.markdown("<hr style='border:1px solid #333'>", unsafe_allow_html=True)
+    summary = rollups.portfolio_summary()
+    if not summary["documents"]:
+        st.info("No analyses in the rollups yet. Run `python src/rollups.py --rebuild` to backfill existing ones.")
+        return
+    col1, col2, col3, col4 = st.columns([1,1,1,2])
+    col1.metric("Contracts", summary["documents"])
+    col2.metric("High Risk", summary["by_risk"].get("High", 0), delta_color="inverse")
+    col3.metric("Medium Risk", summary["by_risk"].get("Medium", 0))
+    col4.metric("Low Risk", summary["by_risk"].get("Low", 0))
+    st.caption(" · ".join(f"{contract_type}: {count}" for contract_type, count in sorted(summary["by_type"].items())))
+    st.markdown("---")
+
+    contract_type = st.selectbox("Contract type", ["All"] + sorted(summary["by_type"]))
+    contract_type = None if contract_type == "All" else contract_type
+    st.subheader("Clause Risk by Clause")
+    counts = rollups.clause_risk_counts(contract_type)
+    if counts:
+        table = pd.DataFrame.from_dict(counts, orient="index").reindex(columns=list(rollups.RISK_LEVELS)).fillna(0)
+        table = table.astype(int).sort_values(["High", "Medium"], ascending=False)
+        st.dataframe(table, use_container_width=True)
+        st.bar_chart(table[["High", "Medium", "Low"]])
+    st.subheader("Contracts Analyzed per Day by Overall Risk")
+    trend = pd.DataFrame(rollups.daily_counts(contract_type), columns=["day", "risk", "count"])
+    if not trend.empty:
+        st.bar_chart(trend.pivot(index="day", columns="risk", values="count").fillna(0))
 
 # --- Main App ---
 def main():
+    page = st.sidebar.radio("View", ["Contract Analysis", "Portfolio", "Ask the Corpus"])
+    if page == "Ask the Corpus":
+        render_query_panel()
+        return
+    if page == "Portfolio":
+        render_portfolio()
+        return
     contracts = list_contracts()
     if not contracts:
         st.info("No analyzed contracts found.")
@@ -141,13 +223,16 @@ def main():
         if uploaded_files:
             progress = st.progress(0, text="Starting batch analysis...")
             status_msgs = []
+            os.makedirs(UPLOAD_DIR, exist_ok=True)
             for idx, uploaded_file in enumerate(uploaded_files):
                 file_path = os.path.join(UPLOAD_DIR, uploaded_file.name)
                 with open(file_path, "wb") as f:
                     f.write(uploaded_file.getbuffer())
                 try:
                     with st.spinner(f"Analyzing {uploaded_file.name}..."):
-                        new_json = run_pipeline_on_upload(file_path)
+                        live, partial = st.empty(), {}
+                        new_json = run_pipeline_on_upload(
+                            file_path, on_event=lambda event: render_stream_event(live, partial, event))
                     status_msgs.append(f"✅ {uploaded_file.name} analyzed successfully.")
                 except Exception as e:
                     status_msgs.append(f"❌ {uploaded_file.name} failed: {e}")
@@ -1,13 +1,19 @@
 import os
 import json
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 import pandas as pd
 import numpy as np
 from sklearn import metrics
 
 IOU_THRESH = 0.5
+# Confidence thresholds swept by get_precisions_recalls
+CONFS = list(np.arange(0.99, 0, -0.01)) + [0.001, 0]
 
 def get_questions_from_csv():
-    df = pd.read_csv("category_descriptions.csv")
+    df = pd.read_csv(os.path.join(os.path.dirname(os.path.abspath(__file__)), "category_descriptions.csv"))
     q_dict = {}
     for i in range(df.shape[0]):
         category = df.iloc[i, 0].split("Category: ")[1]
@@ -24,10 +30,47 @@ def load_json(path):
     return dict
 
 
+def _parse_entry(line):
+    line = line.strip()
+    if line.endswith(","):
+        line = line[:-1]
+    return next(iter(json.loads("{" + line + "}").items()))
+
+
+def iter_json(path):
+    """
+    Yields the (key, value) pairs of a JSON object file. Files written one entry per line by
+    utils.JsonStreamWriter (e.g. nbest_predictions_.json) are read one entry at a time, so
+    memory stays bounded; any other layout is loaded whole.
+    """
+    with open(path, "r") as f:
+        streamed = f.readline().strip() == "{"
+        if streamed:
+            line = f.readline()
+            try:
+                entry = None if line.strip() == "}" else _parse_entry(line)
+            except ValueError:
+                streamed = False
+        if streamed:
+            if entry is None:
+                return
+            yield entry
+            for line in f:
+                if line.strip() == "}":
+                    return
+                yield _parse_entry(line)
+            return
+    yield from load_json(path).items()
+
+
 def get_preds(nbest_preds_dict, conf=None):
+    """
+    nbest_preds_dict is a {question_id: nbest list} dict or an iterable of (question_id, nbest list)
+    pairs such as iter_json yields
+    """
     results = {}
-    for question_id in nbest_preds_dict:
-        list_of_pred_dicts = nbest_preds_dict[question_id]
+    items = nbest_preds_dict.items() if isinstance(nbest_preds_dict, dict) else nbest_preds_dict
+    for question_id, list_of_pred_dicts in items:
         preds = {}
         for pred_dict in list_of_pred_dicts:
             text = pred_dict["text"]
@@ -55,18 +98,19 @@ def get_answers(test_json_dict):
     return results
 
 
+@lru_cache(maxsize=None)
+def get_words(text):
+    """
+    The word set get_jaccard compares, computed once per distinct answer or prediction string
+    """
+    for token in [".", ",", ";", ":"]:
+        text = text.replace(token, "")
+    return frozenset(text.lower().replace("/", " ").split(" "))
+
+
 def get_jaccard(gt, pred):
-    remove_tokens = [".", ",", ";", ":"]
-    for token in remove_tokens:
-        gt = gt.replace(token, "")
-        pred = pred.replace(token, "")
-    gt = gt.lower()
-    pred = pred.lower()
-    gt = gt.replace("/", " ")
-    pred = pred.replace("/", " ")
-
-    gt_words = set(gt.split(" "))
-    pred_words = set(pred.split(" "))
+    gt_words = get_words(gt)
+    pred_words = get_words(pred)
 
     intersection = gt_words.intersection(pred_words)
     union = gt_words.union(pred_words)
@@ -162,7 +206,7 @@ def get_precisions_recalls(pred_dict, gt_dict, category=None):
     precisions = [1]
     recalls = [0]
     confs = []
-    for conf in list(np.arange(0.99, 0, -0.01)) + [0.001, 0]:
+    for conf in CONFS:
         conf_thresh_pred_dict = get_preds(pred_dict, conf)
         prec, recall = compute_precision_recall(gt_dict, conf_thresh_pred_dict, category=category)
         precisions.append(prec)
@@ -171,6 +215,131 @@ def get_precisions_recalls(pred_dict, gt_dict, category=None):
     return precisions, recalls, confs
 
 
+def get_question_events(key, answers, list_of_pred_dicts):
+    """
+    Reduces one question to the confidences at which compute_precision_recall's counts change,
+    so every threshold (and every category) can be scored without matching answers again.
+    Predictions are deduplicated by text as in get_preds. Returns (answer_confs, fp_confs):
+    each answer is a true positive at conf iff its best matching prediction has probability
+    > conf (-1 if none matches), and each entry of fp_confs is a false positive at conf iff > conf.
+    """
+    preds = {}
+    for pred_dict in list_of_pred_dicts:
+        if not pred_dict["text"] == "":
+            preds[pred_dict["text"]] = pred_dict["probability"]
+
+    if len(answers) == 0:
+        return [], list(preds.values())
+
+    substr_ok = "Parties" in key
+    matched = {pred: False for pred in preds}
+    answer_confs = []
+    for ans in answers:
+        assert len(ans) > 0
+        best = -1
+        for pred, prob in preds.items():
+            if substr_ok:
+                is_match = get_jaccard(ans, pred) >= IOU_THRESH or ans in pred
+            else:
+                is_match = get_jaccard(ans, pred) >= IOU_THRESH
+            if is_match:
+                matched[pred] = True
+                best = max(best, prob)
+        answer_confs.append(best)
+    fp_confs = [prob for pred, prob in preds.items() if not matched[pred]]
+    return answer_confs, fp_confs
+
+
+def _question_events_batch(batch):
+    return [(key, get_question_events(key, answers, nbest)) for key, answers, nbest in batch]
+
+
+def get_all_question_events(pred_dict, gt_dict, workers=1, batch_size=256):
+    """
+    Matches every question's predictions against its answers once, optionally across a process pool.
+    pred_dict is a {question_id: nbest list} dict or an iterable of (question_id, nbest list) pairs,
+    e.g. iter_json(path), so the n-best file never has to be held in memory.
+    Returns {question_id: (answer_confs, fp_confs)}.
+    """
+    items = pred_dict.items() if isinstance(pred_dict, dict) else pred_dict
+    questions = ((key, gt_dict[key], nbest) for key, nbest in items)
+    batches = _batches(questions, batch_size)
+    events = {}
+    if workers > 1:
+        # Executor.map would read the whole stream up front; keep two batches per worker in flight
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            for batch in batches:
+                pending.append(pool.submit(_question_events_batch, batch))
+                if len(pending) >= 2 * workers:
+                    events.update(pending.popleft().result())
+            while pending:
+                events.update(pending.popleft().result())
+    else:
+        for batch in batches:
+            events.update(_question_events_batch(batch))
+    return events
+
+
+def _batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def get_precisions_recalls_from_events(events, category=None):
+    """
+    Same curve as get_precisions_recalls, computed from get_all_question_events output
+    """
+    answer_confs, fp_confs = [], []
+    for key in events:
+        if category and category not in key:
+            continue
+        answer_confs.extend(events[key][0])
+        fp_confs.extend(events[key][1])
+    answer_confs, fp_confs = np.array(answer_confs, dtype=float), np.array(fp_confs, dtype=float)
+
+    precisions = [1]
+    recalls = [0]
+    confs = []
+    for conf in CONFS:
+        tp = int(np.sum(answer_confs > conf))
+        fp = int(np.sum(fp_confs > conf))
+        fn = len(answer_confs) - tp
+        precisions.append(tp / (tp + fp) if tp + fp > 0 else np.nan)
+        recalls.append(tp / (tp + fn) if tp + fn > 0 else np.nan)
+        confs.append(conf)
+    return precisions, recalls, confs
+
+
+def get_category_results(events, categories=None):
+    """
+    AUPR and precision at 80%/90% recall for each category (and "Overall") from one set of events
+    """
+    results = {}
+    for category in list(qtype_dict if categories is None else categories) + [None]:
+        precisions, recalls, confs = get_precisions_recalls_from_events(events, category=category)
+        prec_at_90_recall, _ = get_prec_at_recall(precisions, recalls, confs, recall_thresh=0.9)
+        prec_at_80_recall, _ = get_prec_at_recall(precisions, recalls, confs, recall_thresh=0.8)
+        results[category or "Overall"] = {"aupr": get_aupr(precisions, recalls),
+                                          "prec_at_80_recall": prec_at_80_recall,
+                                          "prec_at_90_recall": prec_at_90_recall}
+    return results
+
+
+def format_category_results(category_results):
+    lines = ["{:<36} {:>6} {:>6} {:>6}".format("Category", "AUPR", "P@80R", "P@90R")]
+    for category, row in category_results.items():
+        lines.append("{:<36} {:>6.3f} {:>6.3f} {:>6.3f}".format(
+            category, row["aupr"], row["prec_at_80_recall"], row["prec_at_90_recall"]))
+    return "\n".join(lines)
+
+
 def get_aupr(precisions, recalls):
     processed_precisions = process_precisions(precisions)
     aupr = metrics.auc(recalls, processed_precisions)
@@ -179,37 +348,48 @@ def get_aupr(precisions, recalls):
     return aupr
 
 
-def get_results(model_path, gt_dict, verbose=False):
+def get_results(model_path, gt_dict, verbose=False, per_category=False, workers=1):
     predictions_path = os.path.join(model_path, "nbest_predictions_.json")
     name = model_path.split("/")[-1]
 
-    pred_dict = load_json(predictions_path)
-
-    assert sorted(list(pred_dict.keys())) == sorted(list(gt_dict.keys()))
+    # Answers are matched against predictions once, streaming the n-best file; every threshold
+    # and category is scored from that
+    events = get_all_question_events(iter_json(predictions_path), gt_dict, workers=workers)
 
-    precisions, recalls, confs = get_precisions_recalls(pred_dict, gt_dict)
-    prec_at_90_recall, _ = get_prec_at_recall(precisions, recalls, confs, recall_thresh=0.9)
-    prec_at_80_recall, _ = get_prec_at_recall(precisions, recalls, confs, recall_thresh=0.8)
-    aupr = get_aupr(precisions, recalls)
+    assert sorted(list(events.keys())) == sorted(list(gt_dict.keys()))
+    category_results = get_category_results(events, categories=qtype_dict if per_category else [])
+    overall = category_results.pop("Overall")
+    aupr, prec_at_80_recall, prec_at_90_recall = overall["aupr"], overall["prec_at_80_recall"], overall["prec_at_90_recall"]
 
     if verbose:
         print("AUPR: {:.3f}, Precision at 80% Recall: {:.3f}, Precision at 90% Recall: {:.3f}".format(aupr, prec_at_80_recall, prec_at_90_recall))
+        if per_category:
+            print(format_category_results(category_results))
 
     # now save results as a dataframe and return
     results = {"name": name, "aupr": aupr, "prec_at_80_recall": prec_at_80_recall, "prec_at_90_recall": prec_at_90_recall}
+    if per_category:
+        results["categories"] = category_results
     return results
 
 
 if __name__ == "__main__":
-    test_json_path = "./data/test.json"
-    model_path = "./trained_models/roberta-base"
-    save_dir = "./results"
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--test_json_path", default="./data/test.json")
+    parser.add_argument("--model_path", default="./trained_models/roberta-base")
+    parser.add_argument("--save_dir", default="./results")
+    parser.add_argument("--per_category", action="store_true", help="Also report AUPR for each of the 41 categories")
+    parser.add_argument("--workers", type=int, default=1, help="Processes used to match predictions to answers")
+    args = parser.parse_args()
+    test_json_path = args.test_json_path
+    model_path = args.model_path
+    save_dir = args.save_dir
     if not os.path.exists(save_dir): os.mkdir(save_dir)
 
     gt_dict = load_json(test_json_path)
     gt_dict = get_answers(gt_dict)
 
-    results = get_results(model_path, gt_dict, verbose=True)
+    results = get_results(model_path, gt_dict, verbose=True, per_category=args.per_category, workers=args.workers)
 
     save_path = os.path.join(save_dir, "{}.json".format(model_path.split("/")[-1]))
     with open(save_path, "w") as f:
@@ -0,0 +1,371 @@
+"""
+Sharded, memory-mapped cache of converted SQuAD/CUAD features.
+
+A cache is a directory with a manifest.json listing shards. Each shard holds
+whole examples: one .npy file per dataset tensor, plus pickled examples and
+features (evaluation only). Tensors are opened with np.load(mmap_mode="r"),
+so opening a cache is instant, batches are read from the page cache on
+demand, and distributed ranks share the same pages instead of each
+unpickling a copy. Examples and features are unpickled a shard at a time
+when first accessed.
+
+Shards store shard-local example indices, feature indices and unique ids;
+they are offset to global values at read time, so shards can be written
+independently and listed by several caches.
+
+build_contract_cache converts a SQuAD-format file one contract per shard.
+Shards live in a shared store keyed by a hash of the contract's JSON and
+every conversion parameter, so editing or adding one contract converts one
+contract, and changing e.g. doc_stride never reuses stale features.
+"""
+
+
+import bisect
+import hashlib
+import json
+import logging
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+import transformers
+from torch.utils.data import Dataset
+from tqdm import tqdm
+from transformers import squad_convert_examples_to_features
+
+
+logger = logging.getLogger(__name__)
+
+
+TRAIN_COLUMNS = (
+    "input_ids",
+    "attention_mask",
+    "token_type_ids",
+    "start_positions",
+    "end_positions",
+    "cls_index",
+    "p_mask",
+    "is_impossible",
+)
+EVAL_COLUMNS = ("input_ids", "attention_mask", "token_type_ids", "feature_index", "cls_index", "p_mask")
+# Per-token feature fields that duplicate the dataset tensors; they are not pickled and are restored as array views
+FEATURE_ARRAY_FIELDS = ("input_ids", "attention_mask", "token_type_ids", "p_mask")
+# squad_convert_examples_to_features numbers features from here
+UNIQUE_ID_START = 1000000000
+MANIFEST = "manifest.json"
+# Bump when the shard layout changes, so that stored contracts are reconverted
+CACHE_FORMAT_VERSION = 1
+
+
+def get_columns(is_training):
+    return TRAIN_COLUMNS if is_training else EVAL_COLUMNS
+
+
+def write_shard(shard_dir, tensors, columns, examples=None, features=None, first_example_index=0):
+    """
+    Writes one shard. tensors are the dataset tensors (in columns order) of exactly the features of examples, whose
+    example_index counts from first_example_index. Examples and features are optional (training).
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    for name, tensor in zip(columns, tensors):
+        array = tensor.numpy() if isinstance(tensor, torch.Tensor) else np.asarray(tensor)
+        if name == "feature_index":
+            array = array - array[:1]  # shard-local
+        np.save(os.path.join(shard_dir, name + ".npy"), array)
+    meta = {"num_features": len(tensors[0]), "num_examples": None}
+    if examples is not None:
+        stripped = []
+        for (feature_index, feature) in enumerate(features):
+            state = {k: v for k, v in vars(feature).items() if k not in FEATURE_ARRAY_FIELDS}
+            state["example_index"] = feature.example_index - first_example_index
+            state["unique_id"] = feature_index
+            stripped.append((type(feature), state))
+        with open(os.path.join(shard_dir, "features.pkl"), "wb") as f:
+            pickle.dump(stripped, f, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(os.path.join(shard_dir, "examples.pkl"), "wb") as f:
+            pickle.dump(list(examples), f, protocol=pickle.HIGHEST_PROTOCOL)
+        meta["num_examples"] = len(examples)
+    # Written last: a shard without meta.json is incomplete
+    with open(os.path.join(shard_dir, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    return meta
+
+
+def read_shard_meta(shard_dir):
+    """Returns the shard's meta.json, or None if the shard is missing or incomplete."""
+    try:
+        with open(os.path.join(shard_dir, "meta.json"), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_manifest(cache_dir, shard_dirs, columns):
+    """Lists shard_dirs (paths relative to cache_dir are kept relative) as the shards of the cache in cache_dir."""
+    os.makedirs(cache_dir, exist_ok=True)
+    shards = []
+    for shard_dir in shard_dirs:
+        meta = read_shard_meta(shard_dir if os.path.isabs(shard_dir) else os.path.join(cache_dir, shard_dir))
+        shards.append(dict(meta, path=shard_dir))
+    manifest_file = os.path.join(cache_dir, MANIFEST)
+    with open(manifest_file + ".tmp", "w") as f:
+        json.dump({"columns": list(columns), "shards": shards}, f, indent=1)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+
+def write_feature_cache(cache_dir, dataset, columns, examples=None, features=None, examples_per_shard=200):
+    """
+    Writes the output of squad_convert_examples_to_features to a sharded cache. Shards hold examples_per_shard
+    whole examples each (or an equal share of the features, without examples).
+    """
+    tensors = dataset.tensors
+    num_features = len(tensors[0])
+    if examples is not None:
+        # Feature ranges of each block of examples; features are ordered by example
+        example_of_feature = np.fromiter((f.example_index for f in features), dtype=np.int64, count=len(features))
+        example_bounds = list(range(0, len(examples), examples_per_shard)) + [len(examples)]
+        feature_bounds = np.searchsorted(example_of_feature, example_bounds).tolist()
+    else:
+        features_per_shard = max(1, examples_per_shard * 64)
+        feature_bounds = list(range(0, num_features, features_per_shard)) + [num_features]
+        example_bounds = None
+    shard_dirs = []
+    for shard in range(len(feature_bounds) - 1):
+        f0, f1 = feature_bounds[shard], feature_bounds[shard + 1]
+        shard_dir = "{:05d}".format(shard)
+        write_shard(
+            os.path.join(cache_dir, shard_dir),
+            [tensor[f0:f1] for tensor in tensors],
+            columns,
+            examples=examples[example_bounds[shard] : example_bounds[shard + 1]] if examples is not None else None,
+            features=features[f0:f1] if examples is not None else None,
+            first_example_index=example_bounds[shard] if examples is not None else 0,
+        )
+        shard_dirs.append(shard_dir)
+    write_manifest(cache_dir, shard_dirs, columns)
+
+
+def has_feature_cache(cache_dir):
+    return os.path.exists(os.path.join(cache_dir, MANIFEST))
+
+
+class FeatureCache:
+    """Read side of a cache directory: shard offsets, memory-mapped tensors and lazily unpickled objects."""
+
+    def __init__(self, cache_dir):
+        with open(os.path.join(cache_dir, MANIFEST), "r") as f:
+            manifest = json.load(f)
+        self.columns = manifest["columns"]
+        self.shard_dirs = [
+            shard["path"] if os.path.isabs(shard["path"]) else os.path.join(cache_dir, shard["path"])
+            for shard in manifest["shards"]
+        ]
+        self.feature_offsets = np.cumsum([0] + [shard["num_features"] for shard in manifest["shards"]]).tolist()
+        self.has_objects = all(shard["num_examples"] is not None for shard in manifest["shards"])
+        self.example_offsets = (
+            np.cumsum([0] + [shard["num_examples"] for shard in manifest["shards"]]).tolist()
+            if self.has_objects
+            else None
+        )
+        # Empty shards (contracts without training features) cannot be memory-mapped
+        self.arrays = [
+            [np.load(os.path.join(shard_dir, name + ".npy"), mmap_mode="r" if shard["num_features"] else None)
+             for name in self.columns]
+            for shard_dir, shard in zip(self.shard_dirs, manifest["shards"])
+        ]
+        self._loaded = {}
+
+    def locate_feature(self, index):
+        shard = bisect.bisect_right(self.feature_offsets, index) - 1
+        return shard, index - self.feature_offsets[shard]
+
+    def load_objects(self, shard, kind):
+        """Unpickles a shard's examples or features, keeping only the most recent shard of each kind."""
+        key = (shard, kind)
+        if key not in self._loaded:
+            self._loaded = {k: v for k, v in self._loaded.items() if k[1] != kind}
+            with open(os.path.join(self.shard_dirs[shard], kind + ".pkl"), "rb") as f:
+                objects = pickle.load(f)
+            if kind == "features":
+                objects = [self._restore_feature(shard, local_index, cls, state)
+                           for local_index, (cls, state) in enumerate(objects)]
+            self._loaded[key] = objects
+        return self._loaded[key]
+
+    def _restore_feature(self, shard, local_index, cls, state):
+        feature = cls.__new__(cls)
+        feature.__dict__.update(state)
+        feature.example_index = state["example_index"] + self.example_offsets[shard]
+        feature.unique_id = UNIQUE_ID_START + self.feature_offsets[shard] + local_index
+        arrays = self.arrays[shard]
+        for name in FEATURE_ARRAY_FIELDS:
+            setattr(feature, name, arrays[self.columns.index(name)][local_index])
+        return feature
+
+    def column(self, name):
+        """One dataset column across all shards as an in-memory array (meant for the small per-feature columns)."""
+        position = self.columns.index(name)
+        parts = [arrays[position] for arrays in self.arrays]
+        if name == "feature_index":
+            parts = [part + offset for part, offset in zip(parts, self.feature_offsets)]
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+
+class MmapFeatureDataset(Dataset):
+    """The TensorDataset of a FeatureCache; each item is copied out of the memory-mapped shard arrays."""
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.feature_index_column = cache.columns.index("feature_index") if "feature_index" in cache.columns else None
+
+    def __len__(self):
+        return self.cache.feature_offsets[-1]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        shard, local_index = self.cache.locate_feature(index)
+        item = [torch.from_numpy(np.array(array[local_index])) for array in self.cache.arrays[shard]]
+        if self.feature_index_column is not None:
+            item[self.feature_index_column] += self.cache.feature_offsets[shard]
+        return tuple(item)
+
+    def column(self, position):
+        """Column position of the dataset tuple as a NumPy array, e.g. the start positions for balancing."""
+        return self.cache.column(self.cache.columns[position])
+
+
+class LazyShardedList:
+    """Read-only list of a cache's examples or features, unpickled one shard at a time."""
+
+    def __init__(self, cache, kind):
+        self.cache = cache
+        self.kind = kind
+        self.offsets = cache.example_offsets if kind == "examples" else cache.feature_offsets
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("{} index out of range".format(self.kind))
+        shard = bisect.bisect_right(self.offsets, index) - 1
+        return self.cache.load_objects(shard, self.kind)[index - self.offsets[shard]]
+
+    def __iter__(self):
+        for shard in range(len(self.offsets) - 1):
+            yield from self.cache.load_objects(shard, self.kind)
+
+
+def load_feature_cache(cache_dir):
+    """
+    Opens a cache written by write_feature_cache.
+    Returns (dataset, examples, features); examples and features are None for caches written without them.
+    """
+    cache = FeatureCache(cache_dir)
+    dataset = MmapFeatureDataset(cache)
+    if not cache.has_objects:
+        return dataset, None, None
+    return dataset, LazyShardedList(cache, "examples"), LazyShardedList(cache, "features")
+
+
+def get_contract_key(entry, conversion_params):
+    """sha256 of a contract's JSON entry together with every parameter that affects its features."""
+    payload = json.dumps(
+        {"contract": entry, "params": conversion_params, "format": CACHE_FORMAT_VERSION}, sort_keys=True
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+_worker = {}
+
+
+def _init_converter(processor, tokenizer, conversion_params):
+    _worker.update(processor=processor, tokenizer=tokenizer, params=conversion_params)
+
+
+def _convert_contract(job):
+    entry, shard_dir = job
+    params = _worker["params"]
+    examples = _worker["processor"]._create_examples([entry], params["set_type"])
+    features, dataset = squad_convert_examples_to_features(
+        examples=examples,
+        tokenizer=_worker["tokenizer"],
+        max_seq_length=params["max_seq_length"],
+        doc_stride=params["doc_stride"],
+        max_query_length=params["max_query_length"],
+        is_training=params["is_training"],
+        return_dataset="pt",
+        threads=1,
+        tqdm_enabled=False,
+    )
+    if params["is_training"]:
+        return write_shard(shard_dir, dataset.tensors, TRAIN_COLUMNS)
+    return write_shard(shard_dir, dataset.tensors, EVAL_COLUMNS, examples, features)
+
+
+def build_contract_cache(
+    cache_prefix,
+    data_file,
+    processor,
+    tokenizer,
+    max_seq_length,
+    doc_stride,
+    max_query_length,
+    is_training,
+    threads=1,
+    overwrite=False,
+):
+    """
+    Converts the contracts of a SQuAD-format data file that are not in the shared contract store yet, in a pool of
+    threads processes, and lists all of the file's contracts in a cache directory cache_prefix + "_" + a digest of
+    their keys (so the directory also identifies the exact dataset).
+    Returns:
+        The cache directory, to open with load_feature_cache.
+    """
+    conversion_params = {
+        "set_type": "train" if is_training else "dev",
+        "is_training": is_training,
+        "max_seq_length": max_seq_length,
+        "doc_stride": doc_stride,
+        "max_query_length": max_query_length,
+        "processor": type(processor).__name__,
+        "tokenizer": tokenizer.name_or_path,
+        "tokenizer_class": type(tokenizer).__name__,
+        "transformers": transformers.__version__,
+    }
+    with open(data_file, "r", encoding="utf-8") as reader:
+        entries = json.load(reader)["data"]
+    keys = [get_contract_key(entry, conversion_params) for entry in entries]
+    store_dir = os.path.join(os.path.dirname(cache_prefix), "contract_features")
+    shard_dirs = [os.path.join(store_dir, key) for key in keys]
+
+    jobs = {}
+    for entry, shard_dir in zip(entries, shard_dirs):
+        if shard_dir not in jobs and (overwrite or read_shard_meta(shard_dir) is None):
+            jobs[shard_dir] = (entry, shard_dir)
+    jobs = list(jobs.values())
+    logger.info("Converting %d of %d contracts in %s (%d processes)", len(jobs), len(entries), data_file, threads)
+    if jobs and threads > 1:
+        with ProcessPoolExecutor(
+            threads, initializer=_init_converter, initargs=(processor, tokenizer, conversion_params)
+        ) as executor:
+            for _ in tqdm(executor.map(_convert_contract, jobs), total=len(jobs), desc="convert contracts"):
+                pass
+    elif jobs:
+        _init_converter(processor, tokenizer, conversion_params)
+        for job in tqdm(jobs, desc="convert contracts"):
+            _convert_contract(job)
+
+    digest = hashlib.sha256("\n".join(keys).encode("utf-8")).hexdigest()
+    cache_dir = "{}_{}".format(cache_prefix, digest[:16])
+    if overwrite or not has_feature_cache(cache_dir):
+        columns = TRAIN_COLUMNS if is_training else EVAL_COLUMNS
+        write_manifest(cache_dir, [os.path.relpath(shard_dir, cache_dir) for shard_dir in shard_dirs], columns)
+    return cache_dir
@@ -0,0 +1,246 @@
+""" CPU inference for a trained CUAD span model, without a GPU or the training loop.
+
+Features come from the same sharded cache as train.py. Compared to train.evaluate, inference here
+- can quantize the model's Linear layers to int8 (dynamic quantization),
+- sorts features into length buckets and trims each batch to its longest feature instead of max_seq_length,
+- sets PyTorch's intra-op and inter-op thread pools explicitly,
+- can skip windows whose text shares few keywords with the question's category (prefilter.py).
+
+Logits of padding positions are -inf, so padding never takes an n-best slot; predictions are otherwise those of
+train.evaluate. Any question answering checkpoint works, e.g. roberta-base to measure throughput.
+"""
+
+
+import argparse
+import json
+import logging
+import os
+import timeit
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from feature_cache import MmapFeatureDataset
+from prefilter import (
+    PREFILTER_LEVELS,
+    format_recall_report,
+    get_feature_examples,
+    get_recall_report,
+    get_window_scores,
+    select_features,
+)
+from train import load_and_cache_examples
+from transformers import AutoConfig, AutoModelForQuestionAnswering, AutoTokenizer
+from utils import FeatureLogits, compute_predictions_logits
+
+
+logger = logging.getLogger(__name__)
+
+# Models whose forward() takes no token_type_ids, as in train.evaluate
+NO_TOKEN_TYPE_MODELS = ["xlm", "roberta", "distilbert", "camembert", "bart", "longformer"]
+
+
+def get_feature_lengths(dataset):
+    """Number of attended tokens of every feature of an evaluation dataset; padding always follows them."""
+    if isinstance(dataset, MmapFeatureDataset):
+        position = dataset.cache.columns.index("attention_mask")
+        parts = [arrays[position].sum(axis=1) for arrays in dataset.cache.arrays if len(arrays[position])]
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+    return dataset.tensors[1].sum(dim=1).numpy()
+
+
+def get_length_buckets(lengths, feature_indices, batch_size):
+    """
+    Splits feature_indices into batches of features of similar length, longest first.
+    Returns a list of (feature indices, longest length) pairs.
+    """
+    feature_indices = np.asarray(feature_indices, dtype=np.int64)
+    order = feature_indices[np.argsort(-lengths[feature_indices], kind="stable")]
+    return [(order[i : i + batch_size], int(lengths[order[i]])) for i in range(0, len(order), batch_size)]
+
+
+def predict_logits(args, model, dataset, feature_indices):
+    """
+    Runs model over the features feature_indices of an evaluation dataset in length buckets.
+    Returns a FeatureLogits whose row i holds the logits of feature feature_indices[i].
+    """
+    feature_indices = np.asarray(feature_indices, dtype=np.int64)
+    row_of_feature = np.full(len(dataset), -1, dtype=np.int64)
+    row_of_feature[feature_indices] = np.arange(len(feature_indices))
+    all_results = FeatureLogits(
+        np.full((len(feature_indices), args.max_seq_length), -np.inf, dtype=np.float32),
+        np.full((len(feature_indices), args.max_seq_length), -np.inf, dtype=np.float32),
+    )
+
+    buckets = get_length_buckets(get_feature_lengths(dataset), feature_indices, args.batch_size)
+    dataloader = DataLoader(dataset, batch_sampler=[indices.tolist() for indices, _ in buckets])
+
+    model.eval()
+    with torch.no_grad():
+        for (_, length), batch in zip(tqdm(buckets, desc="Predicting"), dataloader):
+            inputs = {
+                "input_ids": batch[0][:, :length],
+                "attention_mask": batch[1][:, :length],
+                "token_type_ids": batch[2][:, :length],
+            }
+            if args.model_type in NO_TOKEN_TYPE_MODELS:
+                del inputs["token_type_ids"]
+            outputs = model(**inputs)
+
+            # Padding gets -inf whether or not it was trimmed, so results do not depend on the batching
+            attended = batch[1][:, :length].numpy().astype(bool)
+            rows = row_of_feature[batch[3].numpy()]
+            all_results.start_logits[rows, :length] = np.where(attended, outputs[0].numpy(), -np.inf)
+            all_results.end_logits[rows, :length] = np.where(attended, outputs[1].numpy(), -np.inf)
+    return all_results
+
+
+def load_model(args):
+    """Loads the tokenizer and model for CPU inference, quantized if args.quantize."""
+    config = AutoConfig.from_pretrained(args.model_name_or_path, cache_dir=args.cache_dir if args.cache_dir else None)
+    tokenizer = AutoTokenizer.from_pretrained(
+        args.tokenizer_name if args.tokenizer_name else args.model_name_or_path,
+        do_lower_case=args.do_lower_case,
+        cache_dir=args.cache_dir if args.cache_dir else None,
+        use_fast=False,  # SquadDataset is not compatible with Fast tokenizers which have a smarter overflow handeling
+    )
+    model = AutoModelForQuestionAnswering.from_pretrained(
+        args.model_name_or_path, config=config, cache_dir=args.cache_dir if args.cache_dir else None
+    )
+    model.eval()
+    if args.quantize:
+        # int8 weights, activations quantized on the fly; the Linear layers dominate transformer inference on CPU
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    args.model_type = config.model_type
+    return tokenizer, model
+
+
+def set_threads(args):
+    # The inter-op pool can only be sized before PyTorch runs any parallel work
+    if args.inter_op_threads > 0:
+        torch.set_num_interop_threads(args.inter_op_threads)
+    if args.intra_op_threads > 0:
+        torch.set_num_threads(args.intra_op_threads)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model_name_or_path",
+        default=None,
+        type=str,
+        required=True,
+        help="Path to a trained question answering model or model identifier from huggingface.co/models",
+    )
+    parser.add_argument(
+        "--predict_file",
+        default=None,
+        type=str,
+        required=True,
+        help="The input SQuAD-format file. If a data dir is specified, will look for the file there",
+    )
+    parser.add_argument(
+        "--output_dir", default=None, type=str, required=True, help="The output directory for the predictions."
+    )
+    parser.add_argument("--data_dir", default=None, type=str, help="The input data dir.")
+    parser.add_argument(
+        "--tokenizer_name", default="", type=str, help="Pretrained tokenizer name or path if not the same as model"
+    )
+    parser.add_argument("--cache_dir", default="", type=str, help="Where to store models and feature caches")
+    parser.add_argument("--version_2_with_negative", action="store_true", help="Some examples have no answer.")
+    parser.add_argument(
+        "--null_score_diff_threshold",
+        type=float,
+        default=0.0,
+        help="If null_score - best_non_null is greater than the threshold predict null.",
+    )
+    parser.add_argument("--max_seq_length", default=384, type=int, help="Maximum total input sequence length.")
+    parser.add_argument("--doc_stride", default=128, type=int, help="Stride between chunks of a long document.")
+    parser.add_argument("--max_query_length", default=64, type=int, help="Maximum number of question tokens.")
+    parser.add_argument("--do_lower_case", action="store_true", help="Set this flag if you use an uncased model.")
+    parser.add_argument("--batch_size", default=32, type=int, help="Features per batch (within a length bucket).")
+    parser.add_argument("--n_best_size", default=20, type=int, help="The total number of n-best predictions.")
+    parser.add_argument("--max_answer_length", default=30, type=int, help="The maximum length of an answer.")
+    parser.add_argument("--verbose_logging", action="store_true", help="Print warnings about unalignable answers.")
+    parser.add_argument("--quantize", action="store_true", help="Apply int8 dynamic quantization to Linear layers.")
+    parser.add_argument(
+        "--intra_op_threads", type=int, default=0, help="Threads within one op; 0 keeps PyTorch's default."
+    )
+    parser.add_argument(
+        "--inter_op_threads", type=int, default=0, help="Threads running independent ops; 0 keeps PyTorch's default."
+    )
+    parser.add_argument(
+        "--prefilter_keep",
+        type=float,
+        default=1.0,
+        help="Fraction of each question's windows to run the model on, the best by category keyword score.",
+    )
+    parser.add_argument(
+        "--prefilter_report",
+        action="store_true",
+        help="Report the gold-answer recall of the keyword pre-filter at several keep fractions.",
+    )
+    parser.add_argument("--threads", type=int, default=1, help="number of processes converting contracts to features")
+    parser.add_argument("--overwrite_cache", action="store_true", help="Reconvert the features")
+    args = parser.parse_args()
+    # load_and_cache_examples runs as a single, non-distributed process
+    args.local_rank = -1
+
+    set_threads(args)
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    logger.info("Threads: %d intra-op, %d inter-op", torch.get_num_threads(), torch.get_num_interop_threads())
+
+    tokenizer, model = load_model(args)
+    dataset, examples, features = load_and_cache_examples(args, tokenizer, evaluate=True, output_examples=True)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    feature_indices = np.arange(len(dataset))
+    if args.prefilter_keep < 1 or args.prefilter_report:
+        scores = get_window_scores(examples, features)
+        if args.prefilter_report:
+            levels = sorted(set(PREFILTER_LEVELS) | {args.prefilter_keep}, reverse=True)
+            report = get_recall_report(examples, features, scores, levels)
+            logger.info("Pre-filter recall of gold answers by keep fraction:\n%s", format_recall_report(report))
+            with open(os.path.join(args.output_dir, "prefilter_recall.json"), "w") as f:
+                json.dump(report, f, indent=4)
+        feature_indices = select_features(get_feature_examples(features), scores, args.prefilter_keep)
+        logger.info("  Pre-filter keeps %d of %d windows", len(feature_indices), len(dataset))
+
+    start_time = timeit.default_timer()
+    all_results = predict_logits(args, model, dataset, feature_indices)
+    eval_time = timeit.default_timer() - start_time
+    logger.info(
+        "  Inference done in %f secs (%f features per sec)", eval_time, len(feature_indices) / max(eval_time, 1e-9)
+    )
+    if len(feature_indices) < len(dataset):
+        # Pruned windows are left out of postprocessing; the logit rows follow the kept features
+        features = [features[feature_index] for feature_index in feature_indices]
+
+    with open(os.path.join(args.data_dir or "", args.predict_file), "r") as f:
+        json_test_dict = json.load(f)
+    compute_predictions_logits(
+        json_test_dict,
+        examples,
+        features,
+        all_results,
+        args.n_best_size,
+        args.max_answer_length,
+        args.do_lower_case,
+        os.path.join(args.output_dir, "predictions.json"),
+        os.path.join(args.output_dir, "nbest_predictions.json"),
+        os.path.join(args.output_dir, "null_odds.json") if args.version_2_with_negative else None,
+        args.verbose_logging,
+        args.version_2_with_negative,
+        args.null_score_diff_threshold,
+        tokenizer,
+    )
+
+
+if __name__ == "__main__":
+    main()
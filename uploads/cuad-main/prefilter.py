@@ -0,0 +1,168 @@
+"""
+Lexical pre-filter over the doc_stride windows of CUAD contracts.
+
+Every contract is split into windows (features), and the span model scores each window for each of the 41
+questions, although most windows hold no answer to most questions. This module scores each (window, question)
+pair by the category's keywords that occur in the window. The keywords come from the category name and
+description in category_descriptions.csv, and each is weighted by how few categories share it. Inference can
+then run the span model only on the best-scoring fraction of every question's windows.
+
+get_recall_report measures what each pruning level costs: the share of gold answers that are still inside a
+kept window, relative to all windows.
+"""
+
+
+import math
+import re
+
+import numpy as np
+
+from evaluate import get_questions_from_csv
+
+
+PREFILTER_LEVELS = (1.0, 0.75, 0.5, 0.3, 0.2, 0.1, 0.05)
+STOPWORDS = frozenset(
+    "a an and any are as at be been by can does for from has have if in into is it its may of on or other such "
+    "that the their them there these this those to under upon was were what when where whether which who will "
+    "with within without would contract agreement party parties".split()
+)
+STEM_LENGTH = 6
+
+
+def get_stems(text):
+    """Lowercase word stems of text: words cut to STEM_LENGTH letters, stopwords and short words dropped."""
+    words = re.findall(r"[a-z]+", text.lower())
+    return {word[:STEM_LENGTH] for word in words if len(word) > 2 and word not in STOPWORDS}
+
+
+def get_category_keywords():
+    """
+    Returns:
+        dict: {lowercase category: {stem: weight}}, weighted log(1 + categories / categories using the stem).
+    """
+    stems = {category.lower(): get_stems(category + " " + description)
+             for category, description in get_questions_from_csv().items()}
+    usage = {}
+    for category_stems in stems.values():
+        for stem in category_stems:
+            usage[stem] = usage.get(stem, 0) + 1
+    return {
+        category: {stem: math.log(1 + len(stems) / usage[stem]) for stem in category_stems}
+        for category, category_stems in stems.items()
+    }
+
+
+def get_question_keywords(example, category_keywords):
+    # CUAD question ids end in "__<category>"; other questions fall back to their own words
+    category = example.qas_id.split("__")[-1].lower()
+    if category in category_keywords:
+        return category_keywords[category]
+    return {stem: 1.0 for stem in get_stems(example.question_text)}
+
+
+def get_window_range(feature):
+    """First and last word (example.doc_tokens index) of a feature's window."""
+    positions = feature.token_to_orig_map.values()
+    return min(positions), max(positions)
+
+
+def get_window_scores(examples, features, category_keywords=None):
+    """
+    Returns:
+        np.ndarray: The keyword score of every feature's window for its own question.
+    """
+    if category_keywords is None:
+        category_keywords = get_category_keywords()
+    scores = np.zeros(len(features), dtype=np.float64)
+    window_stems = {}  # questions of one contract mostly share their windows
+    for (feature_index, feature) in enumerate(features):
+        example = examples[feature.example_index]
+        keywords = get_question_keywords(example, category_keywords)
+        start, end = get_window_range(feature)
+        key = (example.title, start, end)
+        if key not in window_stems:
+            if len(window_stems) > 100000:
+                window_stems.clear()
+            window_stems[key] = get_stems(" ".join(example.doc_tokens[start : end + 1]))
+        scores[feature_index] = sum(keywords.get(stem, 0.0) for stem in window_stems[key])
+    return scores
+
+
+def get_feature_examples(features):
+    """The example_index of every feature as an array."""
+    return np.fromiter((feature.example_index for feature in features), dtype=np.int64, count=len(features))
+
+
+def select_features(feature_examples, scores, keep_frac):
+    """
+    Keeps the best-scoring keep_frac of every example's windows, at least one; ties keep the earlier window.
+    Args:
+        feature_examples: get_feature_examples of the features.
+        scores: get_window_scores of the features.
+    Returns:
+        np.ndarray: The kept feature indices, in order.
+    """
+    if keep_frac >= 1:
+        return np.arange(len(feature_examples))
+    # Rank windows within each example, best first
+    order = np.lexsort((np.arange(len(feature_examples)), -scores, feature_examples))
+    sorted_examples = feature_examples[order]
+    example_starts = np.flatnonzero(np.r_[True, sorted_examples[1:] != sorted_examples[:-1]])
+    counts = np.diff(np.r_[example_starts, len(order)])
+    rank = np.arange(len(order)) - np.repeat(example_starts, counts)
+    keep = np.maximum(1, np.ceil(keep_frac * counts)).astype(np.int64)
+    return np.sort(order[rank < np.repeat(keep, counts)])
+
+
+def get_answer_ranges(example):
+    """First and last word of each gold answer of an example."""
+    ranges = []
+    for answer in example.answers:
+        start = answer["answer_start"]
+        end = min(start + len(answer["text"]), len(example.char_to_word_offset)) - 1
+        ranges.append((example.char_to_word_offset[start], example.char_to_word_offset[end]))
+    return ranges
+
+
+def get_recall_report(examples, features, scores, levels=PREFILTER_LEVELS):
+    """
+    Recall of the gold answers at each keep fraction. An answer counts when one kept window contains it entirely;
+    recall is relative to answers contained in any window.
+    Returns:
+        list: One dict per level with keep_frac, windows (kept), windows_frac, answers and recall.
+    """
+    answer_ranges = [get_answer_ranges(example) for example in examples]
+    # (feature, answer) containment pairs
+    pair_features, pair_answers = [], []
+    answer_ids = {}
+    for (feature_index, feature) in enumerate(features):
+        start, end = get_window_range(feature)
+        for (answer_index, (answer_start, answer_end)) in enumerate(answer_ranges[feature.example_index]):
+            if start <= answer_start and answer_end <= end:
+                pair_features.append(feature_index)
+                pair_answers.append(answer_ids.setdefault((feature.example_index, answer_index), len(answer_ids)))
+    pair_features = np.asarray(pair_features, dtype=np.int64)
+    pair_answers = np.asarray(pair_answers, dtype=np.int64)
+
+    feature_examples = get_feature_examples(features)
+    report = []
+    for keep_frac in levels:
+        kept = np.zeros(len(features), dtype=bool)
+        kept[select_features(feature_examples, scores, keep_frac)] = True
+        found = np.unique(pair_answers[kept[pair_features]])
+        report.append({
+            "keep_frac": keep_frac,
+            "windows": int(kept.sum()),
+            "windows_frac": float(kept.mean()) if len(features) else 0.0,
+            "answers": len(answer_ids),
+            "recall": len(found) / len(answer_ids) if answer_ids else 1.0,
+        })
+    return report
+
+
+def format_recall_report(report):
+    lines = ["{:>9} {:>10} {:>8} {:>8}".format("keep_frac", "windows", "share", "recall")]
+    for row in report:
+        lines.append("{:>9.2f} {:>10d} {:>8.3f} {:>8.3f}".format(
+            row["keep_frac"], row["windows"], row["windows_frac"], row["recall"]))
+    return "\n".join(lines)
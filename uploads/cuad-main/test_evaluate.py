@@ -0,0 +1,86 @@
+import json
+import random
+
+import numpy as np
+
+import evaluate
+import utils
+
+WORDS = "the licensee shall pay royalties within thirty days of each quarter to licensor in new york".split()
+
+
+def make_data(num_contracts=6, seed=0):
+    rng = random.Random(seed)
+    gt_dict, pred_dict = {}, {}
+    for c in range(num_contracts):
+        for category in evaluate.qtype_dict:
+            key = "Contract{}__{}".format(c, category)
+            answers = [" ".join(rng.choices(WORDS, k=rng.randint(2, 8))) + rng.choice(["", ".", ";"])
+                       for _ in range(rng.choice([0, 0, 1, 2, 3]))]
+            nbest = []
+            for _ in range(rng.randint(0, 8)):
+                kind = rng.random()
+                if kind < 0.3 and answers:
+                    text = rng.choice(answers).upper()  # matches after normalization
+                elif kind < 0.4 and answers:
+                    text = rng.choice(answers) + " and more words around it"  # substring match
+                elif kind < 0.5:
+                    text = ""
+                else:
+                    text = " ".join(rng.choices(WORDS, k=rng.randint(1, 8)))
+                # two-decimal probabilities land exactly on the swept thresholds
+                nbest.append({"text": text, "probability": round(rng.random(), 2)})
+            if nbest and rng.random() < 0.3:
+                nbest.append(dict(nbest[0], probability=round(rng.random(), 2)))  # duplicate text
+            gt_dict[key] = answers
+            pred_dict[key] = nbest
+    return gt_dict, pred_dict
+
+
+def test_single_pass_matches_per_threshold_scoring():
+    gt_dict, pred_dict = make_data()
+    events = evaluate.get_all_question_events(pred_dict, gt_dict)
+    for category in list(evaluate.qtype_dict) + [None]:
+        expected = evaluate.get_precisions_recalls(pred_dict, gt_dict, category=category)
+        actual = evaluate.get_precisions_recalls_from_events(events, category=category)
+        for expected_values, actual_values in zip(expected, actual):
+            np.testing.assert_array_equal(np.array(actual_values, dtype=float), np.array(expected_values, dtype=float))
+        assert evaluate.get_aupr(actual[0], actual[1]) == evaluate.get_aupr(expected[0], expected[1])
+
+
+def test_category_results_match_per_category_aupr():
+    gt_dict, pred_dict = make_data(seed=1)
+    table = evaluate.get_category_results(evaluate.get_all_question_events(pred_dict, gt_dict, workers=2))
+    for category in evaluate.qtype_dict:
+        precisions, recalls, _ = evaluate.get_precisions_recalls(pred_dict, gt_dict, category=category)
+        assert table[category]["aupr"] == evaluate.get_aupr(precisions, recalls)
+    precisions, recalls, _ = evaluate.get_precisions_recalls(pred_dict, gt_dict)
+    assert table["Overall"]["aupr"] == evaluate.get_aupr(precisions, recalls)
+
+
+def test_iter_json_streams_writer_output(tmp_path):
+    _, pred_dict = make_data(num_contracts=2, seed=2)
+    pred_dict["odd, key: with \"quotes\"\n"] = [{"text": "a,\nb", "probability": 0.5}]
+    streamed, indented = tmp_path / "nbest.json", tmp_path / "nbest_indented.json"
+    with utils.JsonStreamWriter(str(streamed)) as writer:
+        for key, nbest in pred_dict.items():
+            writer.write(key, nbest)
+    indented.write_text(json.dumps(pred_dict, indent=4) + "\n")
+
+    assert evaluate.load_json(str(streamed)) == pred_dict
+    assert list(evaluate.iter_json(str(streamed))) == list(pred_dict.items())
+    assert list(evaluate.iter_json(str(indented))) == list(pred_dict.items())
+    with utils.JsonStreamWriter(str(streamed)):
+        pass
+    assert list(evaluate.iter_json(str(streamed))) == [] and evaluate.load_json(str(streamed)) == {}
+
+
+def test_json_stream_writer_leaves_no_file_on_error(tmp_path):
+    path = tmp_path / "nbest.json"
+    try:
+        with utils.JsonStreamWriter(str(path)) as writer:
+            writer.write("a", [])
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,109 @@
+import random
+from types import SimpleNamespace
+
+import utils
+
+
+def reference_best_indexes(logits, n_best_size):
+    """_get_best_indexes before vectorization."""
+    index_and_score = sorted(enumerate(logits), key=lambda x: x[1], reverse=True)
+    return [index for index, _ in index_and_score[:n_best_size]]
+
+
+def reference_prelim_predictions(features, unique_id_to_result, n_best_size, max_answer_length, version_2_with_negative):
+    """The nested n-best loop of compute_predictions_logits before vectorization."""
+    prelim_predictions = []
+    score_null = 1000000
+    min_null_feature_index = 0
+    null_start_logit = 0
+    null_end_logit = 0
+    for (feature_index, feature) in enumerate(features):
+        result = unique_id_to_result[feature.unique_id]
+        start_indexes = reference_best_indexes(result.start_logits, n_best_size)
+        end_indexes = reference_best_indexes(result.end_logits, n_best_size)
+        if version_2_with_negative:
+            feature_null_score = result.start_logits[0] + result.end_logits[0]
+            if feature_null_score < score_null:
+                score_null = feature_null_score
+                min_null_feature_index = feature_index
+                null_start_logit = result.start_logits[0]
+                null_end_logit = result.end_logits[0]
+        for start_index in start_indexes:
+            for end_index in end_indexes:
+                if start_index >= len(feature.tokens):
+                    continue
+                if end_index >= len(feature.tokens):
+                    continue
+                if start_index not in feature.token_to_orig_map:
+                    continue
+                if end_index not in feature.token_to_orig_map:
+                    continue
+                if not feature.token_is_max_context.get(start_index, False):
+                    continue
+                if end_index < start_index:
+                    continue
+                length = end_index - start_index + 1
+                if length > max_answer_length:
+                    continue
+                prelim_predictions.append(
+                    utils._PrelimPrediction(
+                        feature_index=feature_index,
+                        start_index=start_index,
+                        end_index=end_index,
+                        start_logit=result.start_logits[start_index],
+                        end_logit=result.end_logits[end_index],
+                    )
+                )
+    if version_2_with_negative:
+        prelim_predictions.append(
+            utils._PrelimPrediction(
+                feature_index=min_null_feature_index,
+                start_index=0,
+                end_index=0,
+                start_logit=null_start_logit,
+                end_logit=null_end_logit,
+            )
+        )
+    prelim_predictions = sorted(prelim_predictions, key=lambda x: (x.start_logit + x.end_logit), reverse=True)
+    return prelim_predictions, score_null, null_start_logit, null_end_logit
+
+
+def make_features(rng, num_features, seq_length=64, question_length=8):
+    features, results = [], {}
+    for unique_id in range(num_features):
+        num_tokens = rng.randint(question_length + 4, seq_length)
+        context = range(question_length + 2, num_tokens - 1)
+        features.append(SimpleNamespace(
+            unique_id=unique_id,
+            tokens=["tok"] * num_tokens,
+            token_to_orig_map={i: i - question_length for i in context},
+            token_is_max_context={i: rng.random() < 0.8 for i in context},
+        ))
+        # Coarse logits produce plenty of ties, in the n-best cut-off and in span scores
+        results[unique_id] = SimpleNamespace(
+            start_logits=[rng.randint(-20, 20) / 4 for _ in range(seq_length)],
+            end_logits=[rng.randint(-20, 20) / 4 for _ in range(seq_length)],
+        )
+    return features, results
+
+
+def test_best_indexes_match_full_sort():
+    rng = random.Random(0)
+    for _ in range(200):
+        logits = [rng.randint(-5, 5) / 2 for _ in range(rng.randint(1, 50))]
+        for n_best_size in (0, 1, 5, 20, 60):
+            assert utils._get_best_indexes(logits, n_best_size) == reference_best_indexes(logits, n_best_size)
+
+
+def test_prelim_predictions_bit_identical_to_loop():
+    rng = random.Random(1)
+    for _ in range(50):
+        features, results = make_features(rng, rng.randint(0, 6))
+        for version_2_with_negative in (True, False):
+            args = (features, results, rng.choice([1, 5, 20]), rng.choice([1, 10, 512]), version_2_with_negative)
+            prelim, *null = utils._get_prelim_predictions(*args)
+            expected, *expected_null = reference_prelim_predictions(*args)
+            prelim = list(prelim)
+            assert prelim == expected
+            assert [tuple(map(type, p)) for p in prelim] == [tuple(map(type, p)) for p in expected]
+            assert null == expected_null
@@ -41,11 +41,20 @@ from transformers import (
     get_linear_schedule_with_warmup,
     squad_convert_examples_to_features,
 )
+from feature_cache import (
+    MmapFeatureDataset,
+    build_contract_cache,
+    get_columns,
+    has_feature_cache,
+    load_feature_cache,
+    write_feature_cache,
+)
 from utils import (
+    FeatureLogits,
     compute_predictions_logits,
     squad_evaluate,
 )
-from transformers.data.processors.squad import SquadResult, SquadV1Processor, SquadV2Processor
+from transformers.data.processors.squad import SquadV1Processor, SquadV2Processor
 from transformers.trainer_utils import is_main_process
 
 
@@ -75,46 +84,58 @@ def to_list(tensor):
 
 def get_dataset_pos_mask(dataset):
     """
-    Returns a list, pos_mask, where pos_mask[i] indicates is True if the ith example in the dataset is positive
+    Returns a boolean array, pos_mask, where pos_mask[i] is True if the ith example in the dataset is positive
     (i.e. it contains some text that should be highlighted) and False otherwise.
+    Reads the start/end position columns in bulk instead of indexing the dataset example by example.
+    """
+    start_positions = get_dataset_column(dataset, 3)
+    end_positions = get_dataset_column(dataset, 4)
+    return end_positions > start_positions
+
+
+def get_dataset_column(dataset, position):
+    """
+    Returns column position of a TensorDataset or of a memory-mapped feature cache dataset as a NumPy array.
     """
-    pos_mask = []
-    for i in range(len(dataset)):
-        ex = dataset[i]
-        start_pos = ex[3]
-        end_pos = ex[4]
-        is_positive = end_pos > start_pos
-        pos_mask.append(is_positive)
-    return pos_mask
+    if isinstance(dataset, MmapFeatureDataset):
+        return dataset.column(position)
+    return np.asarray(dataset.tensors[position])
 
 
-def get_random_subset(dataset, keep_frac=1):
+def get_random_subset(dataset, keep_frac=1, seed=None):
     """
     Takes a random subset of dataset, where a keep_frac fraction is kept.
     """
-    keep_indices = [i for i in range(len(dataset)) if np.random.random() < keep_frac]
-    subset_dataset = torch.utils.data.Subset(dataset, keep_indices)
+    rng = np.random.default_rng(seed)
+    keep_indices = np.flatnonzero(rng.random(len(dataset)) < keep_frac)
+    subset_dataset = torch.utils.data.Subset(dataset, keep_indices.tolist())
     return subset_dataset
 
 
-def get_balanced_dataset(dataset):
+def get_balanced_indices(dataset, neg_pos_ratio=1.0, seed=None):
     """
-    returns a new dataset, where positive and negative examples are approximately balanced
+    Returns the sorted indices of a subset of dataset that keeps every positive example and, in expectation,
+    neg_pos_ratio negative examples per positive one (all negatives if there are fewer than that).
     """
     pos_mask = get_dataset_pos_mask(dataset)
-    neg_mask = [~mask for mask in pos_mask]
-    npos, nneg = np.sum(pos_mask), np.sum(neg_mask)
+    npos = int(pos_mask.sum())
+    nneg = len(pos_mask) - npos
+    neg_keep_frac = min(1.0, neg_pos_ratio * npos / nneg) if nneg else 0.0
 
-    neg_keep_frac = npos / nneg  # So that in expectation there will be npos negative examples (--> balanced)
-    neg_keep_mask = [mask and np.random.random() < neg_keep_frac for mask in neg_mask]
+    rng = np.random.default_rng(seed)
+    keep_mask = pos_mask | (rng.random(len(pos_mask)) < neg_keep_frac)
+    return np.flatnonzero(keep_mask)
 
-    # keep all positive examples and subset of negative examples
-    keep_mask = [pos_mask[i] or neg_keep_mask[i] for i in range(len(pos_mask))]
-    keep_indices = [i for i in range(len(keep_mask)) if keep_mask[i]]
 
-    subset_dataset = torch.utils.data.Subset(dataset, keep_indices)
+def get_balanced_dataset(dataset, neg_pos_ratio=1.0, seed=None):
+    """
+    returns a new dataset, where positive and negative examples are approximately balanced
+    """
+    keep_indices = get_balanced_indices(dataset, neg_pos_ratio=neg_pos_ratio, seed=seed)
+    subset_dataset = torch.utils.data.Subset(dataset, keep_indices.tolist())
     return subset_dataset
 
+
 def train(args, train_dataset, model, tokenizer):
     """ Train the model """
     if args.local_rank in [-1, 0]:
@@ -122,7 +143,7 @@ def train(args, train_dataset, model, tokenizer):
 
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)
     if args.keep_frac < 1:
-        train_dataset = get_random_subset(train_dataset, keep_frac=args.keep_frac)
+        train_dataset = get_random_subset(train_dataset, keep_frac=args.keep_frac, seed=args.seed)
 
     train_sampler = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
     train_dataloader = DataLoader(train_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
@@ -331,7 +352,11 @@ def evaluate(args, model, tokenizer, prefix=""):
     logger.info("  Num examples = %d", len(dataset))
     logger.info("  Batch size = %d", args.eval_batch_size)
 
-    all_results = []
+    # Logits go straight into contiguous arrays indexed by feature, which postprocessing reads in place
+    all_results = FeatureLogits(
+        np.empty((len(features), args.max_seq_length), dtype=np.float32),
+        np.empty((len(features), args.max_seq_length), dtype=np.float32),
+    )
     start_time = timeit.default_timer()
 
     for batch in tqdm(eval_dataloader, desc="Evaluating"):
@@ -348,42 +373,15 @@ def evaluate(args, model, tokenizer, prefix=""):
             if args.model_type in ["xlm", "roberta", "distilbert", "camembert", "bart", "longformer"]:
                 del inputs["token_type_ids"]
 
-            feature_indices = batch[3]
+            feature_indices = batch[3].cpu().numpy()
 
             # XLNet and XLM use more arguments for their predictions
             if args.model_type in ["xlnet", "xlm"]:
                 raise NotImplementedError
             outputs = model(**inputs)
 
-        for i, feature_index in enumerate(feature_indices):
-            eval_feature = features[feature_index.item()]
-            unique_id = int(eval_feature.unique_id)
-
-            output = [to_list(output[i]) for output in outputs.to_tuple()]
-
-            # Some models (XLNet, XLM) use 5 arguments for their predictions, while the other "simpler"
-            # models only use two.
-            if len(output) >= 5:
-                start_logits = output[0]
-                start_top_index = output[1]
-                end_logits = output[2]
-                end_top_index = output[3]
-                cls_logits = output[4]
-
-                result = SquadResult(
-                    unique_id,
-                    start_logits,
-                    end_logits,
-                    start_top_index=start_top_index,
-                    end_top_index=end_top_index,
-                    cls_logits=cls_logits,
-                )
-
-            else:
-                start_logits, end_logits = output
-                result = SquadResult(unique_id, start_logits, end_logits)
-
-            all_results.append(result)
+        all_results.start_logits[feature_indices] = outputs[0].detach().cpu().numpy()
+        all_results.end_logits[feature_indices] = outputs[1].detach().cpu().numpy()
 
     evalTime = timeit.default_timer() - start_time
     logger.info("  Evaluation done in total %f secs (%f sec per example)", evalTime, evalTime / len(dataset))
@@ -431,7 +429,7 @@ def load_and_cache_examples(args, tokenizer, evaluate=False, output_examples=Fal
 
     # Load data features from cache or dataset file
     input_dir = args.data_dir if args.data_dir else "."
-    cached_features_file = os.path.join(
+    cache_prefix = os.path.join(
         args.cache_dir,
         "cached_{}_{}_{}".format(
             "dev" if evaluate else "train",
@@ -439,40 +437,18 @@ def load_and_cache_examples(args, tokenizer, evaluate=False, output_examples=Fal
             str(args.max_seq_length),
         ),
     )
-    subset_cached_features_file = os.path.join(
-        args.cache_dir,
-        "balanced_subset_cached_{}_{}_{}".format(
-            "dev" if evaluate else "train",
-            list(filter(None, args.model_name_or_path.split("/"))).pop(),
-            str(args.max_seq_length),
-        ),
-    )
-    print(subset_cached_features_file)
+    # Only the first process reconverts; the others wait for it and reuse its cache
+    overwrite_cache = args.overwrite_cache and args.local_rank in [-1, 0]
 
-    # Init features and dataset from cache if it exists
-    if os.path.exists(subset_cached_features_file) and not args.overwrite_cache:
-        logger.info("Loading features from balanced cached file %s", subset_cached_features_file)
-        dataset = torch.load(subset_cached_features_file)["dataset"]
-        features, examples = None, None
-    elif os.path.exists(cached_features_file) and not args.overwrite_cache:
-        logger.info("Loading features from cached file %s", cached_features_file)
-        features_and_dataset = torch.load(cached_features_file)
-        if evaluate:
-            features, dataset, examples = (
-                features_and_dataset["features"],
-                features_and_dataset["dataset"],
-                features_and_dataset["examples"],
-            )
+    if not args.data_dir and ((evaluate and not args.predict_file) or (not evaluate and not args.train_file)):
+        # tensorflow_datasets examples have no contract file to key by, so they are cached as a whole
+        cached_features_dir = cache_prefix
+        if has_feature_cache(cached_features_dir) and not overwrite_cache:
+            # Memory-mapped: nothing is read until batches, examples or features are accessed
+            logger.info("Opening features from cache directory %s", cached_features_dir)
+            dataset, examples, features = load_feature_cache(cached_features_dir)
         else:
-            dataset = features_and_dataset["dataset"]
-            dataset = get_balanced_dataset(dataset)
-            if args.local_rank in [-1, 0]:
-                logger.info("Saving balanced dataset into cached file %s", subset_cached_features_file)
-                torch.save({"dataset": dataset}, subset_cached_features_file)
-    else:
-        logger.info("Creating features from dataset file at %s", input_dir)
-
-        if not args.data_dir and ((evaluate and not args.predict_file) or (not evaluate and not args.train_file)):
+            logger.info("Creating features from dataset file at %s", input_dir)
             try:
                 import tensorflow_datasets as tfds
             except ImportError:
@@ -483,33 +459,65 @@ def load_and_cache_examples(args, tokenizer, evaluate=False, output_examples=Fal
 
             tfds_examples = tfds.load("squad")
             examples = SquadV1Processor().get_examples_from_dataset(tfds_examples, evaluate=evaluate)
-        else:
-            processor = SquadV2Processor() if args.version_2_with_negative else SquadV1Processor()
-            if evaluate:
-                examples = processor.get_dev_examples(args.data_dir, filename=args.predict_file)
-            else:
-                examples = processor.get_train_examples(args.data_dir, filename=args.train_file)
 
-        features, dataset = squad_convert_examples_to_features(
-            examples=examples,
-            tokenizer=tokenizer,
+            features, dataset = squad_convert_examples_to_features(
+                examples=examples,
+                tokenizer=tokenizer,
+                max_seq_length=args.max_seq_length,
+                doc_stride=args.doc_stride,
+                max_query_length=args.max_query_length,
+                is_training=not evaluate,
+                return_dataset="pt",
+                threads=args.threads,
+            )
+
+            if args.local_rank in [-1, 0]:
+                logger.info("Saving features into cache directory %s", cached_features_dir)
+                if evaluate:
+                    write_feature_cache(cached_features_dir, dataset, get_columns(False), examples, features)
+                else:
+                    write_feature_cache(cached_features_dir, dataset, get_columns(True))
+                # Continue from the cache so this run reads the same memory-mapped data as later ones
+                del features, dataset, examples
+                dataset, examples, features = load_feature_cache(cached_features_dir)
+    else:
+        processor = SquadV2Processor() if args.version_2_with_negative else SquadV1Processor()
+        if evaluate:
+            filename = args.predict_file or processor.dev_file
+        else:
+            filename = args.train_file or processor.train_file
+        # One shard per contract, keyed by its content and the tokenization parameters; only new or changed
+        # contracts are converted, in args.threads processes
+        cached_features_dir = build_contract_cache(
+            cache_prefix,
+            os.path.join(input_dir, filename),
+            processor,
+            tokenizer,
             max_seq_length=args.max_seq_length,
             doc_stride=args.doc_stride,
             max_query_length=args.max_query_length,
             is_training=not evaluate,
-            return_dataset="pt",
             threads=args.threads,
+            overwrite=overwrite_cache,
         )
-
-        if evaluate:
-            if args.local_rank in [-1, 0]:
-                logger.info("Saving features into cached file %s", cached_features_file)
-                torch.save({"features": features, "dataset": dataset, "examples": examples}, cached_features_file)
+        logger.info("Opening features from cache directory %s", cached_features_dir)
+        dataset, examples, features = load_feature_cache(cached_features_dir)
+
+    if not evaluate:
+        # Only the indices of the balanced training subset are cached; they select from the full cached dataset,
+        # whose directory name identifies the exact contracts and conversion parameters
+        balanced_indices_file = os.path.join(
+            cached_features_dir, "balanced_indices_{}_{}.npy".format(str(args.neg_pos_ratio), str(args.seed))
+        )
+        if os.path.exists(balanced_indices_file) and not overwrite_cache:
+            logger.info("Loading balanced subset indices from cached file %s", balanced_indices_file)
+            keep_indices = np.load(balanced_indices_file)
         else:
-            dataset = get_balanced_dataset(dataset)
+            keep_indices = get_balanced_indices(dataset, neg_pos_ratio=args.neg_pos_ratio, seed=args.seed)
             if args.local_rank in [-1, 0]:
-                logger.info("Saving balanced dataset into cached file %s", subset_cached_features_file)
-                torch.save({"dataset": dataset}, subset_cached_features_file)
+                logger.info("Saving balanced subset indices into cached file %s", balanced_indices_file)
+                np.save(balanced_indices_file, keep_indices)
+        dataset = torch.utils.data.Subset(dataset, keep_indices.tolist())
 
     if args.local_rank == 0 and not evaluate:
         # Make sure only the first process in distributed training process the dataset, and the others will use the cache
@@ -707,8 +715,16 @@ def main():
     parser.add_argument("--server_ip", type=str, default="", help="Can be used for distant debugging.")
     parser.add_argument("--server_port", type=str, default="", help="Can be used for distant debugging.")
 
-    parser.add_argument("--threads", type=int, default=1, help="multiple threads for converting example to features")
+    parser.add_argument(
+        "--threads", type=int, default=1, help="number of processes converting contracts to features"
+    )
     parser.add_argument("--keep_frac", type=float, default=1.0, help="The fraction of the balanced dataset to keep.")
+    parser.add_argument(
+        "--neg_pos_ratio",
+        type=float,
+        default=1.0,
+        help="Expected number of negative training features kept per positive one when balancing the dataset.",
+    )
     args = parser.parse_args()
 
     if args.doc_stride >= args.max_seq_length - args.max_query_length:
@@ -27,10 +27,12 @@ Modified version of "squad_metrics.py" adapated for CUAD.
 import collections
 import json
 import math
+import os
 import re
 import string
 import json
 
+import numpy as np
 from transformers.models.bert import BasicTokenizer
 from transformers.utils import logging
 
@@ -386,14 +388,37 @@ def get_final_text(pred_text, orig_text, do_lower_case, verbose_logging=False):
 
 def _get_best_indexes(logits, n_best_size):
     """Get the n-best logits from a list."""
-    index_and_score = sorted(enumerate(logits), key=lambda x: x[1], reverse=True)
+    logits = np.asarray(logits)
+    if n_best_size <= 0:
+        return []
+    if n_best_size < len(logits):
+        # Keep everything tied with the n-th best so ties are broken by index, as a stable sort would
+        kth = len(logits) - n_best_size
+        candidates = np.flatnonzero(logits >= np.partition(logits, kth)[kth])
+    else:
+        candidates = np.arange(len(logits))
+    order = np.argsort(-logits[candidates], kind="stable")
+    return candidates[order][:n_best_size].tolist()
 
-    best_indexes = []
-    for i in range(len(index_and_score)):
-        if i >= n_best_size:
-            break
-        best_indexes.append(index_and_score[i][0])
-    return best_indexes
+
+def _get_valid_spans(feature, start_logits, end_logits, n_best_size, max_answer_length):
+    """
+    (start, end) pairs among the n-best start and end indexes that lie in the context, start at a
+    max-context token and are at most max_answer_length long, in (start, end) nested-loop order.
+    """
+    start_indexes = np.array(_get_best_indexes(start_logits, n_best_size), dtype=np.int64)
+    end_indexes = np.array(_get_best_indexes(end_logits, n_best_size), dtype=np.int64)
+    num_tokens = len(feature.tokens)
+    valid_start = np.array(
+        [i < num_tokens and i in feature.token_to_orig_map and bool(feature.token_is_max_context.get(i, False))
+         for i in start_indexes.tolist()],
+        dtype=bool,
+    )
+    valid_end = np.array([i < num_tokens and i in feature.token_to_orig_map for i in end_indexes.tolist()], dtype=bool)
+    lengths = end_indexes[None, :] - start_indexes[:, None] + 1
+    mask = valid_start[:, None] & valid_end[None, :] & (lengths >= 1) & (lengths <= max_answer_length)
+    rows, cols = np.nonzero(mask)
+    return start_indexes[rows], end_indexes[cols]
 
 
 def _compute_softmax(scores):
@@ -419,6 +444,122 @@ def _compute_softmax(scores):
     return probs
 
 
+class JsonStreamWriter:
+    """
+    Writes a JSON object entry by entry, one entry per line, flushing each as it is written.
+    The file is ordinary JSON; evaluate.iter_json reads it back one entry at a time.
+    Entries go to path + ".tmp", which replaces path only when the block exits without an exception, so a crashed
+    run never leaves a truncated file that still parses. Does nothing if path is None.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.count = 0
+
+    def __enter__(self):
+        if self.path:
+            self.file = open(self.path + ".tmp", "w")
+            self.file.write("{")
+        return self
+
+    def write(self, key, value):
+        if self.file:
+            self.file.write(("," if self.count else "") + "\n" + json.dumps(key) + ": " + json.dumps(value))
+            self.file.flush()
+        self.count += 1
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.file:
+            if exc_type is None:
+                self.file.write("\n}\n")
+            self.file.close()
+            if exc_type is None:
+                os.replace(self.path + ".tmp", self.path)
+            else:
+                os.remove(self.path + ".tmp")
+
+
+# Start/end logits of every feature as (num_features, seq_length) arrays; row i belongs to all_features[i]
+FeatureLogits = collections.namedtuple("FeatureLogits", ["start_logits", "end_logits"])
+
+_PrelimPrediction = collections.namedtuple(  # pylint: disable=invalid-name
+    "PrelimPrediction", ["feature_index", "start_index", "end_index", "start_logit", "end_logit"]
+)
+
+
+def _get_prelim_predictions(features, unique_id_to_result, n_best_size, max_answer_length, version_2_with_negative):
+    """
+    Candidate spans of one example's features, best first, and the minimum null score with its logits.
+    Returns (prelim_predictions, score_null, null_start_logit, null_end_logit); prelim_predictions is
+    a lazy iterator, since callers stop once they have n_best_size distinct answers.
+    """
+    # keep track of the minimum score of null start+end of position 0
+    score_null = 1000000  # large and positive
+    min_null_feature_index = 0  # the paragraph slice with min null score
+    null_start_logit = 0  # the start logit at the slice with min null score
+    null_end_logit = 0  # the end logit at the slice with min null score
+    # Candidate spans of all features as flat arrays, in the order the spans are enumerated
+    candidate_features, candidate_starts, candidate_ends = [], [], []
+    candidate_start_logits, candidate_end_logits = [], []
+    for (feature_index, feature) in enumerate(features):
+        result = unique_id_to_result[feature.unique_id]
+        start_logits = np.asarray(result.start_logits, dtype=np.float64)
+        end_logits = np.asarray(result.end_logits, dtype=np.float64)
+        # if we could have irrelevant answers, get the min score of irrelevant
+        if version_2_with_negative:
+            feature_null_score = float(start_logits[0]) + float(end_logits[0])
+            if feature_null_score < score_null:
+                score_null = feature_null_score
+                min_null_feature_index = feature_index
+                null_start_logit = float(start_logits[0])
+                null_end_logit = float(end_logits[0])
+        # We could hypothetically create invalid predictions, e.g., predict
+        # that the start of the span is in the question. We throw out all
+        # invalid predictions.
+        starts, ends = _get_valid_spans(feature, start_logits, end_logits, n_best_size, max_answer_length)
+        candidate_features.append(np.full(len(starts), feature_index, dtype=np.int64))
+        candidate_starts.append(starts)
+        candidate_ends.append(ends)
+        candidate_start_logits.append(start_logits[starts])
+        candidate_end_logits.append(end_logits[ends])
+    if version_2_with_negative:
+        candidate_features.append(np.array([min_null_feature_index], dtype=np.int64))
+        candidate_starts.append(np.zeros(1, dtype=np.int64))
+        candidate_ends.append(np.zeros(1, dtype=np.int64))
+        candidate_start_logits.append(np.array([null_start_logit], dtype=np.float64))
+        candidate_end_logits.append(np.array([null_end_logit], dtype=np.float64))
+    if not candidate_features:
+        return iter(()), score_null, null_start_logit, null_end_logit
+    candidate_features = np.concatenate(candidate_features)
+    candidate_starts = np.concatenate(candidate_starts)
+    candidate_ends = np.concatenate(candidate_ends)
+    candidate_start_logits = np.concatenate(candidate_start_logits)
+    candidate_end_logits = np.concatenate(candidate_end_logits)
+    # Stable descending sort, so equal scores keep enumeration order as sorted(..., reverse=True) does
+    order = np.argsort(-(candidate_start_logits + candidate_end_logits), kind="stable")
+    null_position = len(candidate_starts) - 1 if version_2_with_negative else -1
+    prelim_predictions = (
+        _PrelimPrediction(
+            feature_index=min_null_feature_index,
+            start_index=0,
+            end_index=0,
+            start_logit=null_start_logit,
+            end_logit=null_end_logit,
+        )
+        if i == null_position
+        else _PrelimPrediction(
+            feature_index=int(candidate_features[i]),
+            start_index=int(candidate_starts[i]),
+            end_index=int(candidate_ends[i]),
+            start_logit=float(candidate_start_logits[i]),
+            end_logit=float(candidate_end_logits[i]),
+        )
+        for i in order
+    )
+    return prelim_predictions, score_null, null_start_logit, null_end_logit
+
+
 def compute_predictions_logits(
     json_input_dict,
     all_examples,
@@ -435,7 +576,10 @@ def compute_predictions_logits(
     null_score_diff_threshold,
     tokenizer,
 ):
-    """Write final predictions to the json file and log-odds of null if needed."""
+    """
+    Write final predictions to the json file and log-odds of null if needed.
+    all_results is a list of SquadResult, or a FeatureLogits whose rows follow all_features.
+    """
     if output_prediction_file:
         logger.info(f"Writing predictions to: {output_prediction_file}")
     if output_nbest_file:
@@ -448,202 +592,144 @@ def compute_predictions_logits(
         example_index_to_features[feature.example_index].append(feature)
 
     unique_id_to_result = {}
-    for result in all_results:
-        unique_id_to_result[result.unique_id] = result
-
-    _PrelimPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-        "PrelimPrediction", ["feature_index", "start_index", "end_index", "start_logit", "end_logit"]
-    )
+    if isinstance(all_results, FeatureLogits):
+        # Rows are read in place; no per-feature result objects or lists
+        for (feature_index, feature) in enumerate(all_features):
+            unique_id_to_result[feature.unique_id] = FeatureLogits(
+                all_results.start_logits[feature_index], all_results.end_logits[feature_index]
+            )
+    else:
+        for result in all_results:
+            unique_id_to_result[result.unique_id] = result
 
     all_predictions = collections.OrderedDict()
-    all_nbest_json = collections.OrderedDict()
-    scores_diff_json = collections.OrderedDict()
 
     contract_name_to_idx = {}
     for idx in range(len(json_input_dict["data"])):
         contract_name_to_idx[json_input_dict["data"][idx]["title"]] = idx
 
-    for (example_index, example) in enumerate(all_examples):
-        features = example_index_to_features[example_index]
-
-        contract_name = example.title
-        contract_index = contract_name_to_idx[contract_name]
-        paragraphs = json_input_dict["data"][contract_index]["paragraphs"]
-        assert len(paragraphs) == 1
-
-        prelim_predictions = []
-        # keep track of the minimum score of null start+end of position 0
-        score_null = 1000000  # large and positive
-        min_null_feature_index = 0  # the paragraph slice with min null score
-        null_start_logit = 0  # the start logit at the slice with min null score
-        null_end_logit = 0  # the end logit at the slice with min null score
-        for (feature_index, feature) in enumerate(features):
-            result = unique_id_to_result[feature.unique_id]
-            start_indexes = _get_best_indexes(result.start_logits, n_best_size)
-            end_indexes = _get_best_indexes(result.end_logits, n_best_size)
-            # if we could have irrelevant answers, get the min score of irrelevant
-            if version_2_with_negative:
-                feature_null_score = result.start_logits[0] + result.end_logits[0]
-                if feature_null_score < score_null:
-                    score_null = feature_null_score
-                    min_null_feature_index = feature_index
-                    null_start_logit = result.start_logits[0]
-                    null_end_logit = result.end_logits[0]
-            for start_index in start_indexes:
-                for end_index in end_indexes:
-                    # We could hypothetically create invalid predictions, e.g., predict
-                    # that the start of the span is in the question. We throw out all
-                    # invalid predictions.
-                    if start_index >= len(feature.tokens):
-                        continue
-                    if end_index >= len(feature.tokens):
-                        continue
-                    if start_index not in feature.token_to_orig_map:
-                        continue
-                    if end_index not in feature.token_to_orig_map:
-                        continue
-                    if not feature.token_is_max_context.get(start_index, False):
-                        continue
-                    if end_index < start_index:
-                        continue
-                    length = end_index - start_index + 1
-                    if length > max_answer_length:
-                        continue
-                    prelim_predictions.append(
-                        _PrelimPrediction(
-                            feature_index=feature_index,
-                            start_index=start_index,
-                            end_index=end_index,
-                            start_logit=result.start_logits[start_index],
-                            end_logit=result.end_logits[end_index],
-                        )
-                    )
-        if version_2_with_negative:
-            prelim_predictions.append(
-                _PrelimPrediction(
-                    feature_index=min_null_feature_index,
-                    start_index=0,
-                    end_index=0,
-                    start_logit=null_start_logit,
-                    end_logit=null_end_logit,
-                )
-            )
-        prelim_predictions = sorted(prelim_predictions, key=lambda x: (x.start_logit + x.end_logit), reverse=True)
-
-        _NbestPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-            "NbestPrediction", ["text", "start_logit", "end_logit"]
-        )
+    # n-best lists and null odds are written out (and dropped) example by example
+    nbest_writer = JsonStreamWriter(output_nbest_file)
+    null_odds_writer = JsonStreamWriter(output_null_log_odds_file if version_2_with_negative else None)
+    with nbest_writer, null_odds_writer:
+        for (example_index, example) in enumerate(all_examples):
+            features = example_index_to_features[example_index]
 
-        seen_predictions = {}
-        nbest = []
-        start_indexes = []
-        end_indexes = []
-        for pred in prelim_predictions:
-            if len(nbest) >= n_best_size:
-                break
-            feature = features[pred.feature_index]
-            if pred.start_index > 0:  # this is a non-null prediction
-                tok_tokens = feature.tokens[pred.start_index : (pred.end_index + 1)]
-                orig_doc_start = feature.token_to_orig_map[pred.start_index]
-                orig_doc_end = feature.token_to_orig_map[pred.end_index]
-                orig_tokens = example.doc_tokens[orig_doc_start : (orig_doc_end + 1)]
+            contract_name = example.title
+            contract_index = contract_name_to_idx[contract_name]
+            paragraphs = json_input_dict["data"][contract_index]["paragraphs"]
+            assert len(paragraphs) == 1
 
-                tok_text = tokenizer.convert_tokens_to_string(tok_tokens)
-
-                # Clean whitespace
-                tok_text = tok_text.strip()
-                tok_text = " ".join(tok_text.split())
-                orig_text = " ".join(orig_tokens)
-
-                final_text = get_final_text(tok_text, orig_text, do_lower_case, verbose_logging)
+            prelim_predictions, score_null, null_start_logit, null_end_logit = _get_prelim_predictions(
+                features, unique_id_to_result, n_best_size, max_answer_length, version_2_with_negative
+            )
 
-                if final_text in seen_predictions:
-                    continue
+            _NbestPrediction = collections.namedtuple(  # pylint: disable=invalid-name
+                "NbestPrediction", ["text", "start_logit", "end_logit"]
+            )
 
-                seen_predictions[final_text] = True
+            seen_predictions = {}
+            nbest = []
+            start_indexes = []
+            end_indexes = []
+            for pred in prelim_predictions:
+                if len(nbest) >= n_best_size:
+                    break
+                feature = features[pred.feature_index]
+                if pred.start_index > 0:  # this is a non-null prediction
+                    tok_tokens = feature.tokens[pred.start_index : (pred.end_index + 1)]
+                    orig_doc_start = feature.token_to_orig_map[pred.start_index]
+                    orig_doc_end = feature.token_to_orig_map[pred.end_index]
+                    orig_tokens = example.doc_tokens[orig_doc_start : (orig_doc_end + 1)]
+
+                    tok_text = tokenizer.convert_tokens_to_string(tok_tokens)
+
+                    # Clean whitespace
+                    tok_text = tok_text.strip()
+                    tok_text = " ".join(tok_text.split())
+                    orig_text = " ".join(orig_tokens)
+
+                    final_text = get_final_text(tok_text, orig_text, do_lower_case, verbose_logging)
+
+                    if final_text in seen_predictions:
+                        continue
 
-                start_indexes.append(orig_doc_start)
-                end_indexes.append(orig_doc_end)
-            else:
-                final_text = ""
-                seen_predictions[final_text] = True
+                    seen_predictions[final_text] = True
 
-                start_indexes.append(-1)
-                end_indexes.append(-1)
+                    start_indexes.append(orig_doc_start)
+                    end_indexes.append(orig_doc_end)
+                else:
+                    final_text = ""
+                    seen_predictions[final_text] = True
 
-            nbest.append(_NbestPrediction(text=final_text, start_logit=pred.start_logit, end_logit=pred.end_logit))
+                    start_indexes.append(-1)
+                    end_indexes.append(-1)
 
-        # if we didn't include the empty option in the n-best, include it
-        if version_2_with_negative:
-            if "" not in seen_predictions:
-                nbest.append(_NbestPrediction(text="", start_logit=null_start_logit, end_logit=null_end_logit))
-                start_indexes.append(-1)
-                end_indexes.append(-1)
+                nbest.append(_NbestPrediction(text=final_text, start_logit=pred.start_logit, end_logit=pred.end_logit))
 
-            # In very rare edge cases we could only have single null prediction.
-            # So we just create a nonce prediction in this case to avoid failure.
-            if len(nbest) == 1:
-                nbest.insert(0, _NbestPrediction(text="empty", start_logit=0.0, end_logit=0.0))
+            # if we didn't include the empty option in the n-best, include it
+            if version_2_with_negative:
+                if "" not in seen_predictions:
+                    nbest.append(_NbestPrediction(text="", start_logit=null_start_logit, end_logit=null_end_logit))
+                    start_indexes.append(-1)
+                    end_indexes.append(-1)
+
+                # In very rare edge cases we could only have single null prediction.
+                # So we just create a nonce prediction in this case to avoid failure.
+                if len(nbest) == 1:
+                    nbest.insert(0, _NbestPrediction(text="empty", start_logit=0.0, end_logit=0.0))
+                    start_indexes.append(-1)
+                    end_indexes.append(-1)
+
+            # In very rare edge cases we could have no valid predictions. So we
+            # just create a nonce prediction in this case to avoid failure.
+            if not nbest:
+                nbest.append(_NbestPrediction(text="empty", start_logit=0.0, end_logit=0.0))
                 start_indexes.append(-1)
                 end_indexes.append(-1)
 
-        # In very rare edge cases we could have no valid predictions. So we
-        # just create a nonce prediction in this case to avoid failure.
-        if not nbest:
-            nbest.append(_NbestPrediction(text="empty", start_logit=0.0, end_logit=0.0))
-            start_indexes.append(-1)
-            end_indexes.append(-1)
-
-        assert len(nbest) >= 1, "No valid predictions"
-        assert len(nbest) == len(start_indexes), "nbest length: {}, start_indexes length: {}".format(len(nbest), len(start_indexes))
-
-        total_scores = []
-        best_non_null_entry = None
-        for entry in nbest:
-            total_scores.append(entry.start_logit + entry.end_logit)
-            if not best_non_null_entry:
-                if entry.text:
-                    best_non_null_entry = entry
-
-        probs = _compute_softmax(total_scores)
-
-        nbest_json = []
-        for (i, entry) in enumerate(nbest):
-            output = collections.OrderedDict()
-            output["text"] = entry.text
-            output["probability"] = probs[i]
-            output["start_logit"] = entry.start_logit
-            output["end_logit"] = entry.end_logit
-            output["token_doc_start"] = start_indexes[i]
-            output["token_doc_end"] = end_indexes[i]
-            nbest_json.append(output)
-
-        assert len(nbest_json) >= 1, "No valid predictions"
-
-        if not version_2_with_negative:
-            all_predictions[example.qas_id] = nbest_json[0]["text"]
-        else:
-            # predict "" iff the null score - the score of best non-null > threshold
-            score_diff = score_null - best_non_null_entry.start_logit - (best_non_null_entry.end_logit)
-            scores_diff_json[example.qas_id] = score_diff
-            if score_diff > null_score_diff_threshold:
-                all_predictions[example.qas_id] = ""
+            assert len(nbest) >= 1, "No valid predictions"
+            assert len(nbest) == len(start_indexes), "nbest length: {}, start_indexes length: {}".format(len(nbest), len(start_indexes))
+
+            total_scores = []
+            best_non_null_entry = None
+            for entry in nbest:
+                total_scores.append(entry.start_logit + entry.end_logit)
+                if not best_non_null_entry:
+                    if entry.text:
+                        best_non_null_entry = entry
+
+            probs = _compute_softmax(total_scores)
+
+            nbest_json = []
+            for (i, entry) in enumerate(nbest):
+                output = collections.OrderedDict()
+                output["text"] = entry.text
+                output["probability"] = probs[i]
+                output["start_logit"] = entry.start_logit
+                output["end_logit"] = entry.end_logit
+                output["token_doc_start"] = start_indexes[i]
+                output["token_doc_end"] = end_indexes[i]
+                nbest_json.append(output)
+
+            assert len(nbest_json) >= 1, "No valid predictions"
+
+            if not version_2_with_negative:
+                all_predictions[example.qas_id] = nbest_json[0]["text"]
             else:
-                all_predictions[example.qas_id] = best_non_null_entry.text
-        all_nbest_json[example.qas_id] = nbest_json
+                # predict "" iff the null score - the score of best non-null > threshold
+                score_diff = score_null - best_non_null_entry.start_logit - (best_non_null_entry.end_logit)
+                null_odds_writer.write(example.qas_id, score_diff)
+                if score_diff > null_score_diff_threshold:
+                    all_predictions[example.qas_id] = ""
+                else:
+                    all_predictions[example.qas_id] = best_non_null_entry.text
+            nbest_writer.write(example.qas_id, nbest_json)
 
     if output_prediction_file:
         with open(output_prediction_file, "w") as writer:
             writer.write(json.dumps(all_predictions, indent=4) + "\n")
 
-    if output_nbest_file:
-        with open(output_nbest_file, "w") as writer:
-            writer.write(json.dumps(all_nbest_json, indent=4) + "\n")
-
-    if output_null_log_odds_file and version_2_with_negative:
-        with open(output_null_log_odds_file, "w") as writer:
-            writer.write(json.dumps(scores_diff_json, indent=4) + "\n")
-
     return all_predictions
 
 
@@ -0,0 +1,131 @@
+"""
+FAISS index types for the contract vector store.
+
+FAISS_INDEX_TYPE selects the index the store uses:
+    flat      exact search, 4*d bytes per vector (the LangChain default)
+    hnsw      graph index, fast and accurate but larger than flat; no training
+    ivf_flat  inverted lists over exact vectors; searches FAISS_NPROBE lists
+    ivf_pq    inverted lists over product-quantized codes (FAISS_PQ_M bytes per
+              vector), which keeps millions of chunks in memory
+
+IVF indexes need training, so a store starts as flat and is converted once it
+holds FAISS_TRAIN_MIN vectors: the quantizer is trained on a random sample of
+at most FAISS_TRAIN_SAMPLE vectors and every vector is re-added in its original
+position, so the LangChain position -> docstore id mapping stays valid.
+"""
+import os
+import math
+import faiss
+import numpy as np
+
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "flat").lower()
+FAISS_NLIST = int(os.getenv("FAISS_NLIST", "0"))               # IVF lists; 0 = 4 * sqrt(vectors)
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", "16"))            # IVF lists searched per query
+FAISS_PQ_M = int(os.getenv("FAISS_PQ_M", "0"))                 # PQ bytes per vector; 0 = auto
+FAISS_HNSW_M = int(os.getenv("FAISS_HNSW_M", "32"))            # HNSW graph degree
+FAISS_EF_SEARCH = int(os.getenv("FAISS_EF_SEARCH", "64"))      # HNSW candidates per query
+FAISS_TRAIN_MIN = int(os.getenv("FAISS_TRAIN_MIN", "10000"))   # vectors before an IVF store is trained
+FAISS_TRAIN_SAMPLE = int(os.getenv("FAISS_TRAIN_SAMPLE", "100000"))
+
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+
+def _check_type(index_type):
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"FAISS index type must be one of {', '.join(INDEX_TYPES)}")
+
+def default_nlist(ntotal):
+    # ~39 training points per list is the least FAISS accepts without warning
+    return max(1, min(int(4 * math.sqrt(ntotal)), ntotal // 39))
+
+def default_pq_m(d):
+    for m in (48, 32, 24, 16, 12, 8, 4, 2, 1):
+        if d % m == 0:
+            return m
+
+def index_factory_string(index_type, d, ntotal):
+    """FAISS index_factory description for an index type at a given corpus size."""
+    _check_type(index_type)
+    nlist = FAISS_NLIST or default_nlist(ntotal)
+    return {
+        "flat": "Flat",
+        "hnsw": f"HNSW{FAISS_HNSW_M},Flat",
+        "ivf_flat": f"IVF{nlist},Flat",
+        "ivf_pq": f"IVF{nlist},PQ{FAISS_PQ_M or default_pq_m(d)}x8",
+    }[index_type]
+
+def index_type_of(index):
+    """Reports which of INDEX_TYPES a FAISS index is."""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf_flat"
+    return "flat"
+
+def configure_search(index, nprobe=None, ef_search=None):
+    """Applies the query-time accuracy/speed knobs of IVF and HNSW indexes."""
+    kind = index_type_of(index)
+    if kind.startswith("ivf"):
+        faiss.extract_index_ivf(index).nprobe = nprobe or FAISS_NPROBE
+    elif kind == "hnsw":
+        faiss.downcast_index(index).hnsw.efSearch = ef_search or FAISS_EF_SEARCH
+    return index
+
+def build_index(vectors, index_type, seed=0):
+    """
+    Builds (and trains, if needed) an index of the given type over vectors.
+    Args:
+        vectors (np.ndarray): float32 array of shape (n, d).
+        index_type (str): One of INDEX_TYPES.
+        seed (int): Seed for the training sample.
+    Returns:
+        faiss.Index with all vectors added, in order.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    n, d = vectors.shape
+    index = faiss.index_factory(d, index_factory_string(index_type, d, n))
+    if not index.is_trained:
+        sample = vectors
+        if n > FAISS_TRAIN_SAMPLE:
+            sample = vectors[np.random.default_rng(seed).choice(n, FAISS_TRAIN_SAMPLE, replace=False)]
+        index.train(sample)
+    index.add(vectors)
+    return configure_search(index)
+
+def should_convert(index, index_type=None):
+    """Whether a flat store index is due to become the configured index type."""
+    index_type = index_type or FAISS_INDEX_TYPE
+    _check_type(index_type)
+    if index_type == "flat" or index_type_of(index) != "flat":
+        return False
+    return index_type == "hnsw" or index.ntotal >= FAISS_TRAIN_MIN
+
+def convert_index(index, index_type=None):
+    """
+    Rebuilds an index as another type from its stored vectors, keeping positions.
+    Exact for flat/HNSW/IVF-Flat sources; an IVF-PQ source yields its approximations.
+    """
+    index_type = index_type or FAISS_INDEX_TYPE
+    if index_type_of(index).startswith("ivf"):
+        faiss.extract_index_ivf(index).make_direct_map()
+    vectors = index.reconstruct_n(0, index.ntotal)
+    return build_index(vectors, index_type)
+
+def remove_positions(index, positions):
+    """
+    Drops the vectors at the given positions and moves the later ones down, so
+    positions stay 0..ntotal-1 in order. Trained IVF quantizers and codebooks are
+    kept; an IVF-PQ index re-encodes its stored approximations.
+    """
+    if index_type_of(index).startswith("ivf"):
+        faiss.extract_index_ivf(index).make_direct_map()
+    vectors = index.reconstruct_n(0, index.ntotal)
+    index.reset()
+    index.add(np.delete(vectors, positions, axis=0))
+    return index
+
+def index_bytes(index):
+    """Serialized size of an index, a proxy for its memory footprint."""
+    return int(faiss.serialize_index(index).size)
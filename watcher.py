@@ -1,39 +1,111 @@
 import time
 import os
 import json
+import logging
+import argparse
+from datetime import date
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from parser import parse_contract, SUPPORTED_EXTENSIONS
-from embedder import chunk_and_embed
-from agent import analyze_contract
+from embedder import chunk_and_embed, store_lock, VECTORSTORE_DIR
+import metadata_index
+import rollups
+from agent import analyze_contract_stream
+import telemetry
+from telemetry import span
+from profiling import profile
 
 data_dir = os.path.join(os.path.dirname(__file__), '..', 'data', 'uploads')
 analysis_dir = os.path.join(os.path.dirname(__file__), '..', 'data', 'analysis')
 os.makedirs(analysis_dir, exist_ok=True)
 
+logger = logging.getLogger("watcher")
+
+FIELD_LABELS = {"contract_type": "Type", "clause": "Clause", "risk": "Risk", "summary": "Summary"}
+
+def print_event(event):
+    """Echoes streamed analysis fields to the console as their tokens arrive."""
+    if event["event"] == "start":
+        label = FIELD_LABELS[event["field"]] + (f" [{event['clause']}]" if event["clause"] else "")
+        print(f"{label}: ", end="", flush=True)
+    elif event["event"] == "delta":
+        print(event["text"], end="", flush=True)
+    elif event["event"] == "end":
+        print()
+    elif event["event"] == "done" and event.get("prefill"):
+        prefill = event["prefill"]
+        print(f"Prefill: {prefill['prompt_tokens']} tokens in {prefill['prefill_seconds']}s over "
+              f"{prefill['calls']} contract prompts, ~{prefill['saved_tokens_est']} tokens "
+              f"(~{prefill['saved_seconds_est']}s) reused from cache")
+
+def process_contract(file_path, on_event=None, profile_enabled=None):
+    """
+    Runs the full pipeline on one contract: parse, embed, analyze and save.
+    Args:
+        file_path (str): Path of the contract file.
+        on_event (callable): Receives each analyze_contract_stream event as it arrives.
+        profile_enabled (bool): Sample-profile the run and write <doc_id>.collapsed.txt
+            next to the analysis JSON; defaults to the PROFILE env var.
+    Returns:
+        str: Path of the saved analysis JSON.
+    """
+    doc_id = os.path.basename(file_path)
+    profile_path = os.path.join(analysis_dir, doc_id + '.collapsed.txt')
+    with profile(profile_path, profile_enabled), telemetry.bind(doc_id=doc_id), span("document"):
+        with span("parse"):
+            text = parse_contract(file_path)
+        logger.debug(f"Extracted text (first 200 chars):\n{text[:200]}\n---")
+        chunk_and_embed(text, doc_id)
+        # Analyze and save results
+        analysis = None
+        with span("analyze"):
+            for event in analyze_contract_stream(text, doc_id):
+                if on_event:
+                    on_event(event)
+                if event["event"] == "done":
+                    analysis = event["analysis"]
+        analysis["analyzed_at"] = date.today().isoformat()
+        out_json = os.path.join(analysis_dir, doc_id + '.json')
+        with span("write"):
+            with open(out_json, 'w') as f:
+                json.dump(analysis, f, indent=2)
+            rollups.record(doc_id, analysis)
+        # Under the store's write lock: a concurrent re-ingest moves chunk positions
+        with span("tag"), store_lock(VECTORSTORE_DIR):
+            metadata_index.tag_document(VECTORSTORE_DIR, doc_id, analysis, text)
+    telemetry.inc("documents_processed")
+    return out_json
+
 class ContractHandler(FileSystemEventHandler):
+    def __init__(self, profile_enabled=None):
+        super().__init__()
+        self.profile_enabled = profile_enabled
+
     def on_created(self, event):
         if event.is_directory:
             return
         ext = os.path.splitext(event.src_path)[1].lower()
         if ext in SUPPORTED_EXTENSIONS:
-            print(f"New contract detected: {event.src_path}")
+            logger.info(f"New contract detected: {event.src_path}")
             try:
-                text = parse_contract(event.src_path)
-                print(f"Extracted text (first 200 chars):\n{text[:200]}\n---")
-                chunk_and_embed(text, os.path.basename(event.src_path))
-                # Analyze and save results
-                analysis = analyze_contract(text, os.path.basename(event.src_path))
-                out_json = os.path.join(analysis_dir, os.path.basename(event.src_path) + '.json')
-                with open(out_json, 'w') as f:
-                    json.dump(analysis, f, indent=2)
-                print(f"Analysis saved to {out_json}")
-            except Exception as e:
-                print(f"Failed to process {event.src_path}: {e}")
+                out_json = process_contract(event.src_path, on_event=print_event,
+                                            profile_enabled=self.profile_enabled)
+                logger.info(f"Analysis saved to {out_json}")
+            except Exception:
+                telemetry.inc("documents_failed")
+                logger.exception(f"Failed to process {event.src_path}")
+            finally:
+                telemetry.write_metrics()
 
 def main():
-    print(f"Watching {data_dir} for new contracts...")
-    event_handler = ContractHandler()
+    arg_parser = argparse.ArgumentParser(description="Watch the uploads folder and analyze new contracts.")
+    arg_parser.add_argument('--profile', action='store_true', default=None,
+                            help="write a collapsed-stack profile next to each analysis JSON (or set PROFILE=1)")
+    args = arg_parser.parse_args()
+    telemetry.setup_logging()
+    telemetry.start_metrics_server()
+    logger.info(f"Watching {data_dir} for new contracts...")
+    event_handler = ContractHandler(profile_enabled=args.profile)
     observer = Observer()
     observer.schedule(event_handler, data_dir, recursive=False)
     observer.start()